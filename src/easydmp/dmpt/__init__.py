@@ -0,0 +1 @@
+default_app_config = 'easydmp.dmpt.apps.DmqaConfig'
@@ -6,14 +6,17 @@ from guardian.shortcuts import assign_perm
 from guardian.shortcuts import get_objects_for_user
 
 from easydmp.eestore.models import EEStoreMount
+from easydmp.utils.admin import CountedDeleteAdminMixin
 from easydmp.utils.admin import ObjectPermissionModelAdmin
 from easydmp.utils.admin import SetPermissionsMixin
 from easydmp.utils import get_model_name
+from flow.admin import GraphAdminMixin
 
 from .models import Template
 from .models import Section
 from .models import Question
 from .models import CannedAnswer
+from .utils import with_ordinals
 
 """
 The admin is simplified for non-superusers. Branching sections are disallowed,
@@ -46,7 +49,7 @@ def get_canned_answers_for_user(user):
 
 
 @admin.register(Template)
-class TemplateAdmin(SetPermissionsMixin, ObjectPermissionModelAdmin):
+class TemplateAdmin(CountedDeleteAdminMixin, SetPermissionsMixin, ObjectPermissionModelAdmin):
     list_display = ('id', 'title')
     list_display_links = ('title', 'id')
     set_permissions = ['use_template']
@@ -54,27 +57,31 @@ class TemplateAdmin(SetPermissionsMixin, ObjectPermissionModelAdmin):
 
 
 @admin.register(Section)
-class SectionAdmin(ObjectPermissionModelAdmin):
+class SectionAdmin(CountedDeleteAdminMixin, GraphAdminMixin, ObjectPermissionModelAdmin):
     list_display = (
         'template',
-        'position',
+        'ordinal',
         'section_depth',
         'id',
         'label',
         'title',
     )
-    list_display_links = ('template', 'section_depth', 'id', 'position')
+    list_display_links = ('template', 'section_depth', 'id', 'ordinal')
     list_filter = ('template',)
     actions = [
-        'increment_position',
-        'decrement_position',
+        'move_up',
+        'move_down',
     ]
     search_fields = [
         '=id',
         'title',
     ]
+    readonly_fields = ('graph',)
     _model_slug = 'section'
 
+    def get_queryset(self, request):
+        return with_ordinals(super().get_queryset(request))
+
     def get_limited_queryset(self, request):
         return get_sections_for_user(request.user)
 
@@ -86,19 +93,24 @@ class SectionAdmin(ObjectPermissionModelAdmin):
             kwargs["queryset"] = self.get_queryset(request)
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
-    # actions
+    # display fields
 
-    def increment_position(self, request, queryset):
-        for q in queryset.order_by('-position'):
-            q.position += 1
-            q.save()
-    increment_position.short_description = 'Increment position by 1'
+    def ordinal(self, obj):
+        return obj.get_ordinal()
+    ordinal.short_description = 'Position'
+    ordinal.admin_order_field = 'position'
+
+    # actions
 
-    def decrement_position(self, request, queryset):
+    def move_up(self, request, queryset):
         for q in queryset.order_by('position'):
-            q.position -= 1
-            q.save()
-    decrement_position.short_description = 'Decrement position by 1'
+            q.move_up()
+    move_up.short_description = 'Move up'
+
+    def move_down(self, request, queryset):
+        for q in queryset.order_by('-position'):
+            q.move_down()
+    move_down.short_description = 'Move down'
 
 
 class QuestionFilter(admin.SimpleListFilter):
@@ -189,9 +201,9 @@ class SectionFilter(admin.SimpleListFilter):
 
 
 @admin.register(Question)
-class QuestionAdmin(ObjectPermissionModelAdmin):
+class QuestionAdmin(CountedDeleteAdminMixin, ObjectPermissionModelAdmin):
     list_display = (
-        'position',
+        'ordinal',
         'id',
         'label',
         'question',
@@ -201,7 +213,7 @@ class QuestionAdmin(ObjectPermissionModelAdmin):
         'has_node',
         'get_mount',
     )
-    list_display_links = ('position', 'id', 'question')
+    list_display_links = ('ordinal', 'id', 'question')
     search_fields = [
         '=id',
         'question',
@@ -210,8 +222,8 @@ class QuestionAdmin(ObjectPermissionModelAdmin):
     actions = [
         'create_node',
         'toggle_obligatory',
-        'increment_position',
-        'decrement_position',
+        'move_up',
+        'move_down',
     ]
     list_filter = [
         'obligatory',
@@ -232,7 +244,7 @@ class QuestionAdmin(ObjectPermissionModelAdmin):
         return ('node', 'obligatory')
 
     def get_queryset(self, request):
-        return get_questions_for_user(request.user)
+        return with_ordinals(get_questions_for_user(request.user))
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == 'section' and not request.user.is_superuser:
@@ -242,6 +254,11 @@ class QuestionAdmin(ObjectPermissionModelAdmin):
 
     # display fields
 
+    def ordinal(self, obj):
+        return obj.get_ordinal()
+    ordinal.short_description = 'Position'
+    ordinal.admin_order_field = 'position'
+
     def has_node(self, obj):
         return True if obj.node else False
     has_node.short_description = 'Node'
@@ -266,14 +283,12 @@ class QuestionAdmin(ObjectPermissionModelAdmin):
             q.save()
     toggle_obligatory.short_description = 'Toggle obligatoriness'
 
-    def increment_position(self, request, queryset):
-        for q in queryset.order_by('-position'):
-            q.position += 1
-            q.save()
-    increment_position.short_description = 'Increment position by 1'
-
-    def decrement_position(self, request, queryset):
+    def move_up(self, request, queryset):
         for q in queryset.order_by('position'):
-            q.position -= 1
-            q.save()
-    decrement_position.short_description = 'Decrement position by 1'
+            q.move_up()
+    move_up.short_description = 'Move up'
+
+    def move_down(self, request, queryset):
+        for q in queryset.order_by('-position'):
+            q.move_down()
+    move_down.short_description = 'Move down'
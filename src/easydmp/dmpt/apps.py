@@ -3,5 +3,7 @@ from django.apps import AppConfig
 
 class DmqaConfig(AppConfig):
     name = 'easydmp.dmpt'
-    label = 'easydmp_dmpt'
     verbose_name = 'EasyDMP Template'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,171 @@
+"""
+Clone a template with everything that belongs to it, level by level
+
+Each kind of model (sections, FSAs, nodes, edges, questions, canned
+answers, EEStore mounts and their sources) is read in one query and
+inserted with one bulk insert. Maps from old to new pks are carried from
+level to level so that foreign keys can be set before inserting, which
+means the number of queries does not depend on the size of the template.
+"""
+
+from django.db import models
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.forms import model_to_dict
+
+from easydmp.eestore.models import EEStoreMount
+from flow.models import Edge
+from flow.models import clone_fsas
+
+from .models import CannedAnswer
+from .models import Question
+from .models import Section
+from .models import Template
+
+
+__all__ = [
+    'clone_template',
+]
+
+
+def _bulk_insert(objs, new_rows):
+    """Insert <objs> in bulk, then make sure they know their pks
+
+    Only PostgreSQL returns the pks of bulk inserted rows, elsewhere they
+    are read back from <new_rows>, which must be exactly the inserted rows.
+    Autoincremented pks are handed out in the order the rows are inserted,
+    so sorting on the pk restores the order of <objs>."""
+    if not objs:
+        return objs
+    model = type(objs[0])
+    objs = model.objects.bulk_create(objs)
+    if objs[0].pk is None:
+        pks = list(new_rows.order_by('pk').values_list('pk', flat=True))
+        assert len(pks) == len(objs), 'Bulk insert mismatch'
+        for obj, pk in zip(objs, pks):
+            obj.pk = pk
+    return objs
+
+
+def _copy(obj, exclude=(), **kwargs):
+    "Return an unsaved copy of <obj>, with <kwargs> overriding fields"
+    exclude = ['id', 'pk'] + list(exclude) + list(kwargs)
+    fields = model_to_dict(obj, exclude=exclude)
+    # Foreign keys not overridden must be kept as raw pks
+    for field in obj._meta.concrete_fields:
+        if field.is_relation and field.name in fields:
+            fields[field.attname] = fields.pop(field.name)
+    fields.update(kwargs)
+    return type(obj)(**fields)
+
+
+def _clone_sections(template, new):
+    sections = list(template.sections.order_by('position'))
+    new_sections = _bulk_insert(
+        [_copy(section, ['template', 'super_section'], template_id=new.pk)
+         for section in sections],
+        Section.objects.filter(template=new),
+    )
+    section_map = {old.pk: clone.pk for old, clone in zip(sections, new_sections)}
+    supers = {
+        section_map[section.pk]: section_map[section.super_section_id]
+        for section in sections if section.super_section_id
+    }
+    if supers:
+        whens = [When(pk=pk, then=Value(super_pk))
+                 for pk, super_pk in supers.items()]
+        Section.objects.filter(pk__in=supers).update(
+            super_section=Case(*whens, output_field=models.IntegerField())
+        )
+    return section_map
+
+
+def _clone_flows(questions, section_map):
+    """Clone the FSAs of each section of <questions>
+
+    An FSA is cloned once per section using it, as
+    "s<new section pk>-<old slug>". Returns the map from old question pk to
+    new node pk, and the map from (new node pk, old edge pk) to new edge pk.
+    """
+    slugs = {}
+    for question in questions:
+        if question.node_id is None:
+            continue
+        fsa = question.node.fsa
+        new_section_pk = section_map[question.section_id]
+        slug = 's{}-{}'.format(new_section_pk, fsa.slug)
+        slugs[(new_section_pk, fsa.pk)] = slug
+    fsa_pks, node_map = clone_fsas((fsa_pk, slug) for (_, fsa_pk), slug in slugs.items())
+    question_nodes = {}
+    for question in questions:
+        if question.node_id is None:
+            continue
+        slug = slugs[(section_map[question.section_id], question.node.fsa_id)]
+        question_nodes[question.pk] = node_map[(fsa_pks[slug], question.node_id)]
+    edges = Edge.objects.filter(prev_node__in=question_nodes.values())
+    edge_map = {
+        (prev_pk, old_pk): pk
+        for prev_pk, old_pk, pk in edges.values_list('prev_node_id', 'cloned_from_id', 'pk')
+    }
+    return question_nodes, edge_map
+
+
+def _clone_questions(questions, section_map, question_nodes, new):
+    new_questions = _bulk_insert(
+        [_copy(question, ['section', 'node'],
+               section_id=section_map[question.section_id],
+               node_id=question_nodes.get(question.pk))
+         for question in questions],
+        Question.objects.filter(section__template=new),
+    )
+    return {old.pk: clone.pk for old, clone in zip(questions, new_questions)}
+
+
+def _clone_canned_answers(template, question_map, question_nodes, edge_map):
+    canned_answers = CannedAnswer.objects.filter(
+        question__section__template=template).order_by('pk')
+    CannedAnswer.objects.bulk_create([
+        _copy(ca, ['question', 'edge'],
+              question_id=question_map[ca.question_id],
+              edge_id=edge_map.get((question_nodes.get(ca.question_id), ca.edge_id)))
+        for ca in canned_answers
+    ])
+
+
+def _clone_eestore_mounts(template, question_map, new):
+    mounts = list(EEStoreMount.objects.filter(question__section__template=template)
+                  .prefetch_related('sources').order_by('pk'))
+    new_mounts = _bulk_insert(
+        [EEStoreMount(question_id=question_map[mount.question_id],
+                      eestore_type_id=mount.eestore_type_id)
+         for mount in mounts],
+        EEStoreMount.objects.filter(question__section__template=new),
+    )
+    Through = EEStoreMount.sources.through
+    Through.objects.bulk_create([
+        Through(eestoremount_id=clone.pk, eestoresource_id=source.pk)
+        for mount, clone in zip(mounts, new_mounts)
+        for source in mount.sources.all()
+    ])
+
+
+@transaction.atomic
+def clone_template(template, title):
+    """Clone <template> with everything in it, and save it as <title>
+
+    The version is reset to 1 and ``published`` is not set."""
+    self_dict = model_to_dict(template, exclude=['id', 'pk', 'title',
+                                                 'version', 'published'])
+    new = Template.objects.create(title=title, version=1, **self_dict)
+    section_map = _clone_sections(template, new)
+    questions = list(
+        Question.objects.filter(section__template=template)
+        .select_related('node__fsa').order_by('section', 'position')
+    )
+    question_nodes, edge_map = _clone_flows(questions, section_map)
+    question_map = _clone_questions(questions, section_map, question_nodes, new)
+    _clone_canned_answers(template, question_map, question_nodes, edge_map)
+    _clone_eestore_mounts(template, question_map, new)
+    # bulk operations send no signals
+    Template.objects.filter(pk=new.pk).bump_generation()
+    return new
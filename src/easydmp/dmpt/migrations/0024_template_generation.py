@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dmpt', '0023_add_ordering_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='template',
+            name='generation',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Incremented whenever the structure of the template changes'),
+        ),
+    ]
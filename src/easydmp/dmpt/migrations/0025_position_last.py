@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dmpt', '0024_template_generation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='question',
+            name='position',
+            field=models.PositiveIntegerField(blank=True, help_text='Position in section, questions are sorted on this. Must be unique. Leave empty to put the question last.'),
+        ),
+        migrations.AlterField(
+            model_name='section',
+            name='position',
+            field=models.PositiveIntegerField(blank=True, help_text='Sections are sorted on this, a specific position may only occur once per template. Leave empty to put the section last.'),
+        ),
+    ]
@@ -1,6 +1,4 @@
-from collections import OrderedDict
 from copy import deepcopy
-from functools import lru_cache
 from textwrap import fill
 from uuid import uuid4
 import logging
@@ -14,10 +12,10 @@ from guardian.shortcuts import get_objects_for_user
 
 from django.apps import apps
 from django.conf import settings
-from django.contrib.admin.utils import NestedObjects
 from django.db import models
 from django.db import router
 from django.db import transaction
+from django.db.models.query import ModelIterable
 from django.forms import model_to_dict
 from django.template import engines, Context
 from django.utils.encoding import force_text
@@ -26,6 +24,8 @@ from django.utils.html import format_html, escape
 from django.utils.text import slugify
 
 from flow.graphviz import _prep_dotsource, view_dotsource, render_dotsource_to_file
+from flow.graphviz import render_dotsource_to_bytes
+from flow.modelmixins import CachedLabelMixin
 
 from .errors import TemplateDesignError
 from .utils import *
@@ -88,6 +88,19 @@ def dfs_paths(graph, start):
                 stack.append((next, path + [next]))
 
 
+def _get_node_cascades(nodes, whole_fsas=True):
+    """Return querysets of what to delete along with the question <nodes>
+
+    That is the edges to and from <nodes>, and either the FSAs of <nodes>,
+    which takes the nodes with them, or just <nodes>."""
+    FSA = apps.get_model('flow', 'FSA')
+    Edge = apps.get_model('flow', 'Edge')
+    edges = Edge.objects.filter(models.Q(prev_node__in=nodes) | models.Q(next_node__in=nodes))
+    if whole_fsas:
+        return [FSA.objects.filter(nodes__in=nodes), edges]
+    return [nodes, edges]
+
+
 class TemplateQuerySet(models.QuerySet):
 
     def has_access(self, user):
@@ -97,6 +110,13 @@ class TemplateQuerySet(models.QuerySet):
         qs = self.filter(published__isnull=False) | guardian_access
         return qs.distinct()
 
+    def bump_generation(self):
+        """Mark the structure of the templates as changed
+
+        Increments the generation counter in the database, without
+        touching any template already in memory."""
+        return self.update(generation=models.F('generation') + 1)
+
     def has_change_access(self, user):
         return get_objects_for_user(
             user,
@@ -111,6 +131,11 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
     version = models.PositiveIntegerField(default=1)
     created = models.DateTimeField(auto_now_add=True)
     published = models.DateTimeField(blank=True, null=True)
+    generation = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text='Incremented whenever the structure of the template changes',
+    )
 
     objects = TemplateQuerySet.as_manager()
 
@@ -126,18 +151,34 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
             return self.abbreviation
         return self.title
 
-    def collect(self, **kwargs):
-        collector = super().collect(**kwargs)
-        if self.questions.exists():
-            Edge = apps.get_model('flow', 'Edge')
-            nodes = [q.node for q in self.questions.all() if q.node]
-            fsas = set(n.fsa for n in nodes)
-            collector.collect(tuple(fsas))
-            edges = set()
-            for n in nodes:
-                edges.update(set(n.next_nodes.all() | n.prev_nodes.all()))
-            collector.collect(tuple(edges))
-        return collector
+    def save(self, *args, **kwargs):
+        # The generation is only ever changed in the database, by
+        # bump_generation(), so never write back a possibly stale value
+        if self.pk and not self._state.adding and not kwargs.get('force_insert'):
+            if kwargs.get('update_fields') is None:
+                kwargs['update_fields'] = [
+                    f.name for f in self._meta.concrete_fields
+                    if not f.primary_key and f.name != 'generation'
+                ]
+        super().save(*args, **kwargs)
+
+    def get_stamp(self):
+        """Return a (pk, generation) tuple identifying the current structure
+
+        Meant as a component of cache keys. The generation is read from the
+        database with a single lookup on the primary key, so changes made by
+        other processes are seen."""
+        generation = (Template.objects.filter(pk=self.pk)
+                      .values_list('generation', flat=True).get())
+        self.generation = generation
+        return (self.pk, generation)
+
+    def get_cascades(self):
+        cascades = super().get_cascades()
+        Node = apps.get_model('flow', 'Node')
+        nodes = Node.objects.filter(payload__section__template=self)
+        cascades.extend(_get_node_cascades(nodes))
+        return cascades
 
     @transaction.atomic
     def clone(self, title=None):
@@ -147,26 +188,16 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
         The version is reset to 1 and the new template is hidden from view by
         ``published`` not being set.
 
-        Also recursively clones all sections, questions, canned answers,
-        EEStore mounts, FSAs, nodes and edges."""
+        Also clones all sections, questions, canned answers, EEStore mounts,
+        FSAs, nodes and edges. Each kind is inserted in bulk, so the number of
+        queries does not depend on the size of the template."""
+        from .cloning import clone_template
         if not title:
             title = '{} ({})'.format(self.title, uuid4())
-        self_dict = model_to_dict(self, exclude=['id', 'pk', 'title',
-                                                 'version', 'published'])
-        new = self.__class__.objects.create(title=title, version=1, **self_dict)
-        # clone sections, which clones questions, canned answers, fsas and eestore mounts
-        section_mapping = {}
-        for section in self.sections.all():
-            new_section = section.clone(new)
-            section_mapping[section] = new_section
-        for old_section, new_section in section_mapping.items():
-            if old_section.super_section:
-                new_section.super_section = section_mapping[old_section.super_section]
-                new_section.save()
-        return new
+        return clone_template(self, title)
 
     def renumber_positions(self):
-        """Renumber section positions so that eg. (1, 2, 7, 12) becomes (1, 2, 3, 4)"""
+        """Renumber section positions so that eg. (1, 2, 7, 12) becomes (1024, 2048, 3072, 4096)"""
         sections = self.sections.order_by('position')
         self._renumber_positions(sections)
 
@@ -176,67 +207,35 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
 
     @property
     def first_section(self):
-        return Section.objects.filter(template=self).order_by('position')[0]
+        return self.snapshot().sections[0]
 
     @property
     def last_section(self):
-        return Section.objects.filter(template=self).order_by('-position')[0]
+        return self.snapshot().sections[-1]
 
     @property
     def first_question(self):
-        section = self.first_section
-        return section.first_question
+        graph = self.snapshot()
+        return graph.get_first_question_from(graph.sections[0])
 
     @property
     def last_question(self):
-        section = self.last_section
-        return section.last_question
+        graph = self.snapshot()
+        return graph.get_last_question_upto(graph.sections[-1])
+
+    def snapshot(self):
+        """Return a read-only snapshot of the whole template
+
+        See `easydmp.dmpt.snapshot.TemplateGraph`. The snapshot is cached
+        until the structure of the template changes."""
+        from .snapshot import get_template_graph
+        return get_template_graph(self)
 
     def generate_canned_text(self, data):
-        texts = []
-        for section in self.sections.order_by('position'):
-            canned_text = section.generate_canned_text(data)
-            section_dict = model_to_dict(section, exclude=('_state', '_template_cache'))
-            section_dict['introductory_text'] = mark_safe(section_dict['introductory_text'])
-            texts.append({
-                'section': section_dict,
-                'text': canned_text,
-            })
-        return texts
+        return self.snapshot().generate_canned_text(data)
 
     def get_summary(self, data, valid_section_ids=()):
-        summary = OrderedDict()
-        data = deepcopy(data)  # 1/2 Make absolutely sure we're working on a copy
-        for section in self.sections.order_by('position'):
-            section_summary = OrderedDict()
-            for question in section.find_minimal_path(data):
-                value = {}
-                question = question.get_instance()
-                answer = data.get(str(question.pk), None)
-                if not answer or answer.get('choice', None) is None:
-                    value['answer'] = None
-                else:
-                    value['answer'] = question.pprint_html(answer)
-                # 2/2 Otherwise this might edit the actual plan data in memory!
-                # Mutable types strike back..
-                value['question'] = question
-                section_summary[question.pk] = value
-            summary[section.full_title()] = {
-                'data': section_summary,
-                'section': {
-                    'valid': True if section.id in valid_section_ids else False,
-                    'depth': section.section_depth,
-                    'label': section.label,
-                    'title': section.title,
-                    'section': section,
-                    'full_title': section.full_title(),
-                    'pk': section.pk,
-                    'first_question': section.get_first_question(),
-                    'introductory_text': mark_safe(section.introductory_text),
-                    'comment': mark_safe(section.comment),
-                }
-            }
-        return summary
+        return self.snapshot().get_summary(data, valid_section_ids)
 
     def list_unknown_questions(self, plan):
         "List out all question pks of a plan that are unknown in the template"
@@ -246,35 +245,12 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
         return data_pks.difference(question_pks)
 
     def validate_plan(self, plan, recalculate=True):
-        wrong_pks = [str(pk) for pk in self.list_unknown_questions(plan)]
-        if wrong_pks:
-            error = 'The plan {} contains nonsense data: template has no questions for: {}'
-            planstr = '{} ({}), template {} ({})'.format(plan, plan.pk, self, self.pk)
-            LOG.error(error.format(planstr, ' '.join(wrong_pks)))
-            return False
-        if not plan.data:
-            error = 'The plan {} ({}) has no data: invalid'
-            LOG.error(error.format(plan, plan.pk))
-            return False
-        if recalculate:
-            for section in self.sections.all():
-                valids, invalids = section.find_validity_of_questions(plan.data)
-                section.set_validity_of_questions(plan, valids, invalids)
-            valids, invalids = self.find_validity_of_sections(plan.data)
-            self.set_validity_of_sections(plan, valids, invalids)
-        if plan.section_validity.filter(valid=True).count() == plan.template.sections.count():
-            return True
-        return False
+        "Validate <plan>, return a ValidationReport, which is true if valid"
+        assert self == plan.template, "Mrong template for plan"
+        return self.snapshot().validate_plan(plan, recalculate)
 
     def find_validity_of_sections(self, data):
-        valid_sections = set()
-        invalid_sections = set()
-        for section in self.sections.all():
-            if section.validate_data(data):
-                valid_sections.add(section.pk)
-            else:
-                invalid_sections.add(section.pk)
-        return (valid_sections, invalid_sections)
+        return self.snapshot().find_validity_of_sections(data)
 
     def set_validity_of_sections(self, plan, valids, invalids):
         plan.set_sections_as_valid(*valids)
@@ -304,19 +280,19 @@ class TemplateGroupObjectPermission(GroupObjectPermissionBase):
     content_object = models.ForeignKey(Template, on_delete=models.CASCADE)
 
 
-class Section(DeletionMixin, RenumberMixin, models.Model):
+class Section(DeletionMixin, RenumberMixin, CachedLabelMixin, models.Model):
     """A section of a :model:`dmpt.Template`.
 
     **Attributes**
 
     template: The template this section is part of
     title: Name of section. Can be empty if a template only has one section
-    position: Position when there is more than one section. 1 otherwise.
+    position: Position when there is more than one section. Last if not given.
     introductory_text: Canned text printed before the canned texcts of the sections' questions.
 
-    A template has at least one section, which is why the title is optional and
-    the default position is 1. A specific title and a specific position can
-    only be used once per template, this is checked when attempting to save.
+    A template has at least one section, which is why the title and position
+    are optional. A specific title and a specific position can only be used
+    once per template, this is checked when attempting to save.
     """
     GRAPHVIZ_TMPDIR = '/tmp/dmpt/'
     template = models.ForeignKey(Template, related_name='sections')
@@ -327,8 +303,9 @@ class Section(DeletionMixin, RenumberMixin, models.Model):
         help_text='May be empty for **one** section per template',
     )
     position = models.PositiveIntegerField(
-        default=1,
-        help_text='A specific position may only occur once per template',
+        blank=True,
+        help_text='Sections are sorted on this, a specific position may only '
+                  'occur once per template. Leave empty to put the section last.',
     )
     introductory_text = models.TextField(blank=True)
     comment = models.TextField(blank=True)
@@ -336,14 +313,15 @@ class Section(DeletionMixin, RenumberMixin, models.Model):
     section_depth = models.PositiveSmallIntegerField(default=1)
     branching = models.BooleanField(default=False)
 
+    position_parent = 'template'
+
     class Meta:
         unique_together = (
             ('template', 'title'),
             ('template', 'position'),
         )
 
-    @lru_cache(None)
-    def __str__(self):
+    def get_label(self):
         return '{}: {}'.format(self.template, self.full_title())
 
     def full_title(self):
@@ -396,60 +374,38 @@ class Section(DeletionMixin, RenumberMixin, models.Model):
                 new_ca.edge = edge_mapping[ca.edge]
                 new_ca.save()
 
-    def collect(self, **kwargs):
-        collector = super().collect(**kwargs)
-        if self.questions.exists():
-            Edge = apps.get_model('flow', 'Edge')
-            nodes = [q.node for q in self.questions.all() if q.node]
-            fsas = set(n.fsa for n in nodes)
-            collector.collect(tuple(fsas))
-            edges = set()
-            for n in nodes:
-                edges.update(set(n.next_nodes.all() | n.prev_nodes.all()))
-            collector.collect(tuple(edges))
-        return collector
+    def get_cascades(self):
+        cascades = super().get_cascades()
+        Node = apps.get_model('flow', 'Node')
+        nodes = Node.objects.filter(payload__section=self)
+        cascades.extend(_get_node_cascades(nodes))
+        return cascades
 
     def renumber_positions(self):
-        """Renumber question positions so that eg. (1, 2, 7, 12) becomes (1, 2, 3, 4)"""
+        """Renumber question positions so that eg. (1, 2, 7, 12) becomes (1024, 2048, 3072, 4096)"""
         questions = self.questions.order_by('position')
         self._renumber_positions(questions)
 
     def get_first_question(self):
-        if self.questions.exists():
-            return self.questions.order_by('position')[0]
-        return None
+        return self.template.snapshot().get_first_question(self)
 
     @property
     def first_question(self):
-        first_question = self.get_first_question()
-        if first_question:
-            return first_question
-        # See if there is a next section in case this one has no questions
-        next_section = self.get_next_section()
-        if next_section:
-            return next_section.first_question
-        return None
+        "The first question of this section, or else of the next section with questions"
+        return self.template.snapshot().get_first_question_from(self)
 
     def get_last_question(self, in_section=False):
-        if self.questions.exists():
-            return self.questions.order_by('-position')[0]
-        return None
+        return self.template.snapshot().get_last_question(self)
 
     @property
     def last_question(self):
-        last_question = self.get_last_question()
-        if last_question:
-            return last_question
-        # See if there is a prev section in case this one has no questions
-        prev_section = self.get_prev_section()
-        if prev_section:
-            return prev_section.last_question
-        return None
+        "The last question of this section, or else of the previous section with questions"
+        return self.template.snapshot().get_last_question_upto(self)
 
     def generate_canned_text(self, data):
         texts = []
-        for question in self.questions.order_by('position'):
-            answer = question.get_instance().generate_canned_text(data)
+        for question in self.questions.order_by('position').typed():
+            answer = question.generate_canned_text(data)
             if not isinstance(answer.get('text', ''), bool):
                 texts.append(answer)
         return texts
@@ -458,33 +414,23 @@ class Section(DeletionMixin, RenumberMixin, models.Model):
         return Section.objects.filter(template=self.template, position__gt=self.position)
 
     def get_next_section(self):
-        next_sections = self.get_all_next_sections().order_by('position')
-        if next_sections.exists():
-            return next_sections[0]
-        return None
+        return self.template.snapshot().get_next_section(self)
 
     def get_all_prev_sections(self):
         return Section.objects.filter(template=self.template, position__lt=self.position)
 
     def get_prev_section(self):
-        prev_sections = self.get_all_prev_sections().order_by('-position')
-        if prev_sections.exists():
-            return prev_sections[0]
-        return None
+        return self.template.snapshot().get_prev_section(self)
 
     def get_topmost_section(self):
-        obj = self
-        while obj.super_section is not None:
-            obj = obj.super_section
-        return obj
+        return self.template.snapshot().get_topmost_section(self)
 
     def find_validity_of_questions(self, data):
         assert data, 'No data, cannot validate'
-        questions = self.questions.all()
+        questions = self.questions.typed()
         valids = set()
         invalids = set()
         for question in questions:
-            question = question.get_instance()
             try:
                 valid = question.validate_data(data)
             except AttributeError:
@@ -500,17 +446,11 @@ class Section(DeletionMixin, RenumberMixin, models.Model):
         plan.set_questions_as_invalid(*invalids)
 
     def validate_data(self, data):
-        if not data:
-            return False
-        if not self.questions.exists():
-            return True
-        valids, invalids = self.find_validity_of_questions(data)
-        if not invalids:
-            return True
-        for path in self.find_all_paths():
-            if valids == set(path):
-                return True
-        return False
+        return self.template.snapshot().validate_section_data(self, data)
+
+    def walk(self, data):
+        "Follow the answers in <data> through the section, see `SectionWalk`"
+        return self.template.snapshot().walk_section(self, data)
 
     def find_minimal_path(self, data=None):
         minimal_qs = self.questions.filter(obligatory=True).order_by('position')
@@ -521,39 +461,42 @@ class Section(DeletionMixin, RenumberMixin, models.Model):
         qs = minimal_qs | answered_qs
         return list(qs.distinct().order_by('position'))
 
+    def get_paths(self):
+        """Return the paths through the section
+
+        See `easydmp.dmpt.snapshot.SectionPaths`. They are computed once
+        per change to the template."""
+        return self.template.snapshot().get_section_paths(self)
+
+    def count_paths(self):
+        return self.get_paths().count()
+
     def find_all_paths(self):
-        qs = self.questions.all()
-        adjacent = {}
-        for q in qs:
-            adjacent[q.pk] = set(i.pk if i else None for i in q.get_potential_next_questions())
-        paths = []
-        for path in dfs_paths(adjacent, self.first_question.pk):
-            if not path[-1]:
-                path = path[:-1]
-            paths.append(path)
-        return paths
+        return [list(path) for path in self.get_paths().paths]
 
     def generate_dotsource(self):
         global gv
         dot = gv.Digraph()
+        graph = self.template.snapshot()
+        paths = graph.get_section_paths(self)
 
         s_kwargs = {'shape': 'doublecircle'}
         s_start_id = 's-{}-start'.format(self.pk)
         dot.node(s_start_id, label='Start', **s_kwargs)
         s_end_id = 's-{}-end'.format(self.pk)
         dot.node(s_end_id, label='End', **s_kwargs)
-        for question in self.questions.order_by('position'):
+        for question in graph.get_questions(self):
             q_kwargs = {}
             q_kwargs['label'] = fill(str(question), 20)
             q_id = 'q{}'.format(question.pk)
-            if question.pk == self.get_first_question().pk:
+            if question.pk == paths.first:
                 dot.edge(s_start_id, q_id, **s_kwargs)
             dot.node(q_id, **q_kwargs)
-            next_questions = question.get_potential_next_questions_with_edge()
+            next_questions = paths.edges[question.pk]
             if next_questions:
-                for choice, next_question in next_questions:
-                    if next_question:
-                        nq_id = 'q{}'.format(next_question.pk)
+                for choice, next_question_pk in next_questions:
+                    if next_question_pk:
+                        nq_id = 'q{}'.format(next_question_pk)
                     else:
                         nq_id = s_end_id
                     e_kwargs = {'label': fill(choice, 15)}
@@ -573,6 +516,11 @@ class Section(DeletionMixin, RenumberMixin, models.Model):
             dotsource = self.generate_dotsource()
         return render_dotsource_to_file(format, filename, dotsource, self.GRAPHVIZ_TMPDIR, directory)
 
+    def render_dotsource_to_bytes(self, format, dotsource=None):
+        if not dotsource:
+            dotsource = self.generate_dotsource()
+        return render_dotsource_to_bytes(format, dotsource, self.GRAPHVIZ_TMPDIR)
+
 
 class NoCheckMixin:
 
@@ -599,7 +547,33 @@ class SimpleFramingTextMixin:
         return False
 
 
-class Question(DeletionMixin, RenumberMixin, models.Model):
+class TypedModelIterable(ModelIterable):
+    "Yield questions as instances of their subtype"
+
+    def __iter__(self):
+        for question in super().__iter__():
+            yield question.get_instance()
+
+
+class QuestionQuerySet(models.QuerySet):
+
+    def typed(self):
+        """Return questions as instances of their subtype
+
+        The node, the EEStore mount with its type and sources, and the
+        canned answers in order are fetched in bulk, in a fixed number of
+        queries however many questions there are."""
+        qs = self.select_related(
+            'node', 'eestore', 'eestore__eestore_type',
+        ).prefetch_related(
+            models.Prefetch('canned_answers', queryset=CannedAnswer.objects.order()),
+            'eestore__sources',
+        )
+        qs._iterable_class = TypedModelIterable
+        return qs
+
+
+class Question(DeletionMixin, RenumberMixin, CachedLabelMixin, models.Model):
     """The database representation of a question
 
     Questions come in many subtypes, stored in `input_type`.
@@ -627,8 +601,9 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
     )
     section = models.ForeignKey(Section, related_name='questions')
     position = models.PositiveIntegerField(
-        default=1,
-        help_text='Position in section. Must be unique.',
+        blank=True,
+        help_text='Position in section, questions are sorted on this. Must be '
+                  'unique. Leave empty to put the question last.',
     )
     label = models.CharField(max_length=16, blank=True)
     question = models.CharField(max_length=255)
@@ -640,6 +615,10 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
                                 blank=True, null=True,
                                 on_delete=models.SET_NULL)
 
+    objects = QuestionQuerySet.as_manager()
+
+    position_parent = 'section'
+
     class Meta:
         unique_together = ('section', 'position')
         ordering = ('section', 'position')
@@ -648,19 +627,18 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
             models.Index(fields=['section', 'position']),
         ]
 
-    @lru_cache(None)
-    def __str__(self):
+    def get_label(self):
         if self.label:
             return '{} {}'.format(self.label, self.question)
         return self.question
 
-    def collect(self, **kwargs):
-        collector = super().collect(**kwargs)
-        if self.node:
-            edges = set(self.node.next_nodes.all() | self.node.prev_nodes.all())
-            collector.collect(tuple(edges))
-            collector.collect([self.node])
-        return collector
+    def get_cascades(self):
+        cascades = super().get_cascades()
+        if self.node_id:
+            Node = apps.get_model('flow', 'Node')
+            nodes = Node.objects.filter(pk=self.node_id)
+            cascades.extend(_get_node_cascades(nodes, whole_fsas=False))
+        return cascades
 
     @transaction.atomic
     def clone(self, section):
@@ -673,7 +651,7 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
         return new
 
     def renumber_positions(self):
-        """Renumber canned answer positions so that eg. (1, 2, 7, 12) becomes (1, 2, 3, 4)"""
+        """Renumber canned answer positions so that eg. (1, 2, 7, 12) becomes (1024, 2048, 3072, 4096)"""
         cas = self.canned_answers.order_by('position', 'pk')
         if cas.count() > 1:
             self._renumber_positions(cas)
@@ -681,9 +659,20 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
     def is_valid(self):
         raise NotImplementedError
 
+    def get_section_ordinal(self):
+        """Return the place of the section of self in the template
+
+        If the section is not loaded yet, it is loaded with its template and
+        its ordinal in a single query."""
+        if not Question.section.is_cached(self):
+            sections = with_ordinals(Section.objects.select_related('template'))
+            self.section = sections.get(pk=self.section_id)
+        return self.section.get_ordinal()
+
     def legend(self):
         qstring = str(self)
-        return '{}({}): {}'.format(self.section.template, self.section.position, qstring)
+        ordinal = self.get_section_ordinal()
+        return '{}({}): {}'.format(self.section.template, ordinal, qstring)
 
     def get_class(self):
         """Get the correct class of a raw Question-instance
@@ -732,21 +721,57 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
         answer['text'] = canned
         return answer
 
+    def get_canned_answers(self):
+        """Return the canned answers in order, as a list
+
+        Uses the canned answers prefetched with ``prefetch_related()`` if
+        there are any, so that questions from a prefetching queryset or a
+        template snapshot need no further queries."""
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'canned_answers' in prefetched:
+            return list(prefetched['canned_answers'])
+        return list(self.canned_answers.order())
+
+    def _get_canned_table(self):
+        """Return (choice -> canned text, the first canned answer, count)
+
+        With prefetched canned answers, as in a template snapshot, the
+        table is built once and kept on the instance. If several canned
+        answers have the same choice, the first one wins."""
+        table = getattr(self, '_canned_table', None)
+        if table is not None:
+            return table
+        canned_answers = self.get_canned_answers()
+        lookup = {}
+        for canned in canned_answers:
+            lookup.setdefault(canned.choice, canned.canned_text)
+        first = canned_answers[0] if canned_answers else None
+        table = (lookup, first, len(canned_answers))
+        if 'canned_answers' in getattr(self, '_prefetched_objects_cache', {}):
+            self._canned_table = table
+        return table
+
+    def get_canned_lookup(self):
+        "Return a mapping from each choice to its canned text"
+        return self._get_canned_table()[0]
+
     def get_canned_answer(self, answer, frame=None, **kwargs):
-        if not self.canned_answers.exists():
+        lookup, first, count = self._get_canned_table()
+        if not count:
             return ''
 
         if not answer:
             return ''
 
-        if self.canned_answers.count() == 1:
-            return self.canned_answers.get().canned_text
+        if count == 1:
+            return first.canned_text
 
         choice = self._serialize_condition(answer)
-        canned = self.canned_answers.filter(choice=choice)
-        if canned:
-            return canned[0].canned_text or answer
-        return ''
+        try:
+            canned_text = lookup[choice]
+        except (KeyError, TypeError):  # TypeError: unhashable choice
+            return ''
+        return canned_text or answer
 
     def pprint(self, value):
         "Return a plaintext representation of the `choice`"
@@ -782,33 +807,40 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
     @classmethod
     def map_answers_to_nodes(self, answers):
         "Convert question pks to node pks, and choices to conditions"
-        data = {}
-        questions = {str(q.pk): q for q in (Question.objects
-                                            .select_related('node')
-                                            .filter(pk__in=answers.keys())) }
-        for question_pk, answer in answers.items():
-            q = questions[question_pk]
-            if not q.node: continue
-            q = q.get_instance()
-            condition = q.map_choice_to_condition(answer)
-            data[str(q.node.slug)] = condition
-        return data
+        return self.map_answers_to_nodes_many([answers])[0]
+
+    @classmethod
+    def map_answers_to_nodes_many(self, answer_sets):
+        """Convert several sets of answers, like for `map_answers_to_nodes()`
+
+        The questions of all the sets are fetched in a single query. The
+        result is a list of node slug -> condition dicts, in the same
+        order as <answer_sets>, ready for `flow.models.FSA.evaluate_many()`.
+        """
+        question_pks = set()
+        for answers in answer_sets:
+            question_pks.update(answers.keys())
+        questions = {str(q.pk): q.get_instance() for q in (Question.objects
+                                                           .select_related('node')
+                                                           .filter(pk__in=question_pks))}
+        data_sets = []
+        for answers in answer_sets:
+            data = {}
+            for question_pk, answer in answers.items():
+                q = questions[question_pk]
+                if not q.node: continue
+                condition = q.map_choice_to_condition(answer)
+                data[str(q.node.slug)] = condition
+            data_sets.append(data)
+        return data_sets
 
     def get_first_question_in_next_section(self):
-        next_section = self.section.get_next_section()
-        while next_section:
-            if next_section.questions.exists():
-                return next_section.first_question
-            next_section = next_section.get_next_section()
-        return None
+        section = self.section
+        return section.template.snapshot().get_first_question_in_next_section(section)
 
     def get_last_question_in_prev_section(self):
-        prev_section = self.section.get_prev_section()
-        while prev_section:
-            if prev_section.questions.exists():
-                return prev_section.last_question
-            prev_section = prev_section.get_prev_section()
-        return None
+        section = self.section
+        return section.template.snapshot().get_last_question_in_prev_section(section)
 
     def get_all_following_questions(self):
         "Return a qs of all questions in the same section with higher pos"
@@ -1012,7 +1044,7 @@ class ChoiceQuestion(Question):
         return answer
 
     def get_choices(self):
-        choices = self.canned_answers.order().values_list('choice', 'canned_text')
+        choices = [(ca.choice, ca.canned_text) for ca in self.get_canned_answers()]
         fixed_choices = []
         for (k, v) in choices:
             if not v:
@@ -1024,10 +1056,10 @@ class ChoiceQuestion(Question):
         choice = data.get('choice', None)
         if not choice:
             return False
-        choices = self.get_choices_keys()
-        if choice in choices:
-            return True
-        return False
+        try:
+            return choice in self.get_canned_lookup()
+        except TypeError:  # unhashable, cannot be a choice
+            return False
 
 
 class MultipleChoiceOneTextQuestion(Question):
@@ -1063,15 +1095,14 @@ class MultipleChoiceOneTextQuestion(Question):
         return pprint_list(value['choice'])
 
     def get_choices(self):
-        choices = tuple(self.canned_answers.order().values_list('choice', 'choice'))
+        choices = tuple((ca.choice, ca.choice) for ca in self.get_canned_answers())
         return choices
 
     def validate_choice(self, data):
         choice = set(data.get('choice', []))
         if not choice:
             return False
-        choices = set(self.get_choices_keys())
-        if choice <= choices:
+        if choice <= self.get_canned_lookup().keys():
             return True
         return False
 
@@ -1144,10 +1175,26 @@ class EEStoreMixin:
         return False
 
     def get_entries(self, eestore_pids):
+        prefetched = getattr(self, '_prefetched_entries', None)
+        if prefetched is not None:
+            eestore_type_id = self.eestore.eestore_type_id
+            entries = (prefetched[pid] for pid in set(eestore_pids) if pid in prefetched)
+            return sorted((entry for entry in entries if entry.eestore_type_id == eestore_type_id),
+                          key=lambda entry: entry.pk)
         all_entries = self.eestore.get_cached_entries()
         entries = all_entries.filter(eestore_pid__in=eestore_pids)
         return entries
 
+    def get_entry_pids(self, choice):
+        "List the EEStore pids in the <choice> of an answer"
+        if isinstance(choice, dict):
+            choice = choice.get('choices', ())
+        if not choice:
+            return []
+        if isinstance(choice, str):
+            return [choice]
+        return list(choice)
+
     def pprint(self, value):
         return value['text']
 
@@ -1579,7 +1626,7 @@ class CannedAnswerQuerySet(models.QuerySet):
         return self.order_by('question', 'position', 'pk')
 
 
-class CannedAnswer(DeletionMixin, models.Model):
+class CannedAnswer(DeletionMixin, CachedLabelMixin, models.Model):
     "Defines the possible answers for a branch-capable question"
     question = models.ForeignKey(Question, related_name='canned_answers')
     position = models.PositiveIntegerField(
@@ -1607,15 +1654,15 @@ class CannedAnswer(DeletionMixin, models.Model):
     def label(self):
         return self.choice
 
-    @lru_cache(None)
-    def __str__(self):
+    def get_label(self):
         return '{}: "{}" {}'.format(self.question.question, self.choice, self.canned_text)
 
-    def collect(self, **kwargs):
-        collector = super().collect(**kwargs)
-        if self.edge:
-            collector.collect([self.edge])
-        return collector
+    def get_cascades(self):
+        cascades = super().get_cascades()
+        if self.edge_id:
+            Edge = apps.get_model('flow', 'Edge')
+            cascades.append(Edge.objects.filter(pk=self.edge_id))
+        return cascades
 
     def clone(self, question):
         self_dict = model_to_dict(self, exclude=['id', 'pk', 'question', 'edge'])
@@ -1646,3 +1693,4 @@ class CannedAnswer(DeletionMixin, models.Model):
         condition = self.convert_choice_to_condition()
         self.edge.condition = condition
         self.edge.save()
+
@@ -0,0 +1,73 @@
+"""
+Memoized rendering of answers
+
+Turning an answer into canned text or HTML goes through
+`Question.get_canned_answer()`, `frame_canned_answer()`, `print_url()` and
+the `pprint_html()` methods, and the same answers of published and
+popular plans are rendered over and over. The results are memoized per
+process, keyed on the question, the stamp of its template (see
+`Template.get_stamp()`) and a hash of the answer, in a cache bounded both
+in number of entries and in total length of the rendered text.
+
+Answers to EEStore-backed questions are not memoized: their text depends
+on the EEStore cache, which is not part of the template.
+"""
+
+import hashlib
+import json
+
+from django.conf import settings
+
+from flow.cache import LRUCache
+
+
+__all__ = [
+    'get_rendered_cache_info',
+    'hash_answer',
+    'memoize_rendered',
+]
+
+
+DEFAULT_RENDERED_CACHE_SIZE = 4096
+DEFAULT_RENDERED_CACHE_MAX_CHARS = 4 * 1024 * 1024
+
+_RENDERED = LRUCache(
+    getattr(settings, 'EASYDMP_RENDERED_CACHE_SIZE', DEFAULT_RENDERED_CACHE_SIZE),
+    maxweight=getattr(settings, 'EASYDMP_RENDERED_CACHE_MAX_CHARS',
+                      DEFAULT_RENDERED_CACHE_MAX_CHARS),
+)
+
+
+def hash_answer(answer):
+    "Return a hash of <answer> that is stable between processes"
+    dump = json.dumps(answer, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(dump.encode('utf-8')).hexdigest()
+
+
+def memoize_rendered(kind, question, stamp, answer, render):
+    """Return the result of <render>(), memoized
+
+    <kind> tells apart different renderings of the same answer. <render>
+    must return a string or another immutable value."""
+    key = (kind, question.pk, stamp, hash_answer(answer))
+    value = _RENDERED.get(key, _RENDERED)
+    if value is not _RENDERED:
+        return value
+    value = render()
+    weight = len(value) if isinstance(value, str) else 1
+    _RENDERED.set(key, value, weight)
+    return value
+
+
+def get_rendered_cache_info():
+    "Return the hits, misses, number of entries and total size of the cache"
+    return {
+        'hits': _RENDERED.hits,
+        'misses': _RENDERED.misses,
+        'entries': len(_RENDERED),
+        'chars': _RENDERED.weight,
+    }
+
+
+def clear_rendered_cache():
+    _RENDERED.clear()
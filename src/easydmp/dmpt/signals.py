@@ -0,0 +1,148 @@
+"""
+Keep `Template.generation` in step with the structure of each template
+
+Whenever a section, question, canned answer, EEStore mount, FSA node or
+FSA edge belonging to a template is saved or deleted, the generation
+counter of the template is bumped. Bulk operations send no signals, use
+`TemplateQuerySet.bump_generation()` after those.
+
+Deletions via `DeletionMixin` send `pre_bulk_delete` instead of the delete
+signals, with the pks of all the objects of a model at once. The affected
+templates are bumped and the affected compiled FSAs dropped from that.
+Likewise, moving sections, questions or canned answers in bulk sends
+`positions_changed`.
+"""
+
+from django.db.models import Q
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from easydmp.eestore.models import EEStoreMount
+from easydmp.utils.deletion import pre_bulk_delete
+from flow.compiled import invalidate_compiled_fsa
+from flow.models import Edge
+from flow.models import FSA
+from flow.models import Node
+from flow.signals import get_fsa_pks_for_edge
+
+from .models import CannedAnswer
+from .models import INPUT_TYPE_MAP
+from .models import Question
+from .models import Section
+from .models import Template
+from .utils import positions_changed
+
+
+def bump_template(sender, instance, **kwargs):
+    Template.objects.filter(pk=instance.pk).bump_generation()
+
+
+def bump_template_of_section(sender, instance, **kwargs):
+    Template.objects.filter(pk=instance.template_id).bump_generation()
+
+
+def bump_template_of_question(sender, instance, **kwargs):
+    templates = Template.objects.filter(sections__id=instance.section_id)
+    templates.bump_generation()
+
+
+def bump_template_of_canned_answer(sender, instance, **kwargs):
+    templates = Template.objects.filter(sections__questions__id=instance.question_id)
+    templates.bump_generation()
+
+
+def bump_template_of_eestore_mount(sender, instance, **kwargs):
+    templates = Template.objects.filter(sections__questions__id=instance.question_id)
+    templates.bump_generation()
+
+
+def bump_template_of_node(sender, instance, **kwargs):
+    templates = Template.objects.filter(sections__questions__node__fsa_id=instance.fsa_id)
+    templates.bump_generation()
+
+
+def bump_template_of_edge(sender, instance, **kwargs):
+    fsa_pks = get_fsa_pks_for_edge(instance)
+    if not fsa_pks:
+        return
+    templates = Template.objects.filter(sections__questions__node__fsa_id__in=fsa_pks)
+    templates.bump_generation()
+
+
+def bump_template_of_eestore_sources(sender, instance, action, reverse, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # instance is an EEStoreSource, find the mounts through the change
+        mount_pks = kwargs.get('pk_set') or ()
+        templates = Template.objects.filter(sections__questions__eestore__id__in=mount_pks)
+    else:
+        templates = Template.objects.filter(sections__questions__id=instance.question_id)
+    templates.bump_generation()
+
+
+def get_fsa_pks_for_edges(edge_pks):
+    nodes = Node.objects.filter(
+        Q(next_nodes__id__in=edge_pks) | Q(prev_nodes__id__in=edge_pks))
+    return set(nodes.values_list('fsa_id', flat=True))
+
+
+def bulk_bump_templates(sender, pks, **kwargs):
+    if sender is FSA:
+        fsa_pks = pks
+    elif sender is Node:
+        fsa_pks = set(Node.objects.filter(id__in=pks).values_list('fsa_id', flat=True))
+    elif sender is Edge:
+        fsa_pks = get_fsa_pks_for_edges(pks)
+    else:
+        lookup = BULK_LOOKUPS[sender]
+        Template.objects.filter(**{lookup: pks}).bump_generation()
+        return
+    if not fsa_pks:
+        return
+    invalidate_compiled_fsa(*fsa_pks)
+    templates = Template.objects.filter(sections__questions__node__fsa_id__in=fsa_pks)
+    templates.bump_generation()
+
+
+def bump_templates_of_repositioned(sender, pks, **kwargs):
+    lookup = BULK_LOOKUPS[sender]
+    Template.objects.filter(**{lookup: pks}).bump_generation()
+
+
+# Proxy models send signals with themselves as sender
+QUESTION_CLASSES = set(INPUT_TYPE_MAP.values()) | {Question}
+
+RECEIVERS = (
+    (bump_template, (Template,)),
+    (bump_template_of_section, (Section,)),
+    (bump_template_of_question, QUESTION_CLASSES),
+    (bump_template_of_canned_answer, (CannedAnswer,)),
+    (bump_template_of_eestore_mount, (EEStoreMount,)),
+    (bump_template_of_node, (Node,)),
+    (bump_template_of_edge, (Edge,)),
+)
+
+for receiver, senders in RECEIVERS:
+    for sender in senders:
+        post_save.connect(receiver, sender=sender)
+        post_delete.connect(receiver, sender=sender)
+
+BULK_LOOKUPS = {
+    Section: 'sections__id__in',
+    Question: 'sections__questions__id__in',
+    CannedAnswer: 'sections__questions__canned_answers__id__in',
+    EEStoreMount: 'sections__questions__eestore__id__in',
+}
+
+for sender in tuple(BULK_LOOKUPS) + (FSA, Node, Edge):
+    pre_bulk_delete.connect(bulk_bump_templates, sender=sender)
+
+for sender in (Section, Question, CannedAnswer):
+    positions_changed.connect(bump_templates_of_repositioned, sender=sender)
+
+m2m_changed.connect(
+    bump_template_of_eestore_sources,
+    sender=EEStoreMount.sources.through,
+)
@@ -0,0 +1,1018 @@
+"""
+Read-only, in-memory snapshots of a whole template
+
+Walking Template -> sections -> questions -> canned answers -> nodes ->
+edges through the ORM costs queries at every step, and the same steps are
+repeated many times per request. A `TemplateGraph` loads the lot in a
+fixed number of queries:
+
+* the template
+* its sections
+* its questions, with their nodes and EEStore mounts
+* the canned answers of the questions, also as a choice -> canned text
+  table per question
+* the EEStore sources of the mounts
+* the nodes and edges of the FSAs, unless already compiled
+
+Snapshots are cached per process, keyed on the template's stamp (see
+`Template.get_stamp()`), so a changed template is loaded anew while the
+stale snapshot ages out of the cache.
+
+Everything in a snapshot is shared between requests: do not change the
+model instances it hands out.
+"""
+
+from collections import OrderedDict, deque, namedtuple
+from copy import copy, deepcopy
+from types import MappingProxyType
+import logging
+
+from django.conf import settings
+from django.db import router
+from django.db import transaction
+from django.forms import model_to_dict
+from django.utils.safestring import mark_safe
+
+from flow.cache import LRUCache
+from flow.compiled import compile_fsas
+from flow.errors import FSANoDataError
+
+from easydmp.eestore.models import EEStoreCache
+
+from .errors import TemplateDesignError
+from .models import EEStoreMixin
+from .models import Question
+from .models import Section
+from .models import Template
+from .rendered import memoize_rendered
+
+
+__all__ = [
+    'NavigationMap',
+    'SectionIndex',
+    'SectionPaths',
+    'SectionWalk',
+    'TemplateGraph',
+    'ValidationReport',
+    'get_template_graph',
+]
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_CACHE_SIZE = 32
+
+_SNAPSHOTS = LRUCache(
+    getattr(settings, 'EASYDMP_TEMPLATE_SNAPSHOT_CACHE_SIZE', DEFAULT_SNAPSHOT_CACHE_SIZE)
+)
+
+
+class SectionWalk(namedtuple('SectionWalk', ['path', 'first_invalid', 'complete'])):
+    """The result of following a plan's answers through a section
+
+    path:          the pks of the valid questions walked, in order
+    first_invalid: the pk of the first missing or invalid question on the
+                   way, or None
+    complete:      whether the walk reached the end of the section
+    """
+    __slots__ = ()
+
+    @property
+    def valid(self):
+        return self.complete and self.first_invalid is None
+
+
+class ValidationReport:
+    """The validity of the answers of a plan
+
+    Questions and sections are referred to by pk. <first_invalid> maps an
+    invalid section to the first missing or invalid question on the path
+    chosen by the answers, where known. <errors> holds the reasons the
+    plan could not be validated at all.
+
+    A report is true if the plan is valid."""
+
+    def __init__(self, plan_pk, valid_questions=(), invalid_questions=(),
+                 valid_sections=(), invalid_sections=(), first_invalid=None,
+                 errors=()):
+        self.plan_pk = plan_pk
+        self.valid_questions = frozenset(valid_questions)
+        self.invalid_questions = frozenset(invalid_questions)
+        self.valid_sections = frozenset(valid_sections)
+        self.invalid_sections = frozenset(invalid_sections)
+        self.first_invalid = MappingProxyType(dict(first_invalid or {}))
+        self.errors = tuple(errors)
+
+    def __repr__(self):  # pragma: no cover
+        return '<ValidationReport {}: {}>'.format(
+            self.plan_pk, 'valid' if self.valid else 'invalid')
+
+    def __bool__(self):
+        return self.valid
+
+    @property
+    def valid(self):
+        return not self.errors and not self.invalid_sections
+
+
+class NavigationMap:
+    """The questions a plan's answers lead through, in order
+
+    questions: the reachable questions, from the first question of the
+               template on, across all sections
+    complete:  whether the last question is the end of the plan, rather
+               than a question whose answer is needed to go on
+    sections:  the pks of the sections passed through, in order, each with
+               its slice of <questions>
+    """
+
+    def __init__(self, questions, complete):
+        self.questions = tuple(questions)
+        self.complete = complete
+        self._index = {q.pk: i for i, q in enumerate(self.questions)}
+        sections = OrderedDict()
+        for i, question in enumerate(self.questions):
+            start, _ = sections.get(question.section_id, (i, i))
+            sections[question.section_id] = (start, i + 1)
+        self.sections = MappingProxyType(
+            OrderedDict((pk, slice(*bounds)) for pk, bounds in sections.items())
+        )
+
+    def __repr__(self):  # pragma: no cover
+        return '<NavigationMap: {} questions{}>'.format(
+            len(self.questions), '' if self.complete else ', incomplete')
+
+    def __contains__(self, question):
+        return question.pk in self._index
+
+    def __len__(self):
+        return len(self.questions)
+
+    def get_next(self, question):
+        """Return the question after <question>, or None at the end
+
+        Raises KeyError if <question> is not on the map, or if it is the
+        last question and the way on is not yet known."""
+        i = self._index[question.pk]
+        if i + 1 < len(self.questions):
+            return self.questions[i + 1]
+        if self.complete:
+            return None
+        raise KeyError(question.pk)
+
+    def get_prev(self, question):
+        """Return the question before <question>, or None at the start
+
+        Raises KeyError if <question> is not on the map."""
+        i = self._index[question.pk]
+        return self.questions[i - 1] if i else None
+
+    def get_section_questions(self, section):
+        "Return the questions of <section> on the map, in order"
+        bounds = self.sections.get(section.pk, None)
+        return self.questions[bounds] if bounds else ()
+
+    def is_section_start(self, question):
+        "Whether <question> is the first question on the map in its section"
+        return self.sections[question.section_id].start == self._index[question.pk]
+
+
+def _sort_key(item):
+    return (item is None, item or 0)
+
+
+class SectionPaths:
+    """The paths through the questions of one section
+
+    A path starts at the first question of the section and ends at a
+    question with no next question, or where a next question may be
+    missing. A path never visits a question twice.
+
+    edges:     question pk -> ((label, next question pk or None), ...)
+    adjacency: question pk -> frozenset of next question pks
+    order:     question pks in topological order, None if there are loops
+
+    The number of paths is counted without generating them, and paths are
+    only generated, lazily, when asked for.
+    """
+
+    def __init__(self, first, edges):
+        self.first = first
+        self.edges = MappingProxyType(edges)
+        self.adjacency = MappingProxyType(
+            {pk: frozenset(next_pk for _, next_pk in e) for pk, e in edges.items()}
+        )
+        self._successors = {
+            pk: tuple(sorted(targets, key=_sort_key))
+            for pk, targets in self.adjacency.items()
+        }
+        self.order = self._find_order()
+        if self.order is not None:
+            self._position = {pk: i for i, pk in enumerate(self.order)}
+        self._paths = None
+        self._count = None
+
+    def _find_order(self):
+        indegree = {pk: 0 for pk in self.adjacency}
+        for targets in self.adjacency.values():
+            for target in targets:
+                if target in indegree:
+                    indegree[target] += 1
+        queue = deque(pk for pk, degree in indegree.items() if not degree)
+        order = []
+        while queue:
+            pk = queue.popleft()
+            order.append(pk)
+            for target in self._successors[pk]:
+                if target not in indegree:
+                    continue
+                indegree[target] -= 1
+                if not indegree[target]:
+                    queue.append(target)
+        if len(order) != len(indegree):
+            return None
+        return tuple(order)
+
+    def iter_paths(self):
+        """Lazily generate the paths as tuples of question pks
+
+        All branches share the one list holding the path walked so far."""
+        if self.first is None:
+            return
+        path = [self.first]
+        on_path = {self.first}
+        successors = self._successors.get(self.first, ())
+        if not successors:
+            yield (self.first,)
+            return
+        stack = [iter(successors)]
+        while stack:
+            for pk in stack[-1]:
+                if pk is None:
+                    yield tuple(path)
+                    continue
+                if pk in on_path:
+                    continue
+                successors = self._successors.get(pk, ())
+                if not successors:
+                    yield tuple(path) + (pk,)
+                    continue
+                path.append(pk)
+                on_path.add(pk)
+                stack.append(iter(successors))
+                break
+            else:
+                stack.pop()
+                on_path.discard(path.pop())
+
+    @property
+    def paths(self):
+        "All paths, generated once"
+        if self._paths is None:
+            self._paths = tuple(self.iter_paths())
+        return self._paths
+
+    def count(self):
+        """Count the paths
+
+        Without loops this is done by dynamic programming over the
+        topological order, in time linear in the size of the section."""
+        if self._count is not None:
+            return self._count
+        if self.first is None:
+            count = 0
+        elif self.order is None:
+            count = len(self.paths)
+        else:
+            counts = {}
+            for pk in reversed(self.order):
+                successors = self._successors[pk]
+                if not successors:
+                    counts[pk] = 1
+                    continue
+                counts[pk] = sum(1 if target is None else counts.get(target, 1)
+                                 for target in successors)
+            count = counts[self.first]
+        self._count = count
+        return count
+
+    def is_path(self, pks):
+        """Whether the question pks <pks> are exactly the questions of a path
+
+        Without loops, the only candidate is <pks> in topological order, so
+        no paths need to be generated."""
+        pks = set(pks)
+        if self.order is None:
+            return any(pks == set(path) for path in self.paths)
+        if self.first not in pks or not pks.issubset(self._position):
+            return False
+        candidate = sorted(pks, key=self._position.__getitem__)
+        if candidate[0] != self.first:
+            return False
+        for pk, next_pk in zip(candidate, candidate[1:]):
+            if next_pk not in self.adjacency[pk]:
+                return False
+        last = self.adjacency[candidate[-1]]
+        return not last or None in last
+
+
+class SectionIndex:
+    """The order of the sections of a template, for navigating in O(1)
+
+    Sections and questions are referred to by pk. The lookups are:
+
+    order:          the sections, by position
+    next, prev:     the section right after and before each section
+    next_nonempty, prev_nonempty:
+                    the nearest section after and before each section that
+                    has questions
+    first_question, last_question:
+                    the first and last question of each section
+    topmost:        the outermost super section of each section, or the
+                    section itself
+
+    Missing neighbours and questions are None.
+    """
+
+    def __init__(self, sections, questions_per_section):
+        """<sections>: (pk, super section pk) pairs, in order
+        <questions_per_section>: section pk -> question pks, in order"""
+        order = tuple(pk for pk, _ in sections)
+        self.order = order
+        self.next = MappingProxyType(dict(zip(order, order[1:] + (None,))))
+        self.prev = MappingProxyType(dict(zip(order, (None,) + order[:-1])))
+        first_question = {}
+        last_question = {}
+        for pk in order:
+            questions = questions_per_section.get(pk, ())
+            first_question[pk] = questions[0] if questions else None
+            last_question[pk] = questions[-1] if questions else None
+        self.first_question = MappingProxyType(first_question)
+        self.last_question = MappingProxyType(last_question)
+        self.next_nonempty = MappingProxyType(self._find_nonempty(reversed(order)))
+        self.prev_nonempty = MappingProxyType(self._find_nonempty(order))
+        self.topmost = MappingProxyType(self._find_topmost(dict(sections)))
+
+    def _find_nonempty(self, order):
+        nearest = {}
+        found = None
+        for pk in order:
+            nearest[pk] = found
+            if self.first_question[pk] is not None:
+                found = pk
+        return nearest
+
+    def _find_topmost(self, parents):
+        topmost = {}
+        for pk in parents:
+            chain = []
+            current = pk
+            while current not in topmost:
+                parent = parents.get(current, None)
+                if parent not in parents or parent in chain or parent == current:
+                    # Outermost, elsewhere, or a loop
+                    topmost[current] = current
+                    break
+                chain.append(current)
+                current = parent
+            for member in chain:
+                topmost[member] = topmost[current]
+        return topmost
+
+
+class TemplateGraph:
+    """A read-only snapshot of a template and everything in it
+
+    template:  the Template
+    stamp:     the (pk, generation) of the template when it was loaded
+    sections:  all sections, in order
+    questions: all questions as instances of their subtype, in order
+    shared:    whether the snapshot is in the cache, shared between requests
+    """
+
+    def __init__(self, template_pk, stamp):
+        self.stamp = stamp
+        self.template = Template.objects.get(pk=template_pk)
+        sections = list(Section.objects.filter(template_id=template_pk).order_by('position'))
+        for ordinal, section in enumerate(sections, 1):
+            section.template = self.template
+            section.ordinal = ordinal
+        sections_by_pk = OrderedDict((section.pk, section) for section in sections)
+
+        questions = (
+            Question.objects
+            .filter(section__template_id=template_pk)
+            .order_by('section__position', 'position')
+            .typed()
+            .select_related('node__fsa')
+        )
+        questions_per_section = OrderedDict((pk, []) for pk in sections_by_pk)
+        questions_by_pk = OrderedDict()
+        payloads = {}
+        generations = {}
+        for question in questions:
+            question.section = sections_by_pk[question.section_id]
+            questions_per_section[question.section_id].append(question)
+            questions_by_pk[question.pk] = question
+            question._get_canned_table()  # Build it before it is shared
+            if question.node_id:
+                payloads[(question.node.fsa_id, question.node.slug)] = question
+                generations[question.node.fsa_id] = question.node.fsa.generation
+
+        self.sections = tuple(sections)
+        self.questions = tuple(questions_by_pk.values())
+        self._sections_by_pk = MappingProxyType(sections_by_pk)
+        self._questions_by_pk = MappingProxyType(questions_by_pk)
+        self._questions_per_section = MappingProxyType(
+            {pk: tuple(qs) for pk, qs in questions_per_section.items()}
+        )
+        self._payloads = MappingProxyType(payloads)
+        fsa_pks = set(fsa_pk for fsa_pk, _ in payloads)
+        self._fsas = MappingProxyType(compile_fsas(fsa_pks, generations))
+        self._section_paths = {}
+        self.index = SectionIndex(
+            [(section.pk, section.super_section_id) for section in sections],
+            {pk: [q.pk for q in qs] for pk, qs in questions_per_section.items()},
+        )
+        self.shared = False
+
+    def __repr__(self):  # pragma: no cover
+        return '<TemplateGraph {}: {} sections, {} questions>'.format(
+            self.stamp, len(self.sections), len(self.questions))
+
+    # Lookups
+
+    def get_section(self, section_pk):
+        return self._sections_by_pk[section_pk]
+
+    def get_question(self, question_pk):
+        return self._questions_by_pk[int(question_pk)]
+
+    def get_questions(self, section):
+        "Return the questions of <section>, in order"
+        return self._questions_per_section[section.pk]
+
+    def _get_section_or_none(self, section_pk):
+        return None if section_pk is None else self._sections_by_pk[section_pk]
+
+    def _get_question_or_none(self, question_pk):
+        return None if question_pk is None else self._questions_by_pk[question_pk]
+
+    def get_first_question(self, section):
+        return self._get_question_or_none(self.index.first_question[section.pk])
+
+    def get_last_question(self, section):
+        return self._get_question_or_none(self.index.last_question[section.pk])
+
+    def get_next_section(self, section):
+        return self._get_section_or_none(self.index.next[section.pk])
+
+    def get_prev_section(self, section):
+        return self._get_section_or_none(self.index.prev[section.pk])
+
+    def get_topmost_section(self, section):
+        return self._sections_by_pk[self.index.topmost[section.pk]]
+
+    def get_first_question_from(self, section):
+        "Like `Section.first_question`: in <section> or the nearest section after"
+        return self.get_first_question(section) or self.get_first_question_in_next_section(section)
+
+    def get_last_question_upto(self, section):
+        "Like `Section.last_question`: in <section> or the nearest section before"
+        return self.get_last_question(section) or self.get_last_question_in_prev_section(section)
+
+    def get_following_questions(self, question):
+        "Return the questions in the same section with higher position"
+        return tuple(q for q in self._questions_per_section[question.section_id]
+                     if q.position > question.position)
+
+    def get_first_question_in_next_section(self, section):
+        next_pk = self.index.next_nonempty[section.pk]
+        return self._get_question_or_none(self.index.first_question.get(next_pk, None))
+
+    def get_last_question_in_prev_section(self, section):
+        prev_pk = self.index.prev_nonempty[section.pk]
+        return self._get_question_or_none(self.index.last_question.get(prev_pk, None))
+
+    def get_compiled_fsa(self, question):
+        "Return the compiled FSA of the node of <question>"
+        return self._fsas[question.node.fsa_id]
+
+    def get_payload(self, fsa_pk, slug):
+        "Return the question hooked up to the node <slug> of an FSA, or None"
+        return self._payloads.get((fsa_pk, slug), None)
+
+    # Navigation
+
+    def map_answers_to_nodes(self, answers):
+        """Convert question pks to node slugs, and choices to conditions
+
+        Like `Question.map_answers_to_nodes()`, without queries."""
+        data = {}
+        for question_pk, answer in answers.items():
+            try:
+                question = self.get_question(question_pk)
+            except (KeyError, ValueError):
+                # Not in this template, let the database sort it out
+                return Question.map_answers_to_nodes(answers)
+            if not question.node_id: continue
+            data[str(question.node.slug)] = question.map_choice_to_condition(answer)
+        return data
+
+    def get_next_question(self, question, answers=None, in_section=False):
+        "Like `Question.get_next_question()`, without queries"
+        return self._get_next_question(
+            self.get_question(question.pk),
+            lambda: self.map_answers_to_nodes(answers),
+            in_section,
+        )
+
+    def _get_next_question(self, question, get_data, in_section=False):
+        following_questions = self.get_following_questions(question)
+        if not following_questions:
+            return self.get_first_question_in_next_section(question.section)
+
+        if not question.node_id:
+            return following_questions[0]
+
+        node = question.node
+        if node.end and not in_section:
+            # Break out of section because fsa.end == True
+            return self.get_first_question_in_next_section(question.section)
+
+        compiled = self.get_compiled_fsa(question)
+        if not compiled.graph[node.slug]:
+            return following_questions[0]
+
+        next_slug = compiled.next_slug(node.slug, get_data())
+        if next_slug:
+            next_node = compiled.node(next_slug)
+            # Break out of section because fsa.end == True
+            if next_node.end and not in_section:
+                return self.get_first_question_in_next_section(question.section)
+            # Not at the end, get payload
+            payload = self.get_payload(next_node.fsa_id, next_slug)
+            if payload is None:
+                raise TemplateDesignError('Error in template design: next node ({}) is not hooked up to a question'.format(next_node))
+            return payload
+
+        return None
+
+    def navigation_map(self, answers):
+        """Follow <answers> from the first question of the template
+
+        The answers are converted to conditions once, and every hop is
+        answered from the snapshot. Stops where the next question depends
+        on an answer not yet given. Returns a NavigationMap."""
+        data = self.map_answers_to_nodes(answers or {})
+        get_data = lambda: data  # noqa: E731
+        questions = []
+        seen = set()
+        question = self.get_first_question_from(self.sections[0]) if self.sections else None
+        while question is not None:
+            if question.pk in seen:
+                LOG.error('Loop in template %s at question %s', self.template.pk, question.pk)
+                return NavigationMap(questions, False)
+            questions.append(question)
+            seen.add(question.pk)
+            try:
+                question = self._get_next_question(question, get_data)
+            except (FSANoDataError, KeyError, TypeError, TemplateDesignError):
+                # Unanswered, or answered with something that leads nowhere
+                return NavigationMap(questions, False)
+        return NavigationMap(questions, True)
+
+    def get_potential_next_questions_with_edge(self, question):
+        """Like `Question.get_potential_next_questions_with_edge()`,
+        without queries"""
+        following_questions = self.get_following_questions(question)
+        if not following_questions:
+            return set()
+        if not question.node_id:
+            return set([('->', following_questions[0])])
+        compiled = self.get_compiled_fsa(question)
+        edges = compiled.edges[question.node.slug]
+        if not edges:
+            return set([('=>', following_questions[0])])
+        fsa_pk = question.node.fsa_id
+        return set((condition, self.get_payload(fsa_pk, next_slug) if next_slug else None)
+                   for condition, next_slug in edges)
+
+    def get_potential_next_questions(self, question):
+        "Like `Question.get_potential_next_questions()`, without queries"
+        next_questions = self.get_potential_next_questions_with_edge(question)
+        return set(v for c, v in next_questions)
+
+    def get_section_paths(self, section):
+        """Return the SectionPaths of <section>
+
+        They are computed once per snapshot."""
+        try:
+            return self._section_paths[section.pk]
+        except KeyError:
+            pass
+        edges = {}
+        for question in self.get_questions(section):
+            next_questions = self.get_potential_next_questions_with_edge(question)
+            edges[question.pk] = tuple(sorted(
+                ((label, q.pk if q else None) for label, q in next_questions),
+                key=lambda edge: (edge[0], _sort_key(edge[1])),
+            ))
+        first_question = self.get_first_question(section)
+        first = first_question.pk if first_question else None
+        paths = SectionPaths(first, edges)
+        self._section_paths[section.pk] = paths
+        return paths
+
+    def find_all_paths(self, section):
+        "Like `Section.find_all_paths()`, without queries"
+        return [list(path) for path in self.get_section_paths(section).paths]
+
+    # Validation
+
+    def list_unknown_questions(self, plan):
+        "List out all question pks of a plan that are unknown in the template"
+        data_pks = set(int(k) for k in plan.data)
+        return data_pks.difference(self._questions_by_pk)
+
+    def find_validity_of_questions(self, section, data):
+        "Like `Section.find_validity_of_questions()`, without queries"
+        assert data, 'No data, cannot validate'
+        valids = set()
+        invalids = set()
+        for question in self.get_questions(section):
+            if self._is_valid(question, data):
+                valids.add(question.pk)
+            else:
+                invalids.add(question.pk)
+        return (valids, invalids)
+
+    def _is_valid(self, question, data):
+        try:
+            return question.validate_data(data)
+        except AttributeError:
+            return False
+
+    def _find_next_on_path(self, question, paths, data):
+        """Return (next question pk, pk of missing question, complete)
+
+        The next question is chosen by the answer the branching depends on."""
+        edges = paths.edges[question.pk]
+        targets = set(next_pk for _, next_pk in edges)
+        if not targets:
+            return None, None, True
+        if len(targets) == 1:
+            next_pk = targets.pop()
+        else:
+            compiled = self.get_compiled_fsa(question)
+            depends = compiled.depends[question.node.slug]
+            depends_question = self.get_payload(question.node.fsa_id, depends)
+            answer = None
+            if depends_question is not None:
+                answer = data.get(str(depends_question.pk), None)
+            if answer is None:
+                missing = depends_question.pk if depends_question else question.pk
+                return None, missing, False
+            condition = depends_question.map_choice_to_condition(answer)
+            try:
+                next_slug = compiled.transitions[question.node.slug][condition]
+            except (KeyError, TypeError):
+                # The answer selects no branch
+                return None, question.pk, False
+            payload = self.get_payload(question.node.fsa_id, next_slug) if next_slug else None
+            next_pk = payload.pk if payload else None
+        if next_pk is None:
+            return None, None, True
+        if next_pk not in paths.adjacency:
+            # Leaves the section
+            return None, None, False
+        return next_pk, None, True
+
+    def walk_section(self, section, data):
+        """Follow the answers in <data> through <section>
+
+        Only the questions on the path selected by the answers are
+        checked, so the cost is proportional to the length of that path.
+        Returns a SectionWalk, which knows the first missing or invalid
+        question on the way."""
+        paths = self.get_section_paths(section)
+        path = []
+        seen = set()
+        pk = paths.first
+        while pk is not None:
+            if pk in seen:  # loop
+                return SectionWalk(tuple(path), None, False)
+            question = self.get_question(pk)
+            if not self._is_valid(question, data):
+                return SectionWalk(tuple(path), pk, False)
+            path.append(pk)
+            seen.add(pk)
+            pk, missing, complete = self._find_next_on_path(question, paths, data)
+            if missing is not None or not complete:
+                return SectionWalk(tuple(path), missing, complete)
+        return SectionWalk(tuple(path), None, True)
+
+    def _is_section_valid(self, section, valids):
+        """A section is valid if all of its questions are, or if the valid
+        questions are exactly the questions of a path through the section"""
+        questions = self.get_questions(section)
+        if not questions:
+            return True
+        section_valids = set(q.pk for q in questions if q.pk in valids)
+        if len(section_valids) == len(questions):
+            return True
+        return self.get_section_paths(section).is_path(section_valids)
+
+    def validate_section_data(self, section, data):
+        """Like `Section.validate_data()`, without queries
+
+        Unanswered questions are never valid, so only the path selected by
+        the answers and any answers left over from earlier choices need
+        checking, not every question nor every path."""
+        if not data:
+            return False
+        questions = self.get_questions(section)
+        if not questions:
+            return True
+        walk = self.walk_section(section, data)
+        valids = set(walk.path)
+        for question in questions:
+            if question.pk in valids or data.get(str(question.pk), None) is None:
+                continue
+            if self._is_valid(question, data):
+                valids.add(question.pk)
+        return self._is_section_valid(section, valids)
+
+    def find_validity_of_sections(self, data):
+        valid_sections = set()
+        invalid_sections = set()
+        for section in self.sections:
+            if self.validate_section_data(section, data):
+                valid_sections.add(section.pk)
+            else:
+                invalid_sections.add(section.pk)
+        return (valid_sections, invalid_sections)
+
+    def find_validity(self, data, plan_pk=None):
+        """Validate every question and section against <data>
+
+        Each question is validated once. Nothing is saved, see
+        `Plan.save_validities()` for that. Returns a ValidationReport."""
+        valid_questions = set()
+        invalid_questions = set()
+        for question in self.questions:
+            if data and self._is_valid(question, data):
+                valid_questions.add(question.pk)
+            else:
+                invalid_questions.add(question.pk)
+        valid_sections = set()
+        invalid_sections = set()
+        first_invalid = {}
+        for section in self.sections:
+            if data and self._is_section_valid(section, valid_questions):
+                valid_sections.add(section.pk)
+                continue
+            invalid_sections.add(section.pk)
+            if data:
+                first_invalid[section.pk] = self.walk_section(section, data).first_invalid
+        return ValidationReport(
+            plan_pk,
+            valid_questions=valid_questions,
+            invalid_questions=invalid_questions,
+            valid_sections=valid_sections,
+            invalid_sections=invalid_sections,
+            first_invalid=first_invalid,
+        )
+
+    def read_validity(self, plan):
+        "Build a ValidationReport from the validities stored for <plan>"
+        valid_questions = set(plan.question_validity.filter(valid=True)
+                              .values_list('question_id', flat=True))
+        valid_sections = set(plan.section_validity.filter(valid=True)
+                             .values_list('section_id', flat=True))
+        question_pks = set(self._questions_by_pk)
+        section_pks = set(self._sections_by_pk)
+        return ValidationReport(
+            plan.pk,
+            valid_questions=valid_questions & question_pks,
+            invalid_questions=question_pks - valid_questions,
+            valid_sections=valid_sections & section_pks,
+            invalid_sections=section_pks - valid_sections,
+        )
+
+    def _check_plan(self, plan):
+        "List the reasons <plan> cannot be validated at all"
+        wrong_pks = [str(pk) for pk in sorted(self.list_unknown_questions(plan))]
+        if wrong_pks:
+            error = 'The plan {} contains nonsense data: template has no questions for: {}'
+            planstr = '{} ({}), template {} ({})'.format(plan, plan.pk, self.template, self.template.pk)
+            error = error.format(planstr, ' '.join(wrong_pks))
+            LOG.error(error)
+            return [error]
+        if not plan.data:
+            error = 'The plan {} ({}) has no data: invalid'.format(plan, plan.pk)
+            LOG.error(error)
+            return [error]
+        return []
+
+    def validate_plan(self, plan, recalculate=True):
+        """Like `Template.validate_plan()`, reading the template from the snapshot
+
+        With <recalculate>, all validities are computed in memory and saved
+        in bulk, otherwise the stored validities are read. Returns a
+        ValidationReport."""
+        errors = self._check_plan(plan)
+        if errors:
+            return ValidationReport(plan.pk, errors=errors)
+        if recalculate:
+            report = self.find_validity(plan.data, plan.pk)
+            plan.save_validities(report)
+            return report
+        return self.read_validity(plan)
+
+    def revalidate_question(self, plan, question):
+        """Revalidate what a new answer to <question> can change, and save it
+
+        A question's validity only depends on its own answer, and a
+        section's validity only on the answers to its own questions, so
+        only <question> and its section are recomputed. The section is
+        checked by walking the path chosen by the answers. The validity of
+        the other sections is read as stored.
+
+        Returns a ValidationReport covering <question> and all sections."""
+        errors = self._check_plan(plan)
+        if errors:
+            return ValidationReport(plan.pk, errors=errors)
+        question = self.get_question(question.pk)
+        section = question.section
+        data = plan.data
+        question_valid = self._is_valid(question, data)
+        section_valid = self.validate_section_data(section, data)
+        first_invalid = {}
+        if not section_valid:
+            first_invalid[section.pk] = self.walk_section(section, data).first_invalid
+        changed = ValidationReport(
+            plan.pk,
+            valid_questions=[question.pk] if question_valid else (),
+            invalid_questions=() if question_valid else [question.pk],
+            valid_sections=[section.pk] if section_valid else (),
+            invalid_sections=() if section_valid else [section.pk],
+        )
+        plan.save_validities(changed)
+        section_pks = set(self._sections_by_pk)
+        valid_sections = set(plan.section_validity.filter(valid=True)
+                             .values_list('section_id', flat=True))
+        valid_sections &= section_pks
+        return ValidationReport(
+            plan.pk,
+            valid_questions=changed.valid_questions,
+            invalid_questions=changed.invalid_questions,
+            valid_sections=valid_sections,
+            invalid_sections=section_pks - valid_sections,
+            first_invalid=first_invalid,
+        )
+
+    # Output
+
+    def find_minimal_path(self, section, data=None):
+        "Like `Section.find_minimal_path()`, without queries"
+        questions = self.get_questions(section)
+        if not data:
+            return [q for q in questions if q.obligatory]
+        answered_pks = set(int(pk) for pk in data.keys())
+        return [q for q in questions if q.obligatory or q.pk in answered_pks]
+
+    def prefetch_eestore_entries(self, questions, data):
+        """Look up the EEStore entries answered to <questions> in one query
+
+        Returns a mapping from question pk to a copy of the question that
+        knows its entries, for each EEStore-backed question with an
+        answer. The questions of the snapshot are left alone."""
+        pids_per_question = {}
+        for question in questions:
+            if not isinstance(question, EEStoreMixin) or not question.eestore:
+                continue
+            answer = data.get(str(question.pk), None)
+            if not answer:
+                continue
+            pids = question.get_entry_pids(answer.get('choice', None))
+            if pids:
+                pids_per_question[question] = pids
+        if not pids_per_question:
+            return {}
+        all_pids = set()
+        for pids in pids_per_question.values():
+            all_pids.update(pids)
+        entries = EEStoreCache.objects.filter(eestore_pid__in=all_pids)
+        entries = {entry.eestore_pid: entry for entry in entries}
+        prefetched = {}
+        for question, pids in pids_per_question.items():
+            question = copy(question)
+            question._prefetched_entries = {pid: entries[pid] for pid in pids if pid in entries}
+            prefetched[question.pk] = question
+        return prefetched
+
+    def get_summary(self, data, valid_section_ids=()):
+        """Like `Template.get_summary()`, reading the template from the snapshot
+
+        All EEStore entries are looked up in a single query."""
+        summary = OrderedDict()
+        data = deepcopy(data)  # 1/2 Make absolutely sure we're working on a copy
+        valid_section_ids = set(valid_section_ids)
+        minimal_paths = OrderedDict(
+            (section, self.find_minimal_path(section, data)) for section in self.sections
+        )
+        eestore_questions = self.prefetch_eestore_entries(
+            (q for path in minimal_paths.values() for q in path), data)
+        for section, minimal_path in minimal_paths.items():
+            section_summary = OrderedDict()
+            for question in minimal_path:
+                question = eestore_questions.get(question.pk, question)
+                value = {}
+                answer = data.get(str(question.pk), None)
+                if not answer or answer.get('choice', None) is None:
+                    value['answer'] = None
+                else:
+                    value['answer'] = self.render_answer_html(question, answer)
+                # 2/2 Otherwise this might edit the actual plan data in memory!
+                # Mutable types strike back..
+                value['question'] = question
+                section_summary[question.pk] = value
+            summary[section.full_title()] = {
+                'data': section_summary,
+                'section': {
+                    'valid': True if section.id in valid_section_ids else False,
+                    'depth': section.section_depth,
+                    'label': section.label,
+                    'title': section.title,
+                    'section': section,
+                    'full_title': section.full_title(),
+                    'pk': section.pk,
+                    'first_question': self.get_first_question(section),
+                    'introductory_text': mark_safe(section.introductory_text),
+                    'comment': mark_safe(section.comment),
+                }
+            }
+        return summary
+
+    def _memoize(self, kind, question, answer, render):
+        # Only shared snapshots have reliable stamps
+        if not self.shared or isinstance(question, EEStoreMixin):
+            return render()
+        return memoize_rendered(kind, question, self.stamp, answer, render)
+
+    def render_answer_html(self, question, answer):
+        "Memoized `question.pprint_html(answer)`"
+        return self._memoize('html', question, answer,
+                             lambda: question.pprint_html(answer))
+
+    def render_canned_answer(self, question, choice):
+        "Memoized `question.get_canned_answer(choice)`"
+        return self._memoize('canned', question, choice,
+                             lambda: question.get_canned_answer(choice))
+
+    def generate_canned_text(self, data):
+        """Like `Template.generate_canned_text()`, reading the template from the snapshot
+
+        The canned texts are memoized, see `easydmp.dmpt.rendered`."""
+        texts = []
+        for section in self.sections:
+            canned_text = []
+            for question in self.get_questions(section):
+                # Like `Question.generate_canned_text()`
+                answer = deepcopy(data.get(str(question.pk), {}))
+                choice = answer.get('choice', None)
+                answer['text'] = self.render_canned_answer(question, choice) if choice else ''
+                if not isinstance(answer.get('text', ''), bool):
+                    canned_text.append(answer)
+            section_dict = model_to_dict(section, exclude=('_state', '_template_cache'))
+            section_dict['introductory_text'] = mark_safe(section_dict['introductory_text'])
+            texts.append({
+                'section': section_dict,
+                'text': canned_text,
+            })
+        return texts
+
+
+def get_template_graph(template):
+    """Return a TemplateGraph of <template>, from the cache if possible
+
+    Snapshots taken inside a transaction are not cached: if the transaction
+    is rolled back, the generation it bumped would be reused for different
+    content."""
+    stamp = template.get_stamp()
+    connection = transaction.get_connection(router.db_for_read(Template))
+    cacheable = not connection.in_atomic_block
+    if cacheable:
+        graph = _SNAPSHOTS.get(stamp)
+        if graph is not None:
+            return graph
+    graph = TemplateGraph(template.pk, stamp)
+    if cacheable:
+        graph.shared = True
+        _SNAPSHOTS.set(stamp, graph)
+    return graph
+
+
+def clear_template_graph_cache():
+    _SNAPSHOTS.clear()
@@ -1,10 +1,16 @@
-from django.contrib.admin.utils import NestedObjects
+from collections import OrderedDict
+
+from django.db import models
 from django.db import router
 from django.db import transaction
+from django.db.models.functions import Coalesce
+from django.dispatch import Signal
 from django.template import engines
 from django.utils.encoding import force_text
 from django.utils.html import format_html, escape
 
+from easydmp.utils.deletion import BulkCollector
+
 
 DJANGO_TEMPLATE_ENGINE = engines['django']
 
@@ -14,9 +20,19 @@ __all__ = (
     'print_url',
     'DeletionMixin',
     'RenumberMixin',
+    'POSITION_STEP',
+    'positions_changed',
+    'with_ordinals',
 )
 
 
+# Distance between consecutive positions after renumbering
+POSITION_STEP = 1024
+
+# Sent with the pks of the objects whose positions were changed in bulk
+positions_changed = Signal(providing_args=['pks'])
+
+
 def render_from_string(template_string, context=None):
     if context is None:
         context = {}
@@ -37,50 +53,199 @@ def print_url(urldict):
 
 
 class DeletionMixin:
-    """Extend django's model deletion functionality"""
-
-    def collect(self, **kwargs):
-        """Collect objects related to self
-
-        Designed to be extended. Get the collector for self with super()::
+    """Delete an object and everything depending on it, set by set
 
-            collector = super().collect(**kwargs)
+    Instead of loading every related object, the pks of everything to
+    delete are found with a query per relation and deleted in bulk, see
+    `easydmp.utils.deletion`. No delete signals are sent, receivers of
+    `easydmp.utils.deletion.pre_bulk_delete` are called instead.
+    """
 
-        Add a queryset with::
+    def get_cascades(self):
+        """Return querysets of objects to delete along with self
 
-            collector.collect(queryset)
+        For objects not reached by following ``on_delete=CASCADE``. Designed
+        to be extended::
 
-        Add an instance with::
-
-            collector.collect([instance])
-
-        Finally, return the collector.
+            cascades = super().get_cascades()
+            cascades.append(queryset)
+            return cascades
         """
-        using = getattr(kwargs, 'using', router.db_for_write(self.__class__, instance=self))
+        return []
+
+    def collect(self, using=None):
+        "Return a BulkCollector with everything to delete along with self"
         assert self._get_pk_val() is not None, (
             "%s object can't be deleted because its %s attribute is set to None." %
             (self._meta.object_name, self._meta.pk.attname)
         )
-
-        collector = NestedObjects(using=using)
-        collector.collect([self], **kwargs)
+        using = using or router.db_for_write(self.__class__, instance=self)
+        collector = BulkCollector(using=using)
+        collector.add(self.__class__._base_manager.filter(pk=self.pk))
+        for queryset in self.get_cascades():
+            collector.add(queryset)
         return collector
 
+    def count_deletions(self, using=None):
+        """Count what deleting self would delete, without deleting anything
+
+        Returns an OrderedDict of verbose_name_plural -> count."""
+        counts = self.collect(using=using).counts()
+        return OrderedDict(
+            (model._meta.verbose_name_plural, count)
+            for model, count in counts.items()
+        )
+
     @transaction.atomic
-    def delete(self, **kwargs):
-        collector = self.collect(**kwargs)
+    def delete(self, using=None):
+        collector = self.collect(using=using)
         return collector.delete()
     delete.alters_data = True
 
 
 class RenumberMixin:
+    """Keep positions sparse, so that moving an object touches a single row
+
+    Positions are spaced ``POSITION_STEP`` apart. An object is moved by
+    giving it the position halfway between its new neighbours, only when
+    there is no room left are all its siblings renumbered, in bulk.
+
+    ``position_parent`` is the name of the foreign key that positions are
+    unique within, on models that have a position themselves. New objects
+    without a position are put last.
+
+    Positions are only meaningful relative to each other, for display use
+    `get_ordinal()`.
+
+    Bulk updates send no signals, `positions_changed` is sent instead.
+    """
+    position_parent = None
+
+    def save(self, *args, **kwargs):
+        if self.position_parent and self.position is None:
+            self.position = self.get_next_position()
+        super().save(*args, **kwargs)
+
+    def get_next_position(self):
+        "Return the position after the last sibling"
+        last = self.get_siblings().aggregate(last=models.Max('position'))['last']
+        return (last or 0) + POSITION_STEP
+
+    def get_ordinal(self):
+        """Return the place of self among its siblings, counting from 1
+
+        Uses the ``ordinal`` set by `with_ordinals()` if there, otherwise
+        costs a query."""
+        ordinal = getattr(self, 'ordinal', None)
+        if ordinal is None:
+            ordinal = self.get_siblings().filter(position__lt=self.position).count() + 1
+        return ordinal
 
     def _renumber_positions(self, objects):
-        """Renumber positions so that eg. (1, 2, 7, 12) becomes (1, 2, 3, 4)
+        """Renumber positions so that eg. (1, 2, 7, 12) becomes (1024, 2048, 3072, 4096)
+
+        <objects> must already be sorted by position, and be all the objects
+        sharing a parent.
 
-        <objects> must already be sorted by position.
+        The new positions are set with a single bulk update. Should a new
+        position be in use by another of the objects, all the changed ones
+        are first moved past both the old and new positions, with one more
+        update, so that positions are unique throughout.
         """
+        objects = list(objects)
+        changed = {}
         for i, obj in enumerate(objects, 1):
-            obj.position = i
-            obj.save()
+            if obj.position != i * POSITION_STEP:
+                changed[obj.pk] = i * POSITION_STEP
+        if not changed:
+            return
+        model = type(objects[0])
+        rows = model._base_manager.filter(pk__in=changed)
+        old_positions = {obj.position for obj in objects}
+        if old_positions & set(changed.values()):
+            offset = max(p or 0 for p in old_positions | set(changed.values())) + 1
+            rows.update(position=models.F('position') + offset)
+        whens = [models.When(pk=pk, then=models.Value(position))
+                 for pk, position in changed.items()]
+        rows.update(position=models.Case(*whens, output_field=models.IntegerField()))
+        for obj in objects:
+            obj.position = changed.get(obj.pk, obj.position)
+        positions_changed.send(sender=model._meta.concrete_model, pks=frozenset(changed))
     _renumber_positions.alters_data = True
+
+    def get_siblings(self):
+        "Return the objects sharing a parent with self, self included"
+        parent = self._meta.get_field(self.position_parent)
+        return type(self)._base_manager.filter(
+            **{parent.attname: getattr(self, parent.attname)}
+        ).order_by('position')
+
+    def _set_position(self, position):
+        type(self)._base_manager.filter(pk=self.pk).update(position=position)
+        self.position = position
+        positions_changed.send(sender=self._meta.concrete_model, pks=frozenset([self.pk]))
+
+    @transaction.atomic
+    def move_after(self, other=None):
+        """Move self to just after <other>, or first if <other> is None
+
+        Usually only updates self."""
+        siblings = self.get_siblings()
+        for _ in range(2):
+            lower = 0
+            if other is not None:
+                lower = siblings.filter(pk=other.pk).values_list('position', flat=True).get()
+            upper = (siblings.exclude(pk=self.pk).filter(position__gt=lower)
+                     .values_list('position', flat=True).first())
+            if upper is None:
+                upper = lower + 2 * POSITION_STEP
+            if upper - lower > 1:
+                break
+            # No room left, make some
+            self._renumber_positions(siblings)
+        self._set_position((lower + upper) // 2)
+    move_after.alters_data = True
+
+    def _get_current_position(self):
+        # Siblings may have been renumbered since self was loaded
+        self.position = (type(self)._base_manager.filter(pk=self.pk)
+                         .values_list('position', flat=True).get())
+        return self.position
+
+    def move_up(self):
+        "Swap places with the previous sibling"
+        position = self._get_current_position()
+        before = list(self.get_siblings().filter(position__lt=position).reverse()[:2])
+        if not before:
+            return
+        self.move_after(before[1] if len(before) > 1 else None)
+    move_up.alters_data = True
+
+    def move_down(self):
+        "Swap places with the next sibling"
+        position = self._get_current_position()
+        following = self.get_siblings().filter(position__gt=position).first()
+        if following is not None:
+            self.move_after(following)
+    move_down.alters_data = True
+
+
+def with_ordinals(queryset):
+    """Annotate each object of <queryset> with its ``ordinal``
+
+    That is its place among its siblings, counting from 1, as returned by
+    `RenumberMixin.get_ordinal()`."""
+    model = queryset.model
+    parent = model._meta.get_field(model.position_parent).attname
+    earlier = (
+        model._base_manager
+        .filter(**{parent: models.OuterRef(parent),
+                   'position__lt': models.OuterRef('position')})
+        .order_by()
+        .values(parent)
+        .annotate(count=models.Count('pk'))
+        .values('count')
+    )
+    ordinal = Coalesce(
+        models.Subquery(earlier, output_field=models.IntegerField()), 0) + 1
+    return queryset.annotate(ordinal=ordinal)
@@ -1,11 +1,11 @@
-from functools import lru_cache
-
 from django.conf import settings
 from django.db import models
 from django.db import transaction
 
 from jsonfield import JSONField
 
+from flow.modelmixins import CachedLabelMixin
+
 from .client import EEStoreServer, EEStoreRepo
 
 # With postgres 9.4+, use this instead
@@ -14,19 +14,18 @@ from .client import EEStoreServer, EEStoreRepo
 EESTORE_API_ROOT = 'https://eestore.paas2.uninett.no/api'
 
 
-class EEStoreType(models.Model):
+class EEStoreType(CachedLabelMixin, models.Model):
     name = models.CharField(max_length=64, primary_key=True)
 
     class Meta:
         db_table = 'easydmp_eestore_type'
         verbose_name = 'EEStore type'
 
-    @lru_cache(maxsize=64)
-    def __str__(self):
+    def get_label(self):
         return self.name
 
 
-class EEStoreSource(models.Model):
+class EEStoreSource(CachedLabelMixin, models.Model):
     eestore_type = models.ForeignKey(
         EEStoreType,
         related_name='sources',
@@ -38,8 +37,7 @@ class EEStoreSource(models.Model):
         db_table = 'easydmp_eestore_source'
         verbose_name = 'EEStore source'
 
-    @lru_cache(maxsize=4096)
-    def __str__(self):
+    def get_label(self):
         return '{}:{}'.format(self.eestore_type.name, self.name)
 
 
@@ -104,7 +102,7 @@ class EEStoreCacheManager(models.Manager):
                 self.fill_one(entry)
 
 
-class EEStoreCache(models.Model):
+class EEStoreCache(CachedLabelMixin, models.Model):
     eestore_pid = models.CharField(unique=True, max_length=255)
     eestore_id = models.IntegerField()
     eestore_type = models.ForeignKey(
@@ -132,12 +130,11 @@ class EEStoreCache(models.Model):
         db_table = 'easydmp_eestore_cache'
         verbose_name = 'EEStore cache'
 
-    @lru_cache(None)
-    def __str__(self):
+    def get_label(self):
         return '{}: {}'.format(self.source, self.name)
 
 
-class EEStoreMount(models.Model):
+class EEStoreMount(CachedLabelMixin, models.Model):
     """Configure a question to fetch its choices from an eestore
 
     If no <sources> are given, all sources are used.
@@ -176,6 +173,5 @@ class EEStoreMount(models.Model):
         by_type = EEStoreCache.objects.filter(eestore_type=self.eestore_type)
         return by_type
 
-    @lru_cache(maxsize=4096)
-    def __str__(self):
+    def get_label(self):
         return '{}: {}'.format(self.eestore_type, self.question)
@@ -1,5 +1,7 @@
 from django.contrib import admin
 
+from easydmp.utils.admin import CountedDeleteAdminMixin
+
 from .models import Plan, PlanComment
 from .models import PlanAccess
 
@@ -31,7 +33,7 @@ class PublishedFilter(FakeBooleanFilter):
 
 
 @admin.register(Plan)
-class PlanAdmin(admin.ModelAdmin):
+class PlanAdmin(CountedDeleteAdminMixin, admin.ModelAdmin):
     list_display = ['title', 'template', 'added_by', 'added']
     list_filter = ['template', LockedFilter, PublishedFilter]
     search_fields = ['title', 'abbreviation', 'added_by__email', 'added_by__username',]
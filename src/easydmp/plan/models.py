@@ -17,8 +17,10 @@ from jsonfield import JSONField
 from flow.modelmixins import ClonableModel
 
 from easydmp.dmpt.forms import make_form
+from easydmp.dmpt.models import Question
 from easydmp.dmpt.utils import DeletionMixin
 
+from .summary import get_plan_summary
 from .utils import purge_answer
 from .utils import get_editors_for_plan
 
@@ -70,16 +72,8 @@ class Answer():
             self.plan.modified_by = saved_by
             self.plan.previous_data[self.question_id] = self.current_choice
             self.plan.data[self.question_id] = choice
+            # Revalidates the question and its section
             self.plan.save(question=self.question)
-            LOG.debug('q%s/p%s: setting question valid',
-                      self.question_id, self.plan.pk)
-            self.question_validity.valid = True
-            self.question_validity.save()
-            if not self.section_validity.valid and self.section.validate_data(self.plan.data):
-                LOG.debug('q%s/p%s: setting section valid',
-                          self.question_id, self.plan.pk)
-                self.section_validity.valid = True
-                self.section_validity.save()
 
     def set_invalid(self):
         if self.question_validity.valid:
@@ -219,6 +213,12 @@ class Plan(DeletionMixin, ClonableModel):
     def get_first_question(self):
         return self.template.first_question
 
+    def navigation_map(self):
+        """Return the questions the answers lead through, in order
+
+        See `easydmp.dmpt.snapshot.NavigationMap`."""
+        return self.template.snapshot().navigation_map(self.data)
+
     def get_viewers(self):
         User = get_user_model()
         pas = self.accesses.exclude(may_edit=True)
@@ -244,22 +244,25 @@ class Plan(DeletionMixin, ClonableModel):
 
     def create_section_validities(self):
         svs = []
-        for section in self.sections.all():
-            svs.append(SectionValidity(plan=self, section=section, valid=False))
+        for section_pk in self.template.sections.values_list('pk', flat=True):
+            svs.append(SectionValidity(plan=self, section_id=section_pk, valid=False))
         SectionValidity.objects.bulk_create(svs)
 
-    def set_sections_as_valid(self, *sections):
+    def set_sections_as_valid(self, *section_pks):
         qs = SectionValidity.objects.filter(plan=self, section_id__in=section_pks)
         qs.update(valid=True)
 
-    def set_sections_as_invalid(self, *sections):
+    def set_sections_as_invalid(self, *section_pks):
         qs = SectionValidity.objects.filter(plan=self, section_id__in=section_pks)
         qs.update(valid=False)
 
     def create_question_validities(self):
         qvs = []
-        for question in self.questions.all():
-            qvs.append(QuestionValidity(plan=self, question=question, valid=False))
+        question_pks = (Question.objects
+                        .filter(section__template_id=self.template_id)
+                        .values_list('pk', flat=True))
+        for question_pk in question_pks:
+            qvs.append(QuestionValidity(plan=self, question_id=question_pk, valid=False))
         QuestionValidity.objects.bulk_create(qvs)
 
     def set_questions_as_valid(self, *question_pks):
@@ -270,12 +273,64 @@ class Plan(DeletionMixin, ClonableModel):
         qs = QuestionValidity.objects.filter(plan=self, question_id__in=question_pks)
         qs.update(valid=False)
 
+    def _save_validities(self, model, fieldname, valids, invalids, timestamp):
+        """Store the validities of <model> in at most three statements
+
+        Existing rows are updated in one go, missing rows inserted in bulk."""
+        pks = valids | invalids
+        if not pks:
+            return
+        lookup = fieldname + '__in'
+        qs = model.objects.filter(plan=self, **{lookup: pks})
+        existing = set(qs.values_list(fieldname, flat=True))
+        if existing:
+            if not invalids:
+                valid = True
+            elif not valids:
+                valid = False
+            else:
+                valid = models.Case(
+                    models.When(**{lookup: valids, 'then': models.Value(True)}),
+                    default=models.Value(False),
+                    output_field=models.BooleanField(),
+                )
+            qs.update(valid=valid, last_validated=timestamp)
+        missing = [
+            model(plan=self, valid=pk in valids, last_validated=timestamp, **{fieldname: pk})
+            for pk in sorted(pks - existing)
+        ]
+        if missing:
+            model.objects.bulk_create(missing)
+
+    def save_validities(self, report):
+        "Store the question and section validities of a ValidationReport"
+        timestamp = tznow()
+        self._save_validities(QuestionValidity, 'question_id',
+                              report.valid_questions, report.invalid_questions,
+                              timestamp)
+        self._save_validities(SectionValidity, 'section_id',
+                              report.valid_sections, report.invalid_sections,
+                              timestamp)
+
     def validate(self, recalculate=False, commit=True):
-        valid = self.template.validate_plan(self, recalculate)
-        self.valid = valid
+        report = self.template.validate_plan(self, recalculate)
+        self.valid = report.valid
+        self.last_validated = tznow()
+        if commit:
+            self.save()
+        return report
+
+    def revalidate(self, question, commit=True):
+        """Revalidate after a new answer to <question>
+
+        Only the question and its section are recomputed, see
+        `TemplateGraph.revalidate_question()`."""
+        report = self.template.snapshot().revalidate_question(self, question)
+        self.valid = report.valid
         self.last_validated = tznow()
         if commit:
             self.save()
+        return report
 
     def copy_validations_from(self, oldplan):
         for sv in oldplan.section_validity.all():
@@ -304,7 +359,10 @@ class Plan(DeletionMixin, ClonableModel):
                 if topmost:
                     self.visited_sections.add(topmost)
                 # set validated
-                self.validate(recalculate, commit=False)
+                if recalculate:
+                    self.validate(recalculate, commit=False)
+                else:
+                    self.revalidate(question, commit=False)
             super().save(**kwargs)
             LOG.info('Updated plan "%s" (%i)', self, self.pk)
 
@@ -374,8 +432,12 @@ class Plan(DeletionMixin, ClonableModel):
             self.save()
 
     def get_summary(self, data=None):
+        """Summarize <data>, or the plan's own data
+
+        The summary of the plan's own data is cached, see
+        `easydmp.plan.summary`: do not change it."""
         if not data:
-            data = self.data.copy()
+            return get_plan_summary(self)
         valid_sections = (SectionValidity.objects
                   .filter(valid=True, plan=self)
         )
@@ -392,7 +454,7 @@ class Plan(DeletionMixin, ClonableModel):
         data = self.data.copy()
         return {
             'data': data,
-            'output': self.get_summary(data),
+            'output': self.get_summary(),
             'text': self.get_canned_text(data),
             'plan': self,
             'template': self.template,
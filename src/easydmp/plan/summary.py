@@ -0,0 +1,55 @@
+"""
+Cached summaries of plans
+
+Building the summary of a plan renders every answer, which is wasted work
+when the plan has not changed since the last time it was shown. Summaries
+are cached per process, keyed on the plan, when it was last modified, the
+stamp of its template (see `Template.get_stamp()`) and which of its
+sections are valid.
+
+Cached summaries are shared between requests: do not change them.
+"""
+
+from django.conf import settings
+from django.db import router
+from django.db import transaction
+
+from flow.cache import LRUCache
+
+
+__all__ = [
+    'get_plan_summary',
+]
+
+
+DEFAULT_SUMMARY_CACHE_SIZE = 64
+
+_SUMMARIES = LRUCache(
+    getattr(settings, 'EASYDMP_PLAN_SUMMARY_CACHE_SIZE', DEFAULT_SUMMARY_CACHE_SIZE)
+)
+
+
+def get_plan_summary(plan):
+    """Return the summary of the data of <plan>, from the cache if possible
+
+    Summaries made inside a transaction are not cached, as the template's
+    stamp might be reused if the transaction is rolled back."""
+    valid_ids = frozenset(
+        plan.section_validity.filter(valid=True).values_list('section_id', flat=True)
+    )
+    template = plan.template
+    key = (plan.pk, plan.modified, template.get_stamp(), valid_ids)
+    connection = transaction.get_connection(router.db_for_read(plan.__class__))
+    cacheable = not connection.in_atomic_block
+    if cacheable:
+        summary = _SUMMARIES.get(key)
+        if summary is not None:
+            return summary
+    summary = template.get_summary(plan.data, valid_ids)
+    if cacheable:
+        _SUMMARIES.set(key, summary)
+    return summary
+
+
+def clear_plan_summary_cache():
+    _SUMMARIES.clear()
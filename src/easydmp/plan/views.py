@@ -49,15 +49,29 @@ def progress(so_far, all):
     return so_far/float(all)*100
 
 
-def has_prevquestion(question, data):
-     return bool(question.get_prev_question(data))
+def get_prevquestion(question, data, navigation_map=None):
+    """Return the question to go back to from <question>, or None
+
+    Within a section this is the previous question on the path of the
+    answers. From the first question of a section it is the last question
+    of the previous section.
+    """
+    if (navigation_map is not None and question in navigation_map
+            and not navigation_map.is_section_start(question)):
+        return navigation_map.get_prev(question)
+    return question.get_prev_question(data)
+
+
+def has_prevquestion(question, data, navigation_map=None):
+    return bool(get_prevquestion(question, data, navigation_map))
 
 
 def get_section_progress(plan, current_section=None):
-    sections = plan.template.sections.filter(section_depth=1).order_by('position')
-    visited_sections = plan.visited_sections.all()
+    graph = plan.template.snapshot()
+    sections = [section for section in graph.sections if section.section_depth == 1]
+    visited_sections = set(plan.visited_sections.values_list('pk', flat=True))
     section_struct = []
-    current_section = current_section.get_topmost_section()
+    current_section = graph.get_topmost_section(current_section)
     for section in sections:
         section_dict = {
             'label': section.label,
@@ -66,7 +80,7 @@ def get_section_progress(plan, current_section=None):
             'pk': section.pk,
             'status': 'new',
         }
-        if section in visited_sections:
+        if section.pk in visited_sections:
             section_dict['status'] = 'visited'
         if section == current_section:
             section_dict['status'] = 'active'
@@ -463,6 +477,7 @@ class UpdateLinearSectionView(PlanAccessViewMixin, DetailView):
             self.section.questions
             .filter(obligatory=True)
             .order_by('position')
+            .typed()
         )
         if self.section.questions.count() != self.questions.count():
             # Not a linear section
@@ -639,18 +654,29 @@ class NewQuestionView(AbstractQuestionMixin, UpdateView):
             initial = previous_data.get(self.question_pk, {})
         return initial
 
+    def get_navigation_map(self):
+        if getattr(self, '_navigation_map', None) is None:
+            self._navigation_map = self.object.navigation_map()
+        return self._navigation_map
+
     def get_success_url(self):
         question = self.question
         current_data = self.object.data
         kwargs = {'plan': self.object.pk}
+        # The plan has just been saved, so map it anew
+        self._navigation_map = None
+        navigation_map = self.get_navigation_map()
 
         if 'summary' in self.request.POST:
             return reverse('plan_detail', kwargs=kwargs)
         elif 'prev' in self.request.POST:
-            prev_question = question.get_prev_question(self.object.data)
+            prev_question = get_prevquestion(question, self.object.data, navigation_map)
             kwargs['question'] = prev_question.pk
         elif 'next' in self.request.POST:
-            next_question = question.get_next_question(current_data)
+            try:
+                next_question = navigation_map.get_next(question)
+            except KeyError:
+                next_question = self.template.snapshot().get_next_question(question, current_data)
             if not next_question:
                 # Finished answering all questions
                 return reverse('plan_detail', kwargs=kwargs)
@@ -675,11 +701,15 @@ class NewQuestionView(AbstractQuestionMixin, UpdateView):
         kwargs['answers'] = question.canned_answers.order().values()
         kwargs['framing_text'] = question.framing_text
         kwargs['section'] = section
-        neighboring_questions = Question.objects.filter(section=section)
+        neighboring_questions = template.snapshot().get_questions(section)
         kwargs['questions_in_section'] = neighboring_questions
-        num_questions = neighboring_questions.count()
-        num_questions_so_far = len(question.get_all_preceding_questions())
+        num_questions = len(neighboring_questions)
+        num_questions_so_far = len([q for q in neighboring_questions
+                                    if q.position < question.position])
         kwargs['progress'] = progress(num_questions_so_far, num_questions)
+        # Positions have gaps, so count
+        kwargs['question_number'] = num_questions_so_far + 1
+        kwargs['num_questions'] = num_questions
         kwargs['referrer'] = self.referer  # Not a typo! From the http header
         kwargs['section_progress'] = get_section_progress(self.object, section)
         return super().get_context_data(**kwargs)
@@ -695,7 +725,8 @@ class NewQuestionView(AbstractQuestionMixin, UpdateView):
         form_kwargs = self.get_form_kwargs()
         question = self.question
         generate_kwargs = {
-            'has_prevquestion': has_prevquestion(question, self.object.data),
+            'has_prevquestion': has_prevquestion(question, self.object.data,
+                                                 self.get_navigation_map()),
         }
         generate_kwargs.update(form_kwargs)
         form = make_form(question, **generate_kwargs)
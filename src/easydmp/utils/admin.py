@@ -1,4 +1,13 @@
+from collections import OrderedDict
+
 from django.contrib import admin
+from django.contrib.admin.options import IS_POPUP_VAR, TO_FIELD_VAR
+from django.contrib.admin.utils import unquote
+from django.contrib.auth import get_permission_codename
+from django.db import models
+from django.utils.encoding import force_text
+from django.utils.text import capfirst
+from django.utils.translation import ugettext as _
 
 from guardian.admin import GuardedModelAdminMixin
 from guardian.shortcuts import assign_perm
@@ -56,3 +65,74 @@ class ObjectPermissionModelAdmin(GuardedModelAdminMixin, admin.ModelAdmin):
         qs = perm_qs | limit_qs
 
         return qs.distinct()
+
+
+class CountedDeleteAdminMixin:
+    """Confirm deletions with counts instead of listing every object
+
+    For models with `easydmp.dmpt.utils.DeletionMixin`. The confirmation
+    page shows how many objects of each kind will be deleted, as counted by
+    ``obj.count_deletions()`` without loading any of them. This also covers
+    what is deleted along with the object without a cascading foreign key.
+
+    Only showing the confirmation page is replaced. Missing objects, lacking
+    permissions, popups and the deletion itself are left to Django, and
+    deletion goes through ``obj.delete()`` as usual.
+    """
+
+    def delete_view(self, request, object_id, extra_context=None):
+        if request.method == 'POST' or TO_FIELD_VAR in request.GET:
+            return super().delete_view(request, object_id, extra_context)
+        obj = self.get_object(request, unquote(object_id))
+        if obj is None or not self.has_delete_permission(request, obj):
+            return super().delete_view(request, object_id, extra_context)
+        return self._counted_delete_confirmation(request, obj, extra_context)
+
+    def get_deletion_summary(self, request, obj):
+        """Return model_count, perms_needed and protected for <obj>
+
+        Like `django.contrib.admin.utils.get_deleted_objects()`, but
+        counting instead of listing the objects."""
+        try:
+            model_count = obj.count_deletions()
+        except models.ProtectedError as e:
+            protected = [
+                '{}: {}'.format(capfirst(o._meta.verbose_name), o)
+                for o in e.protected_objects
+            ]
+            return OrderedDict(), set(), protected
+        perms_needed = set()
+        for model in self.admin_site._registry:
+            opts = model._meta
+            if opts.verbose_name_plural not in model_count:
+                continue
+            perm = '{}.{}'.format(opts.app_label, get_permission_codename('delete', opts))
+            if not request.user.has_perm(perm):
+                perms_needed.add(opts.verbose_name)
+        return model_count, perms_needed, []
+
+    def _counted_delete_confirmation(self, request, obj, extra_context):
+        opts = self.model._meta
+        model_count, perms_needed, protected = self.get_deletion_summary(request, obj)
+        object_name = force_text(opts.verbose_name)
+        if perms_needed or protected:
+            title = _("Cannot delete %(name)s") % {"name": object_name}
+        else:
+            title = _("Are you sure?")
+        context = dict(
+            self.admin_site.each_context(request),
+            title=title,
+            object_name=object_name,
+            object=obj,
+            deleted_objects=[],
+            model_count=model_count.items(),
+            perms_lacking=perms_needed,
+            protected=protected,
+            opts=opts,
+            app_label=opts.app_label,
+            preserved_filters=self.get_preserved_filters(request),
+            is_popup=IS_POPUP_VAR in request.GET,
+            to_field=None,
+        )
+        context.update(extra_context or {})
+        return self.render_delete_form(request, context)
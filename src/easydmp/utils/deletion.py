@@ -0,0 +1,161 @@
+"""
+Delete objects and everything that cascades from them, set by set
+
+Django's own collector loads every object it is going to delete into
+memory as soon as any model involved has a delete signal receiver. For a
+template with thousands of questions or a plan with thousands of validity
+rows, that is a lot of objects.
+
+`BulkCollector` instead finds the affected rows as sets of pks, one query
+per relation, by nesting the query that found the parents as a subquery.
+Deletion is then done bottom-up with raw deletes in batches, and foreign
+keys with ``on_delete=SET_NULL`` or ``SET_DEFAULT`` are updated in bulk.
+
+No ``pre_delete`` or ``post_delete`` signals are sent. Instead,
+`pre_bulk_delete` is sent once per model with the set of pks about to be
+deleted, while all rows still exist.
+"""
+
+from collections import OrderedDict
+
+from django.db import connections
+from django.db import models
+from django.db import router
+from django.db.models.deletion import get_candidate_relations_to_delete
+from django.dispatch import Signal
+
+
+__all__ = [
+    'BulkCollector',
+    'pre_bulk_delete',
+]
+
+
+pre_bulk_delete = Signal(providing_args=['pks', 'using'])
+
+
+def _concrete(model):
+    return model._meta.concrete_model
+
+
+class BulkCollector:
+    """Collect the pks of objects to delete, then delete them in bulk
+
+    Add querysets to delete with `add()`. Relations pointing to the
+    collected objects are followed according to their ``on_delete``.
+    """
+
+    def __init__(self, using=None):
+        self.using = using
+        self.pks = OrderedDict()
+        self.field_updates = []
+        # model -> models that must be deleted before it
+        self.dependencies = {}
+
+    def add(self, queryset):
+        """Add the objects of <queryset>, and everything cascading from them
+
+        The queries are run at once, so that later changes to the database
+        do not change what is deleted."""
+        model = _concrete(queryset.model)
+        if self.using is None:
+            self.using = router.db_for_write(model)
+        queryset = model._base_manager.using(self.using).filter(
+            pk__in=queryset.values('pk'))
+        self._add(queryset)
+    add.alters_data = True
+
+    def _add(self, queryset, source=None):
+        model = queryset.model
+        pks = set(queryset.values_list('pk', flat=True))
+        seen = self.pks.setdefault(model, set())
+        if source is not None and source is not model:
+            self.dependencies.setdefault(source, set()).add(model)
+        if not pks - seen:
+            return
+        seen.update(pks)
+        # This includes the rows of automatic many-to-many tables
+        for related in get_candidate_relations_to_delete(model._meta):
+            self._follow(related, queryset)
+
+    def _follow(self, related, queryset):
+        field = related.field
+        on_delete = field.remote_field.on_delete
+        if on_delete is models.DO_NOTHING:
+            return
+        related_model = _concrete(related.related_model)
+        dependent = related_model._base_manager.using(self.using).filter(
+            **{'{}__in'.format(field.name): queryset.values('pk')})
+        if on_delete is models.CASCADE:
+            self._add(dependent, source=queryset.model)
+        elif on_delete is models.PROTECT:
+            if dependent.exists():
+                raise models.ProtectedError(
+                    'Cannot delete some instances of model {!r} because they '
+                    'are referenced through a protected foreign key: '
+                    '{}.{}'.format(queryset.model.__name__,
+                                   related_model.__name__, field.name),
+                    dependent,
+                )
+        elif on_delete in (models.SET_NULL, models.SET_DEFAULT):
+            # Rows that are deleted anyway must go before what they point to
+            self.dependencies.setdefault(queryset.model, set()).add(related_model)
+            value = None if on_delete is models.SET_NULL else field.get_default()
+            pks = list(dependent.values_list('pk', flat=True))
+            if pks:
+                self.field_updates.append((related_model, field.name, value, pks))
+        else:
+            raise NotImplementedError(
+                'Cannot bulk delete through {}.{}: unsupported on_delete'.format(
+                    related_model.__name__, field.name))
+
+    def counts(self):
+        "Return an OrderedDict of model -> number of objects to delete"
+        return OrderedDict((model, len(pks)) for model, pks in self.pks.items() if pks)
+
+    def _sorted_models(self):
+        "Sort the models so that each comes after the models depending on it"
+        models = [model for model, pks in self.pks.items() if pks]
+        ordered = []
+        while models:
+            for model in models:
+                waiting = self.dependencies.get(model, set()) & set(models)
+                if not waiting - {model}:
+                    break
+            else:
+                # A loop of cascades: the database must sort it out
+                model = models[0]
+            models.remove(model)
+            ordered.append(model)
+        return ordered
+
+    def _batches(self, model, pks):
+        connection = connections[self.using]
+        pks = sorted(pks)
+        size = connection.ops.bulk_batch_size(['pk'], pks) or len(pks)
+        for i in range(0, len(pks), size):
+            yield pks[i:i + size]
+
+    def delete(self):
+        """Delete everything collected, bottom-up
+
+        Returns the total number of deleted objects and a dict of model
+        label -> number of deleted objects, like `QuerySet.delete()`."""
+        ordered = self._sorted_models()
+        for model in ordered:
+            pre_bulk_delete.send(
+                sender=model, pks=frozenset(self.pks[model]), using=self.using)
+        for model, fieldname, value, pks in self.field_updates:
+            pks = set(pks) - self.pks.get(model, set())
+            for batch in self._batches(model, pks):
+                model._base_manager.using(self.using).filter(
+                    pk__in=batch).update(**{fieldname: value})
+        deleted = OrderedDict()
+        for model in ordered:
+            count = 0
+            for batch in self._batches(model, self.pks[model]):
+                queryset = model._base_manager.using(self.using).filter(pk__in=batch)
+                count += queryset._raw_delete(using=self.using)
+            deleted[model._meta.label] = count
+        return sum(deleted.values()), deleted
+    delete.alters_data = True
@@ -1,6 +1,12 @@
-from django.contrib import admin
-from django.core.exceptions import ObjectDoesNotExist
-
+from django.conf.urls import url
+from django.contrib import admin, messages
+from django.contrib.admin.utils import unquote
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.http import Http404, HttpResponse
+from django.urls import reverse
+from django.utils.html import format_html_join, format_html
+
+from .graphviz import CONTENT_TYPES
 from .models import Node
 from .models import Edge
 from .models import FSA
@@ -16,6 +22,52 @@ has_payload.short_description = 'Has Payload'
 has_payload.boolean = True
 
 
+class GraphAdminMixin:
+    """Serve a rendered graph of an object at <object_id>/graph.<format>/
+
+    The model needs a ``render_dotsource_to_bytes(format)`` method. The
+    graph is rendered in memory, or fetched from the render cache, and sent
+    directly in the response."""
+
+    graph_formats = ('svg', 'png', 'pdf')
+
+    def _get_graph_urlname(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return '%s_%s_graph' % info
+
+    def get_urls(self):
+        urls = [
+            url(
+                r'^(.+)/graph\.([a-z]+)/$',
+                self.admin_site.admin_view(self.graph_view),
+                name=self._get_graph_urlname(),
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def graph_view(self, request, object_id, format):
+        if format not in self.graph_formats:
+            raise Http404
+        obj = self.get_object(request, unquote(object_id))
+        if obj is None:
+            raise Http404
+        if not self.has_change_permission(request, obj):
+            raise PermissionDenied
+        content = obj.render_dotsource_to_bytes(format)
+        return HttpResponse(content, content_type=CONTENT_TYPES[format])
+
+    def graph(self, obj):
+        if not obj.pk:
+            return '-'
+        urlname = 'admin:' + self._get_graph_urlname()
+        return format_html_join(
+            ' ', '<a href="{}">{}</a>',
+            ((reverse(urlname, args=(obj.pk, format)), format)
+             for format in self.graph_formats),
+        )
+    graph.short_description = 'Graph'
+
+
 class PayloadListFilter(admin.SimpleListFilter):
     title = 'Payload'
     parameter_name = 'payload'
@@ -87,8 +139,25 @@ class NodeAdmin(admin.ModelAdmin):
 admin.site.register(Node, NodeAdmin)
 
 
-class FSAAdmin(admin.ModelAdmin):
+class FSAAdmin(GraphAdminMixin, admin.ModelAdmin):
     list_display = ['slug', 'id']
-    readonly_fields = ('cloned_from', 'cloned_when')
+    readonly_fields = ('cloned_from', 'cloned_when', 'graph', 'structure')
     inlines = [NodeInline]
+
+    def structure(self, obj):
+        if not obj.pk:
+            return '-'
+        problems = obj.analyze().problems()
+        if not problems:
+            return 'No problems found'
+        return format_html(
+            '<ul>{}</ul>',
+            format_html_join('', '<li>{}</li>', ((p,) for p in problems)),
+        )
+    structure.short_description = 'Structural problems'
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        for problem in form.instance.analyze().problems():
+            self.message_user(request, problem, messages.WARNING)
 admin.site.register(FSA, FSAAdmin)
@@ -0,0 +1,163 @@
+# encoding: utf-8
+"""
+Structural analysis of a `flow.compiled.CompiledFSA`
+
+Finds the kind of mistakes that otherwise only show up at runtime, as a
+traversal that takes forever or a node that cannot be left:
+
+* no start node
+* nodes that cannot be reached from the start node
+* dead ends: nodes that are not end nodes but have no way out
+* nodes with more than one edge for the same condition
+* cycles, found as the strongly connected components of the graph
+
+Everything is linear in the number of nodes and edges. The report is
+computed once per compiled FSA, so it is recomputed exactly when the FSA
+changes.
+"""
+
+from collections import Counter, deque
+
+from .paths import get_adjacency
+
+
+__all__ = [
+    'FSAReport',
+    'analyze',
+    'get_analysis',
+]
+
+
+class FSAReport:
+    """The structural problems found in one FSA
+
+    Nodes are referred to by slug. All collections are sorted so that
+    reports can be compared and printed as is."""
+
+    def __init__(self, fsa_pk, start, unreachable, dead_ends,
+                 duplicate_conditions, cycles):
+        self.fsa_pk = fsa_pk
+        self.start = start
+        self.unreachable = unreachable
+        self.dead_ends = dead_ends
+        self.duplicate_conditions = duplicate_conditions
+        self.cycles = cycles
+
+    def __repr__(self):  # pragma: no cover
+        return '<FSAReport {}: {} problems>'.format(self.fsa_pk, len(self.problems()))
+
+    @property
+    def is_ok(self):
+        return not self.problems()
+
+    def problems(self):
+        "Describe each problem in a short sentence"
+        problems = []
+        if self.start is None:
+            problems.append('There is no start node')
+        for slug in self.unreachable:
+            problems.append('Node "{}" cannot be reached from the start node'.format(slug))
+        for slug in self.dead_ends:
+            problems.append('Node "{}" is not an end node but has no next node'.format(slug))
+        for slug, conditions in self.duplicate_conditions.items():
+            problems.append('Node "{}" has more than one edge for {}'.format(
+                slug, ', '.join('"{}"'.format(c) for c in conditions)))
+        for cycle in self.cycles:
+            problems.append('There is a loop through {}'.format(
+                ', '.join('"{}"'.format(slug) for slug in cycle)))
+        return problems
+
+
+def _find_reachable(adjacency, start):
+    seen = {start}
+    queue = deque([start])
+    while queue:
+        for target in adjacency[queue.popleft()]:
+            if target is None or target in seen:
+                continue
+            seen.add(target)
+            queue.append(target)
+    return seen
+
+
+def _find_cycles(adjacency):
+    """Find the cycles of <adjacency> with Tarjan's algorithm
+
+    Returns the strongly connected components with more than one node, and
+    the nodes with an edge to themselves. Iterative, so deep graphs cannot
+    hit the recursion limit."""
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+    for root in adjacency:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(adjacency[root]))]
+        while work:
+            slug, targets = work[-1]
+            for target in targets:
+                if target is None:
+                    continue
+                if target not in index:
+                    index[target] = lowlink[target] = len(index)
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(adjacency[target])))
+                    break
+                if target in on_stack:
+                    lowlink[slug] = min(lowlink[slug], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[slug])
+                if lowlink[slug] != index[slug]:
+                    continue
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == slug:
+                        break
+                if len(component) > 1 or slug in adjacency[slug]:
+                    cycles.append(tuple(sorted(component)))
+    return tuple(sorted(cycles))
+
+
+def analyze(compiled):
+    "Analyze <compiled> and return an FSAReport"
+    adjacency = get_adjacency(compiled)
+    start = compiled.start
+    unreachable = ()
+    if start is not None:
+        reachable = _find_reachable(adjacency, start)
+        unreachable = tuple(sorted(set(adjacency) - reachable))
+    dead_ends = tuple(sorted(
+        slug for slug, targets in compiled.graph.items()
+        if not targets and slug not in compiled.ends
+    ))
+    duplicate_conditions = {}
+    for slug in sorted(compiled.edges):
+        counts = Counter(condition for condition, _ in compiled.edges[slug])
+        duplicates = sorted(c for c, count in counts.items() if count > 1)
+        if duplicates:
+            duplicate_conditions[slug] = tuple(duplicates)
+    return FSAReport(
+        fsa_pk=compiled.fsa_pk,
+        start=start,
+        unreachable=unreachable,
+        dead_ends=dead_ends,
+        duplicate_conditions=duplicate_conditions,
+        cycles=_find_cycles(adjacency),
+    )
+
+
+def get_analysis(compiled):
+    "Return the FSAReport for <compiled>, computed once per compiled FSA"
+    return compiled.derive('analysis', analyze)
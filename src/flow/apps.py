@@ -5,3 +5,6 @@ from django.apps import AppConfig
 
 class FlowConfig(AppConfig):
     name = 'flow'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+__all__ = [
+    'LRUCache',
+]
+
+
+class LRUCache:
+    """A thread safe mapping that keeps at most <maxsize> items
+
+    When full, the least recently used item is dropped to make room. Hits
+    and misses are counted, for checking that a cache is worth its memory.
+
+    Items may also be given a weight when set, for instance their length.
+    With <maxweight>, items are dropped until the total weight is at most
+    <maxweight>.
+    """
+
+    def __init__(self, maxsize=128, maxweight=None):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.hits = 0
+        self.misses = 0
+        self.weight = 0
+        self._data = OrderedDict()
+        self._weights = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _too_big(self):
+        if len(self._data) > self.maxsize:
+            return True
+        return self.maxweight is not None and self.weight > self.maxweight
+
+    def set(self, key, value, weight=0):
+        with self._lock:
+            self.weight += weight - self._weights.get(key, 0)
+            self._data[key] = value
+            self._weights[key] = weight
+            self._data.move_to_end(key)
+            while self._data and self._too_big():
+                old_key, _ = self._data.popitem(last=False)
+                self.weight -= self._weights.pop(old_key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self.weight -= self._weights.pop(key, 0)
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self.weight = 0
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,330 @@
+# encoding: utf-8
+"""
+Compiled, read-only transition tables for FSAs
+
+Walking an FSA through the ORM costs several queries per step. A
+`CompiledFSA` is built from two queries (all nodes, all edges) and after
+that answers next/prev lookups with plain dict lookups.
+
+Compiled FSAs are cached per process, keyed on the FSA and its
+generation. The generation is stored in the database and bumped whenever a
+Node, Edge or FSA belonging to it is saved or deleted, see `flow.signals`,
+so a change made by any process makes the cached tables of every process
+unreachable. Tables built inside a transaction are never cached, as they
+may contain changes that are later rolled back.
+"""
+
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.apps import apps
+from django.conf import settings
+from django.db import router
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+
+from .cache import LRUCache
+from .errors import FSANoDataError
+
+
+__all__ = [
+    'CompiledFSA',
+    'Walk',
+    'clear_compiled_fsa_cache',
+    'compile_fsa',
+    'compile_fsas',
+    'get_fsa_generations',
+    'invalidate_compiled_fsa',
+]
+
+
+# path:     the slugs of the nodes visited, in order
+# terminal: the slug of the last node visited
+# complete: True if the walk reached an end node or an edge without a
+#           next node, False if it stopped for lack of a usable answer
+Walk = namedtuple('Walk', ['path', 'terminal', 'complete'])
+
+
+DEFAULT_COMPILED_FSA_CACHE_SIZE = 256
+
+_CACHE = LRUCache(
+    getattr(settings, 'FLOW_COMPILED_FSA_CACHE_SIZE', DEFAULT_COMPILED_FSA_CACHE_SIZE)
+)
+
+
+class CompiledFSA:
+    """An immutable snapshot of the nodes and edges of one FSA
+
+    Nodes are referred to by slug throughout. ``None`` is used for the
+    missing end of an edge, exactly like in the database.
+
+    graph:       slug -> frozenset of next slugs
+    transitions: slug -> {condition: next slug}
+    edges:       slug -> ((condition, next slug), ...), all edges in pk order
+    reverse:     slug -> ((prev slug, condition), ...)
+    depends:     slug -> slug of the node whose answer decides the next node
+    """
+
+    def __init__(self, fsa_pk, db, node_rows, edge_rows):
+        Node = apps.get_model('flow', 'Node')
+        self.fsa_pk = fsa_pk
+        self.db = db
+        self._derived = {}
+        self._field_names = tuple(f.attname for f in Node._meta.concrete_fields)
+
+        values = {}
+        pks = {}
+        depends = {}
+        start = None
+        starts = set()
+        ends = set()
+        for row in node_rows:
+            node_values, depends_slug = row[:-1], row[-1]
+            node = dict(zip(self._field_names, node_values))
+            slug = node['slug']
+            values[slug] = tuple(node_values)
+            pks[slug] = node['id']
+            depends[slug] = depends_slug if depends_slug else slug
+            if node['start']:
+                starts.add(slug)
+                if start is None:
+                    start = slug
+            if node['end']:
+                ends.add(slug)
+        slugs = {pk: slug for slug, pk in pks.items()}
+
+        graph = {slug: set() for slug in pks}
+        transitions = {slug: {} for slug in pks}
+        edges = {slug: [] for slug in pks}
+        reverse = {slug: [] for slug in pks}
+        prev_nodes = {slug: set() for slug in pks}
+        for condition, prev_pk, next_pk in edge_rows:
+            # Edges leaving the FSA cannot be represented by slug, skip them
+            if prev_pk is not None and prev_pk not in slugs:
+                continue
+            if next_pk is not None and next_pk not in slugs:
+                continue
+            prev_slug = slugs.get(prev_pk)
+            next_slug = slugs.get(next_pk)
+            if prev_slug is not None:
+                graph[prev_slug].add(next_slug)
+                edges[prev_slug].append((condition, next_slug))
+                # Edges are sorted by pk, the first edge for a condition wins
+                transitions[prev_slug].setdefault(condition, next_slug)
+            if next_slug is not None:
+                reverse[next_slug].append((prev_slug, condition))
+                prev_nodes[next_slug].add(prev_slug)
+
+        self._values = MappingProxyType(values)
+        self.pks = MappingProxyType(pks)
+        self.slugs = MappingProxyType(slugs)
+        self.start = start
+        self.starts = frozenset(starts)
+        self.ends = frozenset(ends)
+        self.depends = MappingProxyType(depends)
+        self.graph = MappingProxyType(
+            {slug: frozenset(targets) for slug, targets in graph.items()}
+        )
+        self.transitions = MappingProxyType(
+            {slug: MappingProxyType(t) for slug, t in transitions.items()}
+        )
+        self.edges = MappingProxyType(
+            {slug: tuple(e) for slug, e in edges.items()}
+        )
+        self.reverse = MappingProxyType(
+            {slug: tuple(r) for slug, r in reverse.items()}
+        )
+        self.prev_nodes = MappingProxyType(
+            {slug: frozenset(p) for slug, p in prev_nodes.items()}
+        )
+
+    def __contains__(self, slug):
+        return slug in self.pks
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __repr__(self):  # pragma: no cover
+        return '<CompiledFSA {}: {} nodes>'.format(self.fsa_pk, len(self))
+
+    def derive(self, name, builder):
+        """Return ``builder(self)``, computed once per compiled FSA
+
+        For data derived from the table, like orderings and indexes. Since
+        the table never changes the result is kept for the table's lifetime."""
+        try:
+            return self._derived[name]
+        except KeyError:
+            value = builder(self)
+            self._derived[name] = value
+            return value
+
+    def node(self, slug):
+        """Return a fresh Node instance for <slug>, without a query
+
+        Returns None if <slug> is None."""
+        if slug is None:
+            return None
+        Node = apps.get_model('flow', 'Node')
+        return Node.from_db(self.db, self._field_names, self._values[slug])
+
+    def next_slug(self, slug, data):
+        "Get the slug of the next node given the node-slug -> condition <data>"
+        if not data:
+            raise FSANoDataError
+        targets = self.graph[slug]
+        if len(targets) == 1:  # simple node
+            return next(iter(targets))
+        if len(targets) > 1:  # complex node
+            condition = data[self.depends[slug]]
+            try:
+                return self.transitions[slug].get(condition, None)
+            except TypeError:  # unhashable, cannot be a condition
+                return None
+        # end node or overridden
+        return None
+
+    def prev_slug(self, slug, data):
+        "Get the slug of the previous node given the node-slug -> condition <data>"
+        if not data:
+            raise FSANoDataError
+        sources = self.prev_nodes[slug]
+        if len(sources) == 1:  # simple node
+            return next(iter(sources))
+        if len(sources) > 1:  # complex node
+            for prev_slug, condition in self.reverse[slug]:
+                if prev_slug in data and data[prev_slug] == condition:
+                    return prev_slug
+        # start node or overridden
+        return None
+
+    def walk(self, data, start=None):
+        """Follow <data> from the start node for as long as possible
+
+        <data> maps node slugs to conditions, like for `next_slug()`. The
+        walk stops at an end node, at an edge without a next node, or at a
+        node whose answer is missing or matches no edge. Returns a Walk."""
+        slug = self.start if start is None else start
+        path = []
+        visited = set()
+        while slug not in visited:
+            path.append(slug)
+            visited.add(slug)
+            if slug in self.ends:
+                return Walk(tuple(path), slug, True)
+            targets = self.graph[slug]
+            if len(targets) == 1:  # simple node
+                next_slug = next(iter(targets))
+            else:  # complex node or dead end
+                try:
+                    condition = data[self.depends[slug]]
+                    next_slug = self.transitions[slug][condition]
+                except (KeyError, TypeError):
+                    return Walk(tuple(path), slug, False)
+            if next_slug is None:
+                return Walk(tuple(path), slug, True)
+            slug = next_slug
+        # Loop
+        return Walk(tuple(path), path[-1], False)
+
+    def get_next_node(self, slug, data):
+        return self.node(self.next_slug(slug, data))
+
+    def get_prev_node(self, slug, data):
+        return self.node(self.prev_slug(slug, data))
+
+
+def _load(fsa_pks):
+    Node = apps.get_model('flow', 'Node')
+    Edge = apps.get_model('flow', 'Edge')
+    db = router.db_for_read(Node)
+    field_names = [f.attname for f in Node._meta.concrete_fields]
+    node_rows = (Node.objects.using(db)
+                 .filter(fsa_id__in=fsa_pks)
+                 .order_by('pk')
+                 .values_list(*(field_names + ['depends__slug'])))
+    fsa_index = field_names.index('fsa_id')
+    rows_per_fsa = {pk: [] for pk in fsa_pks}
+    fsa_of_node = {}
+    for row in node_rows:
+        rows_per_fsa[row[fsa_index]].append(row)
+        fsa_of_node[row[0]] = row[fsa_index]
+    edge_rows = (Edge.objects.using(db)
+                 .filter(Q(prev_node__fsa_id__in=fsa_pks) | Q(next_node__fsa_id__in=fsa_pks))
+                 .order_by('pk')
+                 .values_list('condition', 'prev_node_id', 'next_node_id'))
+    edges_per_fsa = {pk: [] for pk in fsa_pks}
+    for edge in edge_rows:
+        _, prev_pk, next_pk = edge
+        fsa_pk = fsa_of_node.get(prev_pk, fsa_of_node.get(next_pk))
+        edges_per_fsa[fsa_pk].append(edge)
+    return {
+        pk: CompiledFSA(pk, db, rows_per_fsa[pk], edges_per_fsa[pk])
+        for pk in fsa_pks
+    }
+
+
+def get_fsa_generations(fsa_pks, using=None):
+    "Return a dict of fsa pk -> generation, as stored in the database"
+    FSA = apps.get_model('flow', 'FSA')
+    db = using or router.db_for_read(FSA)
+    return dict(FSA.objects.using(db)
+                .filter(pk__in=fsa_pks)
+                .values_list('pk', 'generation'))
+
+
+def compile_fsas(fsa_pks, generations=None):
+    """Return a dict of fsa pk -> CompiledFSA
+
+    Cached tables are only used if they were built for the current
+    generation of their FSA. The generations are looked up in one query,
+    unless given as a dict of fsa pk -> generation in <generations>, for
+    instance by a caller that loaded the FSAs already. Uncached FSAs are
+    compiled together, in two queries."""
+    fsa_pks = set(fsa_pks)
+    if not fsa_pks:
+        return {}
+    db = router.db_for_read(apps.get_model('flow', 'Node'))
+    # Read before the tables are loaded, so that a change committed while
+    # loading makes the table unreachable rather than cached as current
+    if generations is None:
+        generations = get_fsa_generations(fsa_pks, using=db)
+    cacheable = not transaction.get_connection(db).in_atomic_block
+    compiled = {}
+    for pk in fsa_pks:
+        table = _CACHE.get((pk, generations.get(pk)))
+        if table is not None:
+            compiled[pk] = table
+    missing = fsa_pks - set(compiled)
+    if not missing:
+        return compiled
+    loaded = _load(missing)
+    for pk, table in loaded.items():
+        if cacheable and pk in generations:
+            _CACHE.set((pk, generations[pk]), table)
+    compiled.update(loaded)
+    return compiled
+
+
+def compile_fsa(fsa_pk):
+    "Return the CompiledFSA for the FSA with the pk <fsa_pk>"
+    return compile_fsas([fsa_pk])[fsa_pk]
+
+
+def invalidate_compiled_fsa(*fsa_pks):
+    """Make any compiled table of the given FSA pks stale, in every process
+
+    Bumps the generation of the FSAs in the database. Tables cached for
+    older generations are never looked up again, and are eventually dropped
+    from the cache."""
+    fsa_pks = set(pk for pk in fsa_pks if pk is not None)
+    if not fsa_pks:
+        return
+    FSA = apps.get_model('flow', 'FSA')
+    FSA.objects.filter(pk__in=fsa_pks).update(generation=F('generation') + 1)
+
+
+def clear_compiled_fsa_cache():
+    "Drop all compiled tables cached by this process"
+    _CACHE.clear()
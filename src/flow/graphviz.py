@@ -1,16 +1,179 @@
 # encoding: utf-8
 
+from hashlib import sha256
 from pathlib import PurePath, Path
+from threading import BoundedSemaphore, Lock
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
 
 import graphviz as gv
 
 
+# Maximum size in bytes of the rendered graphs kept per cache directory
+DEFAULT_RENDER_CACHE_SIZE = 32 * 1024 * 1024
+# Maximum number of graphviz processes running at the same time
+DEFAULT_MAX_RENDERS = 4
+
+CONTENT_TYPES = {
+    'svg': 'image/svg+xml',
+    'png': 'image/png',
+    'pdf': 'application/pdf',
+    'dot': 'text/vnd.graphviz',
+}
+
+
 def _prep_dotsource(graphviz_tmpdir):
     """Create workdir for graphviz"""
     path = Path(graphviz_tmpdir)
     path.mkdir(mode=0o750, parents=True, exist_ok=True)
 
 
+class RenderCache:
+    """Store rendered graphs on disk, keyed on a hash of source and format
+
+    The total size of the cache is bounded by <max_size> bytes. When it
+    grows larger the least recently used files are removed. A file's
+    modification time is bumped whenever it is used.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_RENDER_CACHE_SIZE):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self._lock = Lock()
+
+    @staticmethod
+    def get_key(format, dotsource):
+        blob = '{}\0{}'.format(format, dotsource).encode('utf-8')
+        return sha256(blob).hexdigest()
+
+    def get_path(self, format, dotsource):
+        key = self.get_key(format, dotsource)
+        return self.directory / '{}.{}'.format(key, format)
+
+    def get(self, format, dotsource):
+        "Return the path of the cached render, or None"
+        path = self.get_path(format, dotsource)
+        try:
+            os.utime(str(path))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get_bytes(self, format, dotsource):
+        "Return the cached render as bytes, or None"
+        path = self.get(format, dotsource)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:  # evicted since it was touched
+            return None
+
+    def put(self, format, dotsource, rendered_file):
+        "Copy <rendered_file> into the cache and return its new path"
+        return self.put_bytes(format, dotsource, Path(rendered_file).read_bytes())
+
+    def put_bytes(self, format, dotsource, content):
+        "Store the render <content> in the cache and return its path"
+        _prep_dotsource(self.directory)
+        path = self.get_path(format, dotsource)
+        # Write to a temporary name first so readers never see half a file
+        fd, tmpname = tempfile.mkstemp(dir=str(self.directory), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmpname, str(path))
+        self.evict()
+        return path
+
+    def evict(self):
+        "Remove the least recently used renders until the cache is small enough"
+        with self._lock:
+            entries = []
+            total = 0
+            for path in self.directory.iterdir():
+                if path.suffix == '.tmp':
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        if self.directory.exists():
+            shutil.rmtree(str(self.directory), ignore_errors=True)
+
+
+_RENDER_CACHES = {}
+
+
+def get_render_cache(graphviz_tmpdir):
+    "Get the render cache kept in <graphviz_tmpdir>"
+    directory = Path(graphviz_tmpdir) / 'cache'
+    try:
+        return _RENDER_CACHES[directory]
+    except KeyError:
+        max_size = getattr(settings, 'FLOW_GRAPHVIZ_CACHE_SIZE',
+                           DEFAULT_RENDER_CACHE_SIZE)
+        cache = RenderCache(directory, max_size)
+        _RENDER_CACHES[directory] = cache
+        return cache
+
+
+_RENDER_SEMAPHORE = None
+_RENDER_SEMAPHORE_LOCK = Lock()
+
+
+def get_render_semaphore():
+    "Get the semaphore limiting the number of concurrent graphviz processes"
+    global _RENDER_SEMAPHORE
+    with _RENDER_SEMAPHORE_LOCK:
+        if _RENDER_SEMAPHORE is None:
+            max_renders = getattr(settings, 'FLOW_GRAPHVIZ_MAX_RENDERS',
+                                  DEFAULT_MAX_RENDERS)
+            _RENDER_SEMAPHORE = BoundedSemaphore(max_renders)
+        return _RENDER_SEMAPHORE
+
+
+def render_dotsource_to_bytes(format, dotsource, graphviz_tmpdir=None):
+    """Render <dotsource> in memory and return the result as bytes
+
+    The source is piped through graphviz. At most FLOW_GRAPHVIZ_MAX_RENDERS
+    graphviz processes run at the same time, further renders wait their
+    turn.
+
+    With <graphviz_tmpdir>, renders are cached there on the hash of the
+    format and the dotsource, and graphviz is only run once per distinct
+    graph.
+
+    format: a format supported by graphviz
+    dotsource: the graph to render"""
+    cache = get_render_cache(graphviz_tmpdir) if graphviz_tmpdir else None
+    if cache is not None:
+        content = cache.get_bytes(format, dotsource)
+        if content is not None:
+            return content
+    graph = gv.Source(source=dotsource, format=format)
+    with get_render_semaphore():
+        content = graph.pipe()
+    if cache is not None:
+        cache.put_bytes(format, dotsource, content)
+    return content
+
+
 def view_dotsource(format, dotsource, graphviz_tmpdir, cleanup=True):
     """Generate and show the fsa structure
 
@@ -35,6 +198,9 @@ def render_dotsource_to_file(format, filename, dotsource, graphviz_tmpdir, direc
     This will create a file at <filename> on the computer this software
     runs on.
 
+    Renders are cached on the hash of the format and the dotsource, so
+    graphviz is only run once per distinct graph.
+
     format: a format supported by graphviz
     filename: store the file locally at this location
     doutsource: show dotsource, do not generate from this fsa"""
@@ -53,6 +219,12 @@ def render_dotsource_to_file(format, filename, dotsource, graphviz_tmpdir, direc
     except ValueError:
         directory = Path(graphviz_tmpdir)
     directory.mkdir(mode=0o750, exist_ok=True, parents=True)
+    full_path = directory / PurePath(filename).with_suffix(extension)
+    cache = get_render_cache(graphviz_tmpdir)
+    content = cache.get_bytes(format, dotsource)
+    if content is not None:
+        full_path.write_bytes(content)
+        return full_path
     graph = gv.Source(
         source=dotsource,
         format=format,
@@ -60,5 +232,5 @@ def render_dotsource_to_file(format, filename, dotsource, graphviz_tmpdir, direc
         directory=str(directory),
     )
     graph.render(cleanup=True)
-    full_path = directory / PurePath(filename).with_suffix(extension)
+    cache.put(format, dotsource, full_path)
     return full_path
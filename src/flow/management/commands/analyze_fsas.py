@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from flow.compiled import compile_fsas
+from flow.analysis import get_analysis
+from flow.models import FSA
+
+
+class Command(BaseCommand):
+    help = ('Check FSAs for unreachable nodes, dead ends, duplicate '
+            'conditions and loops')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'slugs', nargs='*', metavar='slug',
+            help='Only check the FSAs with these slugs',
+        )
+
+    def handle(self, *args, **options):
+        fsas = FSA.objects.order_by('slug')
+        if options['slugs']:
+            fsas = fsas.filter(slug__in=options['slugs'])
+        fsas = list(fsas.values_list('pk', 'slug'))
+        compiled = compile_fsas(pk for pk, _ in fsas)
+        broken = 0
+        for pk, slug in fsas:
+            problems = get_analysis(compiled[pk]).problems()
+            if not problems:
+                self.stdout.write('{}: OK'.format(slug))
+                continue
+            broken += 1
+            self.stdout.write(self.style.WARNING('{}:'.format(slug)))
+            for problem in problems:
+                self.stdout.write('    {}'.format(problem))
+        if broken:
+            raise CommandError('{} of {} FSAs have problems'.format(broken, len(fsas)))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flow', '0006_add_clonable_model_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fsa',
+            name='generation',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Incremented whenever a node or edge of the FSA changes'),
+        ),
+    ]
@@ -1,9 +1,16 @@
+from threading import Lock
+from weakref import WeakValueDictionary
+
 from django.utils.timezone import now as utcnow
 
 from django.db import models
 
 
-__all__ = ['ClonableModel']
+__all__ = [
+    'CachedLabelMixin',
+    'ClonableModel',
+    'get_label_cache_info',
+]
 
 
 class ClonableModel(models.Model):
@@ -18,3 +25,103 @@ class ClonableModel(models.Model):
     def set_cloned_from(self, obj):
         self.cloned_from = obj
         self.cloned_when = utcnow()
+
+
+class LabelStats:
+    """Thread safe counts of label cache hits, misses and entries
+
+    The labels are kept on the instances, so the entries are the live
+    instances currently holding a label. They are tracked by weak
+    reference, keyed on ``id()`` since unsaved model instances are
+    unhashable, and vanish when their instance is garbage collected.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._holders = WeakValueDictionary()
+        self._lock = Lock()
+
+    @property
+    def entries(self):
+        return len(self._holders)
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def store(self, obj):
+        with self._lock:
+            self._holders[id(obj)] = obj
+
+    def forget(self, obj):
+        with self._lock:
+            self._holders.pop(id(obj), None)
+
+    def clear(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+_STATS = LabelStats()
+
+
+class CachedLabelMixin:
+    """Cache the string representation of model instances
+
+    Define ``get_label()`` instead of ``__str__()``; without it the label is
+    Django's default. The label is computed once per instance and kept on
+    the instance, so it lives exactly as long as the instance does, and it
+    is dropped when the instance is saved or refreshed from the database.
+
+    Labels often include those of related objects, and nothing tells an
+    instance that such an object changed. Only instances loaded after the
+    change get a fresh label, in this and in every other process. Long lived
+    instances, like those held by a cached template snapshot, keep their old
+    label until they are themselves saved or refreshed, or the snapshot is
+    rebuilt because the template's stamp changed.
+    """
+
+    def get_label(self):
+        return super().__str__()
+
+    def __str__(self):
+        try:
+            label = self.__dict__['_cached_label']
+        except KeyError:
+            _STATS.miss()
+            label = str(self.get_label())
+            self.__dict__['_cached_label'] = label
+            _STATS.store(self)
+        else:
+            _STATS.hit()
+        return label
+
+    def forget_label(self):
+        if self.__dict__.pop('_cached_label', None) is not None:
+            _STATS.forget(self)
+
+    def save(self, *args, **kwargs):
+        self.forget_label()
+        super().save(*args, **kwargs)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.forget_label()
+        super().refresh_from_db(*args, **kwargs)
+
+
+def get_label_cache_info():
+    """Return the number of label cache hits and misses
+
+    ``entries`` is the number of live instances holding a cached label.
+    """
+    return {
+        'hits': _STATS.hits,
+        'misses': _STATS.misses,
+        'entries': _STATS.entries,
+    }
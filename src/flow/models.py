@@ -1,25 +1,31 @@
 # encoding: utf-8
 
-from functools import lru_cache
+from collections import OrderedDict
 from uuid import uuid4
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Case, Q, Value, When
+from django.utils.timezone import now as utcnow
 
 import graphviz as gv
 
+from .analysis import get_analysis
+from .compiled import compile_fsa, invalidate_compiled_fsa
 from .errors import FSANoStartnodeError
 from .errors import FSANoDataError
 from .graphviz import _prep_dotsource, view_dotsource, render_dotsource_to_file
-from .modelmixins import ClonableModel
+from .graphviz import render_dotsource_to_bytes
+from .modelmixins import CachedLabelMixin, ClonableModel
+from .paths import count_paths, iter_paths
+from .reachability import get_maximal_previous_slugs, get_reachability
 
 
 SLUG_LENGTH = 40
 
 
-class Node(ClonableModel):
+class Node(CachedLabelMixin, ClonableModel):
     """
     Defaults, fallbacks; interface for all nodes
 
@@ -50,8 +56,7 @@ class Node(ClonableModel):
         ordering = ('fsa',)
         unique_together = ('fsa', 'slug')
 
-    @lru_cache(None)
-    def __str__(self):  # pragma: no cover
+    def get_label(self):  # pragma: no cover
         try:
             return self.payload.legend()
         except (ObjectDoesNotExist, AttributeError):
@@ -65,56 +70,18 @@ class Node(ClonableModel):
         new.save()
         return new
 
-    def get_next_node_many(self, next_nodes, data):
-        if not data:
-            raise FSANoDataError
-        depends = self.depends if self.depends else self
-        condition = data[str(depends.slug)]
-        for edge in next_nodes:
-            if depends.slug in data:
-                if edge.condition == condition:
-                    return edge.next_node
-        return None
-
     def get_next_node(self, nodes):
         if not nodes:
             raise FSANoDataError
-        edges = self.next_nodes.all()
-        next_nodes = set([edge.next_node for edge in edges])
-        if len(next_nodes) == 1:  # simple node
-            return next_nodes.pop()
-        if len(next_nodes) > 1:  # complex node
-            next_node = self.get_next_node_many(edges, nodes)
-            return next_node
-        # end node or overridden
-        return None
-
-    def get_prev_node_many(self, prev_nodes, data):
-        if not data:
-            raise FSANoDataError
-        for edge in prev_nodes:
-            prev_node = edge.prev_node
-            prev_node_slug = prev_node.slug
-            if prev_node_slug in data:
-                if edge.condition == data[prev_node_slug]:
-                    return prev_node
-        return None
+        return compile_fsa(self.fsa_id).get_next_node(self.slug, nodes)
 
     def get_prev_node(self, nodes):
         if not nodes:
             raise FSANoDataError
-        edges = self.prev_nodes.all()
-        prev_nodes = set([edge.prev_node for edge in edges])
-        if len(prev_nodes) == 1:  # simple node
-            return prev_nodes.pop()
-        if len(prev_nodes) > 1:  # complex node
-            prev_node = self.get_prev_node_many(edges, nodes)
-            return prev_node
-        # start node or overridden
-        return None
-
-
-class Edge(ClonableModel):
+        return compile_fsa(self.fsa_id).get_prev_node(self.slug, nodes)
+
+
+class Edge(CachedLabelMixin, ClonableModel):
     condition = models.CharField(max_length=64, blank=True)
     prev_node = models.ForeignKey(
         Node,
@@ -134,8 +101,7 @@ class Edge(ClonableModel):
     class Meta:
         unique_together = ('condition', 'prev_node', 'next_node')
 
-    @lru_cache(None)
-    def __str__(self):
+    def get_label(self):
         try:
             return self.payload.legend()
         except (ObjectDoesNotExist, AttributeError):
@@ -162,6 +128,10 @@ class FSA(ClonableModel):
     GRAPHVIZ_TMPDIR = '/tmp/flow_graphviz'
 
     slug = models.SlugField(max_length=SLUG_LENGTH, unique=True)
+    generation = models.PositiveIntegerField(
+        default=0, editable=False,
+        help_text='Incremented whenever a node or edge of the FSA changes',
+    )
 
     class Meta:
         verbose_name = 'FSA'
@@ -170,35 +140,45 @@ class FSA(ClonableModel):
     def __str__(self):  # pragma: no cover
         return self.slug
 
+    def save(self, *args, **kwargs):
+        # The generation is only ever changed in the database, by
+        # invalidate_compiled_fsa(), so never write back a possibly stale value
+        if self.pk and not self._state.adding and not kwargs.get('force_insert'):
+            if kwargs.get('update_fields') is None:
+                kwargs['update_fields'] = [
+                    f.name for f in self._meta.concrete_fields
+                    if not f.primary_key and f.name != 'generation'
+                ]
+        super().save(*args, **kwargs)
+
     @transaction.atomic
     def clone(self, slug=None):
+        """Clone the FSA with all its nodes and edges, and name it <slug>
+
+        Nodes and edges are inserted in bulk and hooked up via a map from
+        old to new pks, so the number of queries does not depend on the size
+        of the FSA."""
         slug = slug if slug else str(uuid4())
         new, created = self.__class__.objects.get_or_create(slug=slug)
         if not created:
             return new
         new.set_cloned_from(self)
         new.save()
-        # clone nodes
-        mapping = {}
-        for node in self.nodes.all():
-            mapping[node] = node.clone(new)
-        # set depends on nodes
-        for node in new.nodes.all():
-            node.depends = mapping.get(node.depends, None)
-            node.save()
-        # clone edges
-        for edge in Edge.objects.filter(
-            Q(prev_node__in=mapping) | Q(next_node__in=mapping)).distinct():
-            edge.clone(
-                mapping.get(edge.prev_node, None),
-                mapping.get(edge.next_node, None)
-            )
+        _clone_fsa_contents([(self.pk, new.pk)], new.cloned_when)
         return new
 
     @property
     def nodemap(self):
         return {s.slug: s for s in self.nodes.all()}
 
+    def compile(self):
+        """Return the read-only transition table of this FSA
+
+        The table is built in two queries and cached until a node or edge of
+        this FSA is saved or deleted. Looking it up costs one query, to
+        check that the cached table is still current."""
+        return compile_fsa(self.pk)
+
     def get_startnode(self):
         try:
             return Node.objects.get(start=True, fsa=self)
@@ -225,111 +205,148 @@ class FSA(ClonableModel):
         node.save()
 
     def generate_graph(self):
-        graph = {}
-        for node in self.nodes.all():
-            goes_to = set()
-            for s in node.next_nodes.all():
-                goes_to.add(s.next_node.slug if s.next_node else None)
-            graph[node.slug] = list(goes_to)
-        return graph
-
-    def _find_all_paths(self, graph, start, path=[]):
-        path = path + [start]
-        if start is None or self.nodes.get(slug=start).end:
-            return [path]
-        if start not in graph:
-            return []
-        paths = []
-        for node in graph[start]:
-            if node not in path:
-                newpaths = self._find_all_paths(graph, node, path)
-                for newpath in newpaths:
-                    paths.append(newpath)
-        return paths
+        graph = self.compile().graph
+        return {slug: list(goes_to) for slug, goes_to in graph.items()}
+
+    def iter_paths(self, limit=None, through=None, from_=None):
+        """Lazily generate paths through the FSA as tuples
+
+        limit:   stop after this many paths
+        through: only generate paths that visit the node with this slug
+        from_:   start at the node with this slug instead of the start node
+        """
+        compiled = self.compile()
+        if from_ is None and compiled.start is None:
+            raise FSANoStartnodeError()
+        return iter_paths(compiled, limit=limit, through=through, from_=from_)
+
+    def count_paths(self, from_=None):
+        "Count paths through the FSA without generating them"
+        compiled = self.compile()
+        if from_ is None and compiled.start is None:
+            raise FSANoStartnodeError()
+        return count_paths(compiled, from_=from_)
 
     def find_all_paths(self):
-        graph = self.generate_graph()
-        paths = self._find_all_paths(graph, self.start.slug)
-        return [tuple(path) for path in paths]
+        return list(self.iter_paths())
 
     def find_paths_to(self, nodeslug):
-        paths = self.find_all_paths()
-        paths_to = []
-        for path in paths:
-            if nodeslug in path:
-                pos = path.index(nodeslug)
-                paths_to.append(path[:pos])
-        paths_to.append(nodeslug)
-        return paths
+        """Find all distinct paths from the start node to <nodeslug>
+
+        Each path is a tuple of slugs ending with <nodeslug>, and paths
+        that only differ after <nodeslug> are returned once. Paths not
+        passing through <nodeslug> are left out.
+
+        This used to return every full path of the FSA, whether or not it
+        passed through <nodeslug>."""
+        paths_to = OrderedDict()
+        for path in self.iter_paths(through=nodeslug):
+            pos = path.index(nodeslug)
+            paths_to[path[:pos+1]] = None
+        return list(paths_to)
 
     def find_paths_from(self, nodeslug):
-        paths = self.find_all_paths()
         paths_from = []
-        for path in paths:
-            if nodeslug in path:
-                pos = path.index(nodeslug)
-                paths_from.append(path[pos:])
+        for path in self.iter_paths(through=nodeslug):
+            pos = path.index(nodeslug)
+            paths_from.append(path[pos:])
         return paths_from
 
     def nextnode(self, curnode, data):
         "Get next node"
-        return self.nodemap[curnode].get_next_node(data)
+        return self.compile().get_next_node(curnode, data)
 
     def prevnode(self, curnode, data):
         "Get prev node"
-        return self.nodemap[curnode].get_prev_node(data)
+        return self.compile().get_prev_node(curnode, data)
+
+    def evaluate_many(self, data_sets):
+        """Walk each of <data_sets> through the FSA
+
+        Each set maps node slugs to conditions. The FSA is compiled once
+        and shared by all the walks, so no queries are made per set.
+        Returns a list of `flow.compiled.Walk`, one per set, holding the
+        path taken and the node it ended at."""
+        compiled = self.compile()
+        if compiled.start is None:
+            raise FSANoStartnodeError
+        return [compiled.walk(data) for data in data_sets]
+
+    def reachability(self):
+        """Return the reachability engine of the FSA
+
+        It answers whether a set of nodes is on some path, in what order,
+        and what is reachable before or after a node, in linear time."""
+        return get_reachability(self.compile())
+
+    def analyze(self):
+        """Find structural problems: unreachable nodes, dead ends, duplicate
+        conditions and loops
+
+        See `flow.analysis.FSAReport`."""
+        return get_analysis(self.compile())
 
     def find_possible_paths_for_data(self, data):
-        paths = self.find_all_paths()
-        candidate_paths = set()
         keys = set(data.keys())
-        for path in paths:
+        reachability = self.reachability()
+        if not reachability.is_consistent(keys):
+            return set()
+        # Only walk paths that can visit the last of the keys
+        ordered_keys = reachability.canonical_order(keys)
+        through = ordered_keys[-1] if ordered_keys else None
+        candidate_paths = set()
+        for path in self.iter_paths(through=through):
             path = tuple(node for node in path if node)
             if keys.issubset(path):
                 candidate_paths.add(path)
         return candidate_paths
 
     def get_maximal_previous_nodes(self, nodeslug, visited=None):
-        if not visited:
-            visited = set()
-        node = Node.objects.get(slug=nodeslug, fsa=self)
-        visited.add(node)
-        edges = Edge.objects.filter(next_node=node)
-        nodes = set(edge.prev_node for edge in edges.all())
-        nodes.discard(None)
-        for node in nodes.copy():
-            if node.start:
-                nodes.add(node)
-                visited.add(node)
-                continue
-            if node in visited:
-                continue
-            recnodes = self.get_maximal_previous_nodes(node.slug, visited)
-            nodes = nodes.union(recnodes)
-        return list(nodes)
+        """Find all nodes before <nodeslug>, stopping at start nodes
+
+        <visited> is ignored, it is kept for backwards compatibility."""
+        compiled = self.compile()
+        if nodeslug not in compiled:
+            raise Node.DoesNotExist(
+                'FSA "{}" has no node "{}"'.format(self, nodeslug)
+            )
+        slugs = get_maximal_previous_slugs(compiled, nodeslug)
+        return [compiled.node(slug) for slug in slugs]
 
     def order_data(self, data):
         """Sort data according to possible graphs
 
         Incidentally, removes unknown nodes"""
-        paths = self.find_possible_paths_for_data(data)
-        # All graphs start the same so just pick one
-        keys = paths.pop()
-        ordered_data = [(s, data.get(s)) for s in keys if s in data]
+        reachability = self.reachability()
+        if not reachability.is_consistent(data.keys()):
+            raise KeyError('No path in the FSA visits all of the data')
+        # All graphs visit the keys in the same order
+        keys = reachability.canonical_order(data.keys())
+        ordered_data = [(s, data.get(s)) for s in keys]
         return ordered_data
 
     def generate_dotsource(self):
         global gv
         dot = gv.Digraph()
 
-        for node in self.nodes.all():
+        # Keep the order stable: renders are cached on the source
+        nodes = self.nodes.order_by('pk')
+        if any(rel.name == 'payload' for rel in Node._meta.related_objects):
+            nodes = nodes.select_related('payload')
+        edges = {}
+        edge_qs = (Edge.objects.filter(prev_node__fsa=self)
+                   .select_related('next_node').order_by('pk'))
+        for edge in edge_qs:
+            edges.setdefault(edge.prev_node_id, []).append(edge)
+
+        for node in nodes:
             node_args = {}
             payload = getattr(node, 'payload', None)
             if payload:
                 node_args['label'] = payload.label
             if node.start:
                 node_args['shape'] = 'doublecircle'
-            for edge in Edge.objects.filter(prev_node=node):
+            for edge in edges.get(node.pk, ()):
                 edge_args = {}
                 if edge.next_node is None:
                     node_args['shape'] = 'doublecircle'
@@ -350,3 +367,98 @@ class FSA(ClonableModel):
         if not dotsource:
             dotsource = self.generate_dotsource()
         return render_dotsource_to_file(format, filename, dotsource, self.GRAPHVIZ_TMPDIR, directory)
+
+    def render_dotsource_to_bytes(self, format, dotsource=None):
+        if not dotsource:
+            dotsource = self.generate_dotsource()
+        return render_dotsource_to_bytes(format, dotsource, self.GRAPHVIZ_TMPDIR)
+
+
+def _clone_fsa_contents(pairs, cloned_when):
+    """Clone the nodes and edges of FSAs into other, already saved FSAs
+
+    <pairs> is a sequence of (old FSA pk, new FSA pk), the same old FSA may
+    be cloned into several new ones. Nodes and edges are inserted in bulk
+    and hooked up via maps from old to new pks, so the number of queries
+    does not depend on the number or size of the FSAs.
+
+    Returns a dict from (new FSA pk, old node pk) to new node pk."""
+    clones = {}
+    for old_pk, new_pk in pairs:
+        clones.setdefault(old_pk, []).append(new_pk)
+    # clone nodes
+    nodes = list(Node.objects.filter(fsa__in=clones))
+    Node.objects.bulk_create([
+        Node(slug=node.slug, fsa_id=new_pk, start=node.start, end=node.end,
+             cloned_from_id=node.pk, cloned_when=cloned_when)
+        for node in nodes
+        for new_pk in clones[node.fsa_id]
+    ])
+    new_fsa_pks = [new_pk for _, new_pk in pairs]
+    new_pks = {
+        (fsa_pk, slug): pk
+        for fsa_pk, slug, pk in Node.objects.filter(fsa__in=new_fsa_pks)
+                                            .values_list('fsa_id', 'slug', 'pk')
+    }
+    mapping = {
+        (new_pk, node.pk): new_pks[(new_pk, node.slug)]
+        for node in nodes
+        for new_pk in clones[node.fsa_id]
+    }
+    old_fsas = {node.pk: node.fsa_id for node in nodes}
+    # set depends on nodes
+    depends = {
+        mapping[(new_pk, node.pk)]: mapping[(new_pk, node.depends_id)]
+        for node in nodes if old_fsas.get(node.depends_id) == node.fsa_id
+        for new_pk in clones[node.fsa_id]
+    }
+    if depends:
+        whens = [When(pk=pk, then=Value(depends_pk))
+                 for pk, depends_pk in depends.items()]
+        Node.objects.filter(pk__in=depends).update(
+            depends=Case(*whens, output_field=models.IntegerField())
+        )
+    # clone edges
+    edges = Edge.objects.filter(
+        Q(prev_node__in=old_fsas) | Q(next_node__in=old_fsas)).distinct()
+    new_edges = []
+    for edge in edges:
+        fsa_pks = {old_fsas.get(edge.prev_node_id), old_fsas.get(edge.next_node_id)}
+        fsa_pks.discard(None)
+        for old_pk in sorted(fsa_pks):
+            for new_pk in clones[old_pk]:
+                prev_pk = mapping.get((new_pk, edge.prev_node_id), None)
+                next_pk = mapping.get((new_pk, edge.next_node_id), None)
+                new_edges.append(
+                    Edge(condition=edge.condition, prev_node_id=prev_pk,
+                         next_node_id=next_pk, cloned_from_id=edge.pk,
+                         cloned_when=cloned_when)
+                )
+    Edge.objects.bulk_create(new_edges)
+    # bulk operations send no signals
+    invalidate_compiled_fsa(*new_fsa_pks)
+    return mapping
+
+
+@transaction.atomic
+def clone_fsas(slugs):
+    """Clone several FSAs with all their nodes and edges
+
+    <slugs> is a sequence of (FSA pk, slug of the clone). The same FSA may
+    be cloned several times under different slugs. Everything is inserted in
+    bulk, in a fixed number of queries.
+
+    Returns a dict from slug to the pk of the new FSA, and the dict from
+    (new FSA pk, old node pk) to new node pk."""
+    slugs = list(slugs)
+    if not slugs:
+        return {}, {}
+    cloned_when = utcnow()
+    FSA.objects.bulk_create([
+        FSA(slug=slug, cloned_from_id=old_pk, cloned_when=cloned_when)
+        for old_pk, slug in slugs
+    ])
+    fsa_pks = dict(FSA.objects.filter(slug__in=[slug for _, slug in slugs])
+                   .values_list('slug', 'pk'))
+    pairs = [(old_pk, fsa_pks[slug]) for old_pk, slug in slugs]
+    return fsa_pks, _clone_fsa_contents(pairs, cloned_when)
@@ -0,0 +1,162 @@
+# encoding: utf-8
+"""
+Path enumeration and counting over a `flow.compiled.CompiledFSA`
+
+A path starts at the start node and ends either at an end node or with
+``None``, for an edge without a next node. A path never visits a node
+twice. Nodes without outgoing edges that are not end nodes are dead ends
+and do not lead to a path.
+"""
+
+from collections import deque
+
+
+__all__ = [
+    'iter_paths',
+    'count_paths',
+    'topological_order',
+]
+
+
+def _sort_key(slug):
+    return (slug is None, slug or '')
+
+
+def _build_adjacency(compiled):
+    """Successors per node in a stable order
+
+    Traversal stops at end nodes, so they have no successors."""
+    adjacency = {}
+    for slug, targets in compiled.graph.items():
+        if slug in compiled.ends:
+            adjacency[slug] = ()
+        else:
+            adjacency[slug] = tuple(sorted(targets, key=_sort_key))
+    return adjacency
+
+
+def get_adjacency(compiled):
+    return compiled.derive('adjacency', _build_adjacency)
+
+
+def _build_topological_order(compiled):
+    adjacency = get_adjacency(compiled)
+    indegree = {slug: 0 for slug in adjacency}
+    for targets in adjacency.values():
+        for target in targets:
+            if target is not None:
+                indegree[target] += 1
+    queue = deque(slug for slug, degree in indegree.items() if not degree)
+    order = []
+    while queue:
+        slug = queue.popleft()
+        order.append(slug)
+        for target in adjacency[slug]:
+            if target is None:
+                continue
+            indegree[target] -= 1
+            if not indegree[target]:
+                queue.append(target)
+    if len(order) != len(adjacency):
+        return None
+    return tuple(order)
+
+
+def topological_order(compiled):
+    """Return all node slugs in a canonical topological order
+
+    Returns None if the FSA has a loop."""
+    return compiled.derive('topological_order', _build_topological_order)
+
+
+def _find_ancestors(compiled, slug):
+    "Find all nodes that <slug> can be reached from, including itself"
+    adjacency = get_adjacency(compiled)
+    ancestors = {slug}
+    queue = deque([slug])
+    while queue:
+        current = queue.popleft()
+        for prev_slug in compiled.prev_nodes.get(current, ()):
+            if prev_slug is None or prev_slug in ancestors:
+                continue
+            if current not in adjacency[prev_slug]:  # prev_slug is an end node
+                continue
+            ancestors.add(prev_slug)
+            queue.append(prev_slug)
+    return ancestors
+
+
+def iter_paths(compiled, limit=None, through=None, from_=None):
+    """Lazily generate the paths of <compiled> as tuples
+
+    limit:   stop after this many paths
+    through: only generate paths that visit the node with this slug
+    from_:   start at the node with this slug instead of the start node
+
+    The path being walked is kept in one list that all branches share, so
+    the only copying done is of the paths actually generated.
+    """
+    start = compiled.start if from_ is None else from_
+    if limit is not None and limit <= 0:
+        return
+    adjacency = get_adjacency(compiled)
+    if through is not None:
+        if through not in adjacency:
+            return
+        may_reach_through = _find_ancestors(compiled, through)
+    count = 0
+
+    path = [start]
+    on_path = {start}
+    seen_through = through is None or start == through
+    if start in compiled.ends:
+        if seen_through:
+            yield (start,)
+        return
+    stack = [iter(adjacency[start])]
+    while stack:
+        for slug in stack[-1]:
+            if slug in on_path:
+                continue
+            if not seen_through and slug != through and slug not in may_reach_through:
+                continue
+            if slug is None or slug in compiled.ends:
+                if seen_through or slug == through:
+                    yield tuple(path) + (slug,)
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+                continue
+            path.append(slug)
+            on_path.add(slug)
+            if slug == through:
+                seen_through = True
+            stack.append(iter(adjacency[slug]))
+            break
+        else:
+            stack.pop()
+            slug = path.pop()
+            on_path.discard(slug)
+            if slug == through:
+                seen_through = False
+
+
+def count_paths(compiled, from_=None):
+    """Count the paths of <compiled> without generating them
+
+    Uses dynamic programming over the topological order, so the cost is
+    linear in the size of the FSA, not in the number of paths. Falls back
+    to counting generated paths if the FSA has a loop."""
+    start = compiled.start if from_ is None else from_
+    order = topological_order(compiled)
+    if order is None:
+        return sum(1 for _ in iter_paths(compiled, from_=start))
+    adjacency = get_adjacency(compiled)
+    counts = {}
+    for slug in reversed(order):
+        if slug in compiled.ends:
+            counts[slug] = 1
+            continue
+        counts[slug] = sum(1 if target is None else counts[target]
+                           for target in adjacency[slug])
+    return counts.get(start, 0)
@@ -0,0 +1,185 @@
+# encoding: utf-8
+"""
+Linear-time reachability questions over a `flow.compiled.CompiledFSA`
+
+Enumerating paths to answer "is there a path through these nodes" costs
+time proportional to the number of paths, which grows exponentially with
+the number of branches. On a DAG the same questions can be answered in
+time linear in the number of nodes and edges.
+
+FSAs with loops fall back to path enumeration so that the answers are the
+same in every case.
+"""
+
+from collections import deque
+
+from .paths import get_adjacency, iter_paths, topological_order
+
+
+__all__ = [
+    'Reachability',
+    'get_reachability',
+    'get_maximal_previous_slugs',
+]
+
+
+class Reachability:
+    "Answer reachability questions about one compiled FSA"
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.adjacency = get_adjacency(compiled)
+        self.order = topological_order(compiled)
+        self.is_dag = self.order is not None
+        if self.is_dag:
+            self.position = {slug: i for i, slug in enumerate(self.order)}
+
+    def _terminates(self, slug):
+        "Whether a path may end at <slug>"
+        return slug in self.compiled.ends or None in self.adjacency[slug]
+
+    def _candidate_paths(self, slugs):
+        for path in iter_paths(self.compiled):
+            if slugs.issubset(path):
+                yield path
+
+    def is_consistent(self, slugs):
+        """Whether some path from the start node visits all of <slugs>"""
+        slugs = set(slugs)
+        start = self.compiled.start
+        if start is None or not slugs.issubset(self.adjacency):
+            return False
+        if not self.is_dag:
+            return any(True for _ in self._candidate_paths(slugs))
+        wanted = self.canonical_order(slugs)
+        # covered[slug]: the longest prefix of <wanted> that some path from
+        # the start node to <slug> visits, in order.
+        covered = {start: 1 if wanted and wanted[0] == start else 0}
+        for slug in self.order[self.position[start]:]:
+            if slug not in covered:
+                continue
+            so_far = covered[slug]
+            if so_far == len(wanted) and self._terminates(slug):
+                return True
+            for target in self.adjacency[slug]:
+                if target is None:
+                    continue
+                next_so_far = so_far
+                if so_far < len(wanted) and wanted[so_far] == target:
+                    next_so_far += 1
+                if covered.get(target, -1) < next_so_far:
+                    covered[target] = next_so_far
+        return False
+
+    def canonical_order(self, slugs):
+        """Sort <slugs> in the canonical topological order of the FSA
+
+        Any path visiting all of <slugs> visits them in this order. Unknown
+        slugs are dropped."""
+        slugs = set(slugs)
+        if self.is_dag:
+            return [slug for slug in self.order if slug in slugs]
+        for path in self._candidate_paths(slugs):
+            return [slug for slug in path if slug in slugs]
+        return [slug for slug in self.adjacency if slug in slugs]
+
+    def reachable_after(self, slug):
+        "Return the set of nodes that can be visited after <slug>"
+        seen = set()
+        queue = deque([slug])
+        while queue:
+            current = queue.popleft()
+            for target in self.adjacency[current]:
+                if target is None or target in seen:
+                    continue
+                seen.add(target)
+                queue.append(target)
+        seen.discard(slug)
+        return frozenset(seen)
+
+    def reachable_before(self, slug):
+        "Return the set of nodes that can be visited before <slug>"
+        seen = set()
+        queue = deque([slug])
+        while queue:
+            current = queue.popleft()
+            for source in self.compiled.prev_nodes[current]:
+                if source is None or source in seen:
+                    continue
+                if current not in self.adjacency[source]:  # an end node
+                    continue
+                seen.add(source)
+                queue.append(source)
+        seen.discard(slug)
+        return frozenset(seen)
+
+
+def get_reachability(compiled):
+    "Return the Reachability for <compiled>, computed once per compiled FSA"
+    return compiled.derive('reachability', Reachability)
+
+
+def _build_ancestor_index(compiled):
+    """Map each node to the set of its maximal previous nodes
+
+    The previous nodes of a node are followed backwards along every edge,
+    but not past nodes flagged as start nodes. With no loops this is a
+    single pass in topological order, with the ancestors kept as bitsets
+    indexed by node ordinal.
+    """
+    slugs = tuple(compiled.pks)
+    ordinal = {slug: i for i, slug in enumerate(slugs)}
+    indegree = {slug: 0 for slug in slugs}
+    for targets in compiled.graph.values():
+        for target in targets:
+            if target is not None:
+                indegree[target] += 1
+    queue = deque(slug for slug in slugs if not indegree[slug])
+    bits = {}
+    while queue:
+        slug = queue.popleft()
+        ancestors = 0
+        for prev_slug in compiled.prev_nodes[slug]:
+            if prev_slug is None:
+                continue
+            ancestors |= 1 << ordinal[prev_slug]
+            if prev_slug not in compiled.starts:
+                ancestors |= bits[prev_slug]
+        bits[slug] = ancestors
+        for target in compiled.graph[slug]:
+            if target is None:
+                continue
+            indegree[target] -= 1
+            if not indegree[target]:
+                queue.append(target)
+    if len(bits) == len(slugs):
+        index = {}
+        for slug, ancestors in bits.items():
+            index[slug] = tuple(s for i, s in enumerate(slugs) if ancestors >> i & 1)
+        return index
+    # There are loops, walk backwards from each node instead
+    index = {}
+    for slug in slugs:
+        found = set()
+        expanded = {slug}
+        queue = deque([slug])
+        while queue:
+            current = queue.popleft()
+            for prev_slug in compiled.prev_nodes[current]:
+                if prev_slug is None:
+                    continue
+                found.add(prev_slug)
+                if prev_slug in compiled.starts or prev_slug in expanded:
+                    continue
+                expanded.add(prev_slug)
+                queue.append(prev_slug)
+        index[slug] = tuple(s for s in slugs if s in found)
+    return index
+
+
+def get_maximal_previous_slugs(compiled, slug):
+    """Return the slugs of all maximal previous nodes of <slug>
+
+    The index is computed once per compiled FSA, after that each lookup is
+    a single dict lookup."""
+    return compiled.derive('ancestors', _build_ancestor_index)[slug]
@@ -0,0 +1,44 @@
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .compiled import invalidate_compiled_fsa
+from .models import Edge
+from .models import FSA
+from .models import Node
+
+
+def get_fsa_pks_for_edge(edge):
+    fsa_pks = set()
+    node_pks = []
+    for fieldname in ('prev_node', 'next_node'):
+        if getattr(Edge, fieldname).is_cached(edge):
+            node = getattr(edge, fieldname)
+            if node is not None:
+                fsa_pks.add(node.fsa_id)
+            continue
+        node_pk = getattr(edge, fieldname + '_id')
+        if node_pk is not None:
+            node_pks.append(node_pk)
+    if node_pks:
+        nodes = Node.objects.filter(pk__in=node_pks)
+        fsa_pks.update(nodes.values_list('fsa_id', flat=True))
+    return fsa_pks
+
+
+@receiver(post_save, sender=FSA)
+@receiver(post_delete, sender=FSA)
+def invalidate_fsa(sender, instance, **kwargs):
+    invalidate_compiled_fsa(instance.pk)
+
+
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+def invalidate_fsa_of_node(sender, instance, **kwargs):
+    invalidate_compiled_fsa(instance.fsa_id)
+
+
+@receiver(post_save, sender=Edge)
+@receiver(post_delete, sender=Edge)
+def invalidate_fsa_of_edge(sender, instance, **kwargs):
+    invalidate_compiled_fsa(*get_fsa_pks_for_edge(instance))
@@ -1,11 +1,24 @@
 from datetime import date
+from unittest import mock
 from collections import OrderedDict
 
 from django import test
+from django.contrib.auth.models import Permission
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from guardian.shortcuts import assign_perm
 
 from easydmp.dmpt.models import Template, Section, CannedAnswer, Question
 from easydmp.dmpt.models import BooleanQuestion, ChoiceQuestion, DateRangeQuestion
 from easydmp.dmpt.models import MultipleChoiceOneTextQuestion
+from easydmp.dmpt.models import ExternalChoiceQuestion, ExternalMultipleChoiceOneTextQuestion
+from easydmp.eestore.models import EEStoreCache, EEStoreMount, EEStoreSource, EEStoreType
+from easydmp.dmpt.models import dfs_paths
+from easydmp.dmpt.rendered import clear_rendered_cache, get_rendered_cache_info
+from easydmp.dmpt.snapshot import SectionIndex, SectionPaths, clear_template_graph_cache
+from easydmp.dmpt.utils import with_ordinals
+from flow.cache import LRUCache
+from flow.modelmixins import CachedLabelMixin, get_label_cache_info
 from flow.models import Edge, Node, FSA
 
 
@@ -174,13 +187,766 @@ class TestQuestionGetCannedAnswerMethods(CannedData, test.TestCase):
         self.assertEqual(result, expected)
 
 
+class TestQuestionCannedLookup(CannedData, test.TestCase):
+
+    def test_get_canned_lookup(self):
+        q = ChoiceQuestion.objects.create(**self.canned_question)
+        CannedAnswer.objects.create(question=q, choice='a', canned_text='A', position=1)
+        CannedAnswer.objects.create(question=q, choice='b', canned_text='', position=2)
+        CannedAnswer.objects.create(question=q, choice='a', canned_text='Other A', position=3)
+        self.assertEqual(q.get_canned_lookup(), {'a': 'A', 'b': ''})
+        self.assertEqual(q.get_canned_answer('a'), 'A')
+        self.assertEqual(q.get_canned_answer('b'), 'b')
+        self.assertEqual(q.get_canned_answer('c'), '')
+        self.assertTrue(q.validate_choice({'choice': 'b'}))
+        self.assertFalse(q.validate_choice({'choice': ['b']}))
+        # Without prefetching, changes are seen at once
+        CannedAnswer.objects.create(question=q, choice='c', canned_text='C', position=4)
+        self.assertEqual(q.get_canned_answer('c'), 'C')
+
+    def test_snapshot_needs_no_queries(self):
+        q = ChoiceQuestion.objects.create(**self.canned_question)
+        CannedAnswer.objects.create(question=q, choice='a', canned_text='A', position=1)
+        CannedAnswer.objects.create(question=q, choice='b', canned_text='B', position=2)
+        question = self.template.snapshot().get_question(q.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(question.get_canned_answer('b'), 'B')
+            self.assertTrue(question.validate_choice({'choice': 'a'}))
+
+
+class TestQuestionTyped(CannedData, test.TestCase):
+
+    def test_typed(self):
+        eestore_type = EEStoreType.objects.create(name='repo')
+        source = EEStoreSource.objects.create(eestore_type=eestore_type, name='src')
+        for i in range(3):
+            q = ChoiceQuestion.objects.create(position=i, **self.canned_question)
+            CannedAnswer.objects.create(question=q, choice='a')
+            q = ExternalChoiceQuestion.objects.create(position=10 + i, **self.canned_question)
+            mount = EEStoreMount.objects.create(question=q, eestore_type=eestore_type)
+            mount.sources.add(source)
+        # Questions, canned answers, EEStore sources
+        with self.assertNumQueries(3):
+            questions = list(self.section.questions.order_by('position').typed())
+            for question in questions:
+                question.get_canned_lookup()
+                if question.input_type == 'externalchoice':
+                    list(question.eestore.sources.all())
+                    str(question.eestore.eestore_type)
+        self.assertEqual([type(q) for q in questions],
+                         [ChoiceQuestion] * 3 + [ExternalChoiceQuestion] * 3)
+        self.assertEqual(Question.objects.typed().count(), 6)
+
+
+class TestTemplateGeneration(CannedData, test.TestCase):
+
+    def assertBumped(self, stamp):
+        new_stamp = self.template.get_stamp()
+        self.assertGreater(new_stamp[1], stamp[1])
+        return new_stamp
+
+    def test_structure_changes_bump_generation(self):
+        stamp = self.template.get_stamp()
+        self.assertEqual(stamp[0], self.template.pk)
+        q = BooleanQuestion.objects.create(label='q', **self.canned_question)
+        stamp = self.assertBumped(stamp)
+        ca = CannedAnswer.objects.create(question=q, choice='Yes')
+        stamp = self.assertBumped(stamp)
+        q.create_node()
+        stamp = self.assertBumped(stamp)
+        Node.objects.create(slug='other', fsa=q.node.fsa)
+        stamp = self.assertBumped(stamp)
+        Edge.objects.create(condition='Yes', prev_node=q.node)
+        stamp = self.assertBumped(stamp)
+        ca.delete()
+        stamp = self.assertBumped(stamp)
+        self.section.title = 'Renamed'
+        self.section.save()
+        stamp = self.assertBumped(stamp)
+        self.assertEqual(self.template.get_stamp(), stamp)
+
+    def test_other_templates_are_untouched(self):
+        other = Template.objects.create(title='Other')
+        stamp = other.get_stamp()
+        ChoiceQuestion.objects.create(**self.canned_question)
+        self.assertEqual(other.get_stamp(), stamp)
+
+    def test_saving_stale_template_keeps_generation(self):
+        stale = Template.objects.get(pk=self.template.pk)
+        Question.objects.create(**self.canned_question)
+        stamp = self.template.get_stamp()
+        stale.title = 'New title'
+        stale.save()
+        self.assertGreater(self.template.get_stamp()[1], stamp[1])
+
+
+class BranchingData(CannedData):
+
+    def setUp(self):
+        super().setUp()
+        self.q1 = BooleanQuestion.objects.create(label='q1', position=1, **self.canned_question)
+        self.q1.create_node()
+        fsa = self.q1.node.fsa
+        Node.objects.filter(pk=self.q1.node.pk).update(start=True)
+        self.q2 = ChoiceQuestion.objects.create(label='q2', position=2, **self.canned_question)
+        self.q2.create_node(fsa)
+        self.q3 = ChoiceQuestion.objects.create(label='q3', position=3, **self.canned_question)
+        self.q3.create_node(fsa)
+        for question, choices in ((self.q1, ('Yes', 'No')), (self.q2, ('a', 'b'))):
+            for position, choice in enumerate(choices, 1):
+                CannedAnswer.objects.create(question=question, choice=choice,
+                                            position=position,
+                                            canned_text='Said {}'.format(choice))
+        Edge.objects.create(condition='True', prev_node=self.q1.node, next_node=self.q2.node)
+        Edge.objects.create(condition='False', prev_node=self.q1.node, next_node=self.q3.node)
+        self.section2 = Section.objects.create(template=self.template, title='Next', position=2)
+        self.q4 = ChoiceQuestion.objects.create(section=self.section2, question='s', position=1)
+
+
+class TestTemplateGraph(BranchingData, test.TestCase):
+
+    def test_fixed_number_of_queries(self):
+        with self.assertNumQueries(7):
+            self.template.snapshot()
+        for i in range(5):
+            question = ChoiceQuestion.objects.create(position=10 + i, **self.canned_question)
+            CannedAnswer.objects.create(question=question, choice='x')
+        with self.assertNumQueries(7):  # nothing is cached inside a transaction
+            graph = self.template.snapshot()
+        self.assertEqual(len(graph.questions), 9)
+        self.assertIsInstance(graph.get_question(self.q1.pk), BooleanQuestion)
+        self.assertEqual([s.pk for s in graph.sections], [self.section.pk, self.section2.pk])
+
+    def test_get_next_question(self):
+        graph = self.template.snapshot()
+        for choice, expected in ((True, self.q2), (False, self.q3)):
+            answers = {str(self.q1.pk): {'choice': choice}}
+            with self.assertNumQueries(0):
+                result = graph.get_next_question(self.q1, answers)
+            self.assertEqual(result, expected)
+            self.assertEqual(self.q1.get_next_question(answers), expected)
+        self.assertEqual(graph.get_next_question(self.q2, {}), self.q3)
+        self.assertEqual(graph.get_next_question(self.q3, {}), self.q4)
+        self.assertEqual(graph.get_next_question(self.q4, {}), None)
+
+    def test_find_all_paths(self):
+        graph = self.template.snapshot()
+        paths = graph.get_section_paths(self.section)
+        expected = [[self.q1.pk, self.q2.pk, self.q3.pk], [self.q1.pk, self.q3.pk]]
+        self.assertEqual(sorted(graph.find_all_paths(self.section)), expected)
+        self.assertEqual(sorted(self.section.find_all_paths()), expected)
+        self.assertEqual(paths.count(), 2)
+        self.assertEqual(self.section.count_paths(), 2)
+        self.assertEqual(paths.edges[self.q1.pk], (('False', self.q3.pk), ('True', self.q2.pk)))
+
+    def test_validate_section_data(self):
+        graph = self.template.snapshot()
+        data = {
+            str(self.q1.pk): {'choice': False},
+            str(self.q3.pk): {'choice': 'c'},
+        }
+        self.assertEqual(graph.validate_section_data(self.section, data),
+                         self.section.validate_data(data))
+
+    def test_generate_canned_text(self):
+        data = {
+            str(self.q1.pk): {'choice': True},
+            str(self.q2.pk): {'choice': 'b'},
+        }
+        graph = self.template.snapshot()
+        with self.assertNumQueries(0):
+            texts = graph.generate_canned_text(data)
+        self.assertEqual(texts[0]['text'], self.section.generate_canned_text(data))
+        self.assertEqual(texts[0]['text'][0]['text'], 'Said Yes')
+        self.assertEqual(texts[0]['text'][1]['text'], 'Said b')
+
+    def test_get_summary(self):
+        data = {str(self.q1.pk): {'choice': True}}
+        graph = self.template.snapshot()
+        with self.assertNumQueries(0):
+            summary = graph.get_summary(data, valid_section_ids=(self.section.pk,))
+        section_summary = summary[self.section.full_title()]
+        self.assertTrue(section_summary['section']['valid'])
+        self.assertEqual(section_summary['section']['first_question'], self.q1)
+        self.assertEqual(section_summary['data'][self.q1.pk]['answer'], 'Yes')
+        self.assertEqual(list(section_summary['data']), [self.q1.pk, self.q2.pk, self.q3.pk])
+
+
+class TestSectionWalk(BranchingData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        CannedAnswer.objects.create(question=self.q3, choice='c', position=1)
+
+    def test_walk_follows_answers(self):
+        data = {
+            str(self.q1.pk): {'choice': True},
+            str(self.q2.pk): {'choice': 'a'},
+            str(self.q3.pk): {'choice': 'c'},
+        }
+        walk = self.section.walk(data)
+        self.assertEqual(walk.path, (self.q1.pk, self.q2.pk, self.q3.pk))
+        self.assertTrue(walk.valid)
+        data = {
+            str(self.q1.pk): {'choice': False},
+            str(self.q3.pk): {'choice': 'c'},
+        }
+        self.assertEqual(self.section.walk(data).path, (self.q1.pk, self.q3.pk))
+
+    def test_walk_stops_at_first_missing_question(self):
+        data = {
+            str(self.q1.pk): {'choice': True},
+            str(self.q3.pk): {'choice': 'c'},
+        }
+        walk = self.section.walk(data)
+        self.assertEqual(walk.path, (self.q1.pk,))
+        self.assertEqual(walk.first_invalid, self.q2.pk)
+        self.assertFalse(walk.valid)
+        # The valid questions still make up the path q1 -> q3
+        self.assertTrue(self.section.validate_data(data))
+        del data[str(self.q3.pk)]
+        self.assertFalse(self.section.validate_data(data))
+
+    def test_validate_with_answers_off_the_path(self):
+        graph = self.template.snapshot()
+        valid = self.section.validate_data
+        # Answers left over from the other branch
+        data = {
+            str(self.q1.pk): {'choice': False},
+            str(self.q2.pk): {'choice': 'a'},
+            str(self.q3.pk): {'choice': 'c'},
+        }
+        self.assertTrue(valid(data))
+        data = {
+            str(self.q1.pk): {'choice': False},
+            str(self.q2.pk): {'choice': 'a'},
+        }
+        self.assertFalse(graph.walk_section(self.section, data).valid)
+        # q1 -> q2 -> q3 is not valid without q3, q1 -> q3 neither
+        self.assertFalse(valid(data))
+
+
+class TestNavigationMap(BranchingData, test.TestCase):
+
+    def test_follows_answers_across_sections(self):
+        graph = self.template.snapshot()
+        data = {str(self.q1.pk): {'choice': True}}
+        with self.assertNumQueries(0):
+            navigation_map = graph.navigation_map(data)
+        self.assertEqual(list(navigation_map.questions), [self.q1, self.q2, self.q3, self.q4])
+        self.assertTrue(navigation_map.complete)
+        self.assertEqual(navigation_map.get_next(self.q1), self.q2)
+        self.assertEqual(navigation_map.get_prev(self.q4), self.q3)
+        self.assertIsNone(navigation_map.get_prev(self.q1))
+        self.assertIsNone(navigation_map.get_next(self.q4))
+        self.assertEqual(list(navigation_map.sections), [self.section.pk, self.section2.pk])
+        self.assertEqual(navigation_map.get_section_questions(self.section2), (self.q4,))
+        self.assertTrue(navigation_map.is_section_start(self.q4))
+        self.assertFalse(navigation_map.is_section_start(self.q2))
+
+        data = {str(self.q1.pk): {'choice': False}}
+        navigation_map = graph.navigation_map(data)
+        self.assertEqual(list(navigation_map.questions), [self.q1, self.q3, self.q4])
+        self.assertNotIn(self.q2, navigation_map)
+        with self.assertRaises(KeyError):
+            navigation_map.get_next(self.q2)
+
+    def test_stops_at_unanswered_branch(self):
+        navigation_map = self.template.snapshot().navigation_map({})
+        self.assertEqual(list(navigation_map.questions), [self.q1])
+        self.assertFalse(navigation_map.complete)
+        with self.assertRaises(KeyError):
+            navigation_map.get_next(self.q1)
+
+
+class TestTemplateClone(BranchingData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for ca in self.q1.canned_answers.all():
+            condition = str(ca.choice == 'Yes')
+            ca.edge = Edge.objects.get(prev_node=self.q1.node, condition=condition)
+            ca.save()
+        self.section2.super_section = self.section
+        self.section2.save()
+        eestore_type = EEStoreType.objects.create(name='repo')
+        self.source = EEStoreSource.objects.create(eestore_type=eestore_type, name='src')
+        mount = EEStoreMount.objects.create(question=self.q4, eestore_type=eestore_type)
+        mount.sources.add(self.source)
+
+    def test_clone(self):
+        new = self.template.clone('Clone')
+        self.assertEqual((new.title, new.version), ('Clone', 1))
+        sections = list(new.sections.order_by('position'))
+        self.assertEqual([s.title for s in sections], ['Miscellaneous', 'Next'])
+        self.assertEqual(sections[1].super_section, sections[0])
+        graph = new.snapshot()
+        q1, q2, q3, q4 = graph.questions
+        self.assertEqual([q.label for q in (q1, q2, q3)], ['q1', 'q2', 'q3'])
+        self.assertNotEqual(q1.node.fsa, self.q1.node.fsa)
+        self.assertEqual(q1.node.cloned_from_id, self.q1.node.pk)
+        self.assertEqual(q2.node.fsa, q1.node.fsa)
+        for ca in q1.canned_answers.all():
+            self.assertEqual(ca.edge.prev_node, q1.node)
+            self.assertEqual(ca.edge.condition, str(ca.choice == 'Yes'))
+        answers = {str(q1.pk): {'choice': False}}
+        self.assertEqual(graph.get_next_question(q1, answers), q3)
+        self.assertEqual(list(q4.eestore.sources.all()), [self.source])
+        self.assertEqual(self.q4.eestore.question, self.q4)
+
+    def test_query_count_is_constant(self):
+        with CaptureQueriesContext(connection) as small_queries:
+            self.template.clone('Small clone')
+        section = Section.objects.create(template=self.template, title='More', position=3)
+        for position in range(1, 6):
+            question = BooleanQuestion.objects.create(
+                section=section, question='s', position=position)
+            CannedAnswer.objects.create(question=question, choice='Yes')
+            question.create_node()
+        with CaptureQueriesContext(connection) as big_queries:
+            self.template.clone('Big clone')
+        self.assertEqual(len(big_queries), len(small_queries))
+        self.assertEqual(Question.objects.filter(section__template__title='Big clone').count(), 9)
+
+
+class TestBulkDeletion(BranchingData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for ca in self.q1.canned_answers.all():
+            condition = str(ca.choice == 'Yes')
+            ca.edge = Edge.objects.get(prev_node=self.q1.node, condition=condition)
+            ca.save()
+        self.fsa = self.q1.node.fsa
+
+    def test_delete_question(self):
+        self.q2.delete()
+        self.assertFalse(Node.objects.filter(pk=self.q2.node.pk).exists())
+        self.assertTrue(FSA.objects.filter(pk=self.fsa.pk).exists())
+        self.assertEqual(list(self.q1.node.next_nodes.values_list('condition', flat=True)), ['False'])
+        self.assertIsNone(self.q1.canned_answers.get(choice='Yes').edge)
+        self.assertEqual(list(self.template.snapshot().questions), [self.q1, self.q3, self.q4])
+
+    def test_delete_section(self):
+        generation = self.template.get_stamp()[1]
+        self.assertEqual(self.section.count_deletions(), OrderedDict([
+            ('sections', 1), ('questions', 3), ('canned answers', 4),
+            ('FSAs', 1), ('nodes', 3), ('edges', 2),
+        ]))
+        total, deleted = self.section.delete()
+        self.assertEqual(total, 14)
+        # Bottom-up: whatever refers to something is deleted before it
+        self.assertEqual(list(deleted), ['dmpt.CannedAnswer', 'dmpt.Question',
+                                         'dmpt.Section', 'flow.Edge',
+                                         'flow.Node', 'flow.FSA'])
+        self.assertEqual(deleted['flow.Edge'], 2)
+        self.assertFalse(FSA.objects.filter(pk=self.fsa.pk).exists())
+        self.assertFalse(CannedAnswer.objects.filter(question__section=self.section).exists())
+        self.assertGreater(self.template.get_stamp()[1], generation)
+        self.assertEqual(list(self.template.snapshot().questions), [self.q4])
+
+    def test_admin_confirmation_shows_counts(self):
+        from easydmp.auth.models import User
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(user)
+        url = '/admin/dmpt/section/{}/delete/'.format(self.section.pk)
+        with mock.patch('django.contrib.admin.options.get_deleted_objects') as walk:
+            response = self.client.get(url)
+        walk.assert_not_called()
+        self.assertContains(response, 'FSAs: 1')
+        self.assertContains(response, 'Canned answers: 4')
+        response = self.client.post(url, {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Section.objects.filter(pk=self.section.pk).exists())
+        self.assertFalse(FSA.objects.filter(pk=self.fsa.pk).exists())
+
+    def test_admin_confirmation_needs_permissions(self):
+        from easydmp.auth.models import User
+        user = User.objects.create_user('staff', 'staff@example.com', 'pw', is_staff=True)
+        user.user_permissions.add(*Permission.objects.filter(
+            codename__in=('change_section', 'delete_section')))
+        assign_perm('dmpt.change_template', user, self.template)
+        self.client.force_login(user)
+        response = self.client.get('/admin/dmpt/section/{}/delete/'.format(self.section.pk))
+        self.assertContains(response, 'Cannot delete')
+        self.assertContains(response, '<li>question</li>', html=True)
+
+    def test_query_count_is_constant(self):
+        big = self.template.clone('Big')
+        section = big.sections.get(position=1)
+        for position in range(10, 15):
+            question = BooleanQuestion.objects.create(
+                section=section, question='s', position=position)
+            question.create_node(section.questions.get(position=1).node.fsa)
+            CannedAnswer.objects.create(question=question, choice='Yes').create_edge()
+        # Delete the clone first, or the original has its clones to update
+        with CaptureQueriesContext(connection) as big_queries:
+            big.delete()
+        with CaptureQueriesContext(connection) as small_queries:
+            self.template.delete()
+        self.assertEqual(len(big_queries), len(small_queries))
+        self.assertFalse(Question.objects.exists())
+        self.assertFalse(Node.objects.exists())
+        self.assertFalse(Edge.objects.exists())
+
+
+class TestPositions(CannedData, test.TestCase):
+
+    def create_questions(self, *positions):
+        return [ChoiceQuestion.objects.create(position=position, **self.canned_question)
+                for position in positions]
+
+    def get_positions(self):
+        return list(self.section.questions.values_list('label', 'position'))
+
+    def test_renumber(self):
+        for i, question in enumerate(self.create_questions(1, 2, 7, 12)):
+            question.label = str(i)
+            question.save()
+        generation = self.template.get_stamp()[1]
+        with self.assertNumQueries(3):  # select, update, bump generation
+            self.section.renumber_positions()
+        self.assertEqual(self.get_positions(),
+                         [('0', 1024), ('1', 2048), ('2', 3072), ('3', 4096)])
+        self.assertGreater(self.template.get_stamp()[1], generation)
+        with self.assertNumQueries(1):
+            self.section.renumber_positions()
+
+    def test_renumber_overlapping(self):
+        # The new positions overlap the old, so they are moved out of the way first
+        first, second, third = self.create_questions(5, 1024, 2048)
+        self.section.renumber_positions()
+        self.assertEqual(list(self.section.questions.values_list('pk', 'position')),
+                         [(first.pk, 1024), (second.pk, 2048), (third.pk, 3072)])
+
+    def test_move_touches_one_row(self):
+        first, second, third = self.create_questions(1024, 2048, 3072)
+        third.move_after(first)
+        self.assertEqual(third.position, 1536)
+        self.assertEqual(list(self.section.questions.values_list('pk', 'position')),
+                         [(first.pk, 1024), (third.pk, 1536), (second.pk, 2048)])
+        first.move_after(None)
+        self.assertEqual(first.position, 768)
+        second.move_up()
+        self.assertEqual(list(self.section.questions.values_list('pk', flat=True)),
+                         [first.pk, second.pk, third.pk])
+
+    def test_move_without_room(self):
+        first, second, third = self.create_questions(1, 2, 3)
+        first.move_down()
+        self.assertEqual(list(self.section.questions.values_list('pk', 'position')),
+                         [(second.pk, 2048), (first.pk, 2560), (third.pk, 3072)])
+        third.move_up()
+        third.move_up()
+        self.assertEqual(list(self.section.questions.values_list('pk', flat=True)),
+                         [third.pk, second.pk, first.pk])
+        self.assertEqual(list(self.template.snapshot().questions), [third, second, first])
+
+    def test_new_objects_go_last(self):
+        first, second = self.create_questions(None, None)
+        self.assertEqual((first.position, second.position), (1024, 2048))
+        section = Section.objects.create(template=self.template, title='Last')
+        self.assertEqual(section.position, 1 + 1024)
+
+    def test_ordinals(self):
+        first, second, third = self.create_questions(512, 600, 4096)
+        self.assertEqual([q.get_ordinal() for q in (first, second, third)], [1, 2, 3])
+        questions = with_ordinals(Question.objects.filter(section=self.section))
+        with self.assertNumQueries(1):
+            self.assertEqual([q.get_ordinal() for q in questions], [1, 2, 3])
+        section = Section.objects.create(template=self.template, title='Last', position=5000)
+        question = ChoiceQuestion.objects.create(section=section, question='q')
+        self.assertEqual(question.legend(), 'Template(2): q')
+        question.create_node()
+        node = Node.objects.get(pk=question.node_id)
+        with self.assertNumQueries(2):  # the question, then section and template
+            self.assertEqual(str(node), 'Template(2): q')
+
+
+class TestSectionPaths(test.SimpleTestCase):
+
+    def make_paths(self, adjacency, first=1):
+        edges = {pk: tuple(('->', t) for t in targets) for pk, targets in adjacency.items()}
+        return SectionPaths(first, edges)
+
+    def dfs(self, adjacency, first=1):
+        paths = set()
+        for path in dfs_paths({k: set(v) for k, v in adjacency.items()}, first):
+            if not path[-1]:
+                path = path[:-1]
+            paths.add(tuple(path))
+        return paths
+
+    def test_paths_match_dfs_paths(self):
+        adjacency = {
+            1: (2, 3),
+            2: (4, None),
+            3: (4,),
+            4: (5, 6),
+            5: (None,),
+            6: (),
+        }
+        paths = self.make_paths(adjacency)
+        self.assertEqual(set(paths.paths), self.dfs(adjacency))
+        self.assertEqual(paths.count(), len(self.dfs(adjacency)))
+        self.assertEqual(paths.count(), 5)
+
+    def test_paths_are_lazy(self):
+        adjacency = {i: (i + 1, i + 2) for i in range(1, 60)}
+        adjacency.update({60: (None,), 61: (None,)})
+        paths = self.make_paths(adjacency)
+        first = next(paths.iter_paths())
+        self.assertEqual(first[0], 1)
+        self.assertGreater(paths.count(), 10**12)
+
+    def test_is_path(self):
+        adjacency = {1: (2, 3), 2: (4,), 3: (4,), 4: (None,)}
+        paths = self.make_paths(adjacency)
+        self.assertTrue(paths.is_path({1, 2, 4}))
+        self.assertTrue(paths.is_path({1, 3, 4}))
+        self.assertFalse(paths.is_path({1, 2, 3, 4}))
+        self.assertFalse(paths.is_path({1, 2}))
+        self.assertFalse(paths.is_path({2, 4}))
+        self.assertFalse(paths.is_path(set()))
+
+    def test_loops(self):
+        adjacency = {1: (2,), 2: (3, None), 3: (1, 2)}
+        paths = self.make_paths(adjacency)
+        self.assertIsNone(paths.order)
+        self.assertEqual(set(paths.paths), self.dfs(adjacency))
+        self.assertEqual(paths.count(), 1)
+        self.assertTrue(paths.is_path({1, 2}))
+        self.assertFalse(paths.is_path({1, 2, 3}))
+
+
+class TestSummaryEEStore(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        eestore_type = EEStoreType.objects.create(name='repo')
+        source = EEStoreSource.objects.create(eestore_type=eestore_type, name='src')
+        for i in range(3):
+            EEStoreCache.objects.create(
+                eestore_pid='repo:{}'.format(i), eestore_id=i, remote_id=str(i),
+                eestore_type=eestore_type, source=source, name='Repo {}'.format(i),
+            )
+        self.single = ExternalChoiceQuestion.objects.create(position=1, **self.canned_question)
+        self.multiple = ExternalMultipleChoiceOneTextQuestion.objects.create(position=2, **self.canned_question)
+        for question in (self.single, self.multiple):
+            EEStoreMount.objects.create(question=question, eestore_type=eestore_type)
+
+    def test_entries_are_fetched_in_one_query(self):
+        data = {
+            str(self.single.pk): {'choice': 'repo:0'},
+            str(self.multiple.pk): {'choice': ['repo:2', 'repo:1']},
+        }
+        graph = self.template.snapshot()
+        with self.assertNumQueries(1):
+            summary = graph.get_summary(data)
+        answers = summary[self.section.full_title()]['data']
+        self.assertEqual(answers[self.single.pk]['answer'], 'Repo 0')
+        self.assertEqual(answers[self.multiple.pk]['answer'], 'Repo 1 and Repo 2')
+        self.assertEqual(answers[self.multiple.pk]['answer'],
+                         self.multiple.pprint_html(data[str(self.multiple.pk)]))
+        self.assertFalse(hasattr(graph.get_question(self.single.pk), '_prefetched_entries'))
+
+
+class TestSectionIndex(test.SimpleTestCase):
+
+    def test_lookups(self):
+        index = SectionIndex(
+            [(1, None), (2, 1), (3, 2), (4, None), (5, None)],
+            {1: [10, 11], 2: [], 3: [], 4: [40], 5: []},
+        )
+        self.assertEqual(index.order, (1, 2, 3, 4, 5))
+        self.assertEqual((index.next[1], index.next[5]), (2, None))
+        self.assertEqual((index.prev[1], index.prev[5]), (None, 4))
+        self.assertEqual([index.next_nonempty[pk] for pk in index.order], [4, 4, 4, None, None])
+        self.assertEqual([index.prev_nonempty[pk] for pk in index.order], [None, 1, 1, 1, 4])
+        self.assertEqual((index.first_question[1], index.last_question[1]), (10, 11))
+        self.assertIsNone(index.first_question[2])
+        self.assertEqual([index.topmost[pk] for pk in index.order], [1, 1, 1, 4, 5])
+
+    def test_super_section_loop(self):
+        index = SectionIndex([(1, 2), (2, 1)], {})
+        self.assertIn(index.topmost[1], (1, 2))
+        self.assertEqual(index.topmost[1], index.topmost[2])
+
+
+class TestSectionNavigation(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.empty = Section.objects.create(template=self.template, title='Empty', position=2,
+                                            super_section=self.section)
+        self.last = Section.objects.create(template=self.template, title='Last', position=3)
+        self.q1 = BooleanQuestion.objects.create(position=1, **self.canned_question)
+        self.q2 = BooleanQuestion.objects.create(position=2, **self.canned_question)
+        self.q3 = BooleanQuestion.objects.create(section=self.last, question='t', position=1)
+
+    def test_sections(self):
+        self.assertEqual(self.section.get_next_section(), self.empty)
+        self.assertEqual(self.last.get_prev_section(), self.empty)
+        self.assertIsNone(self.last.get_next_section())
+        self.assertEqual(self.empty.get_topmost_section(), self.section)
+        self.assertEqual(self.template.first_section, self.section)
+        self.assertEqual(self.template.last_section, self.last)
+
+    def test_questions(self):
+        self.assertEqual(self.section.get_first_question(), self.q1)
+        self.assertEqual(self.section.get_last_question(), self.q2)
+        self.assertIsNone(self.empty.get_first_question())
+        self.assertEqual(self.empty.first_question, self.q3)
+        self.assertEqual(self.empty.last_question, self.q2)
+        self.assertEqual(self.q2.get_first_question_in_next_section(), self.q3)
+        self.assertEqual(self.q3.get_last_question_in_prev_section(), self.q2)
+        self.assertIsNone(self.q1.get_last_question_in_prev_section())
+        self.assertEqual(self.template.first_question, self.q1)
+        self.assertEqual(self.template.last_question, self.q3)
+        graph = self.template.snapshot()
+        with self.assertNumQueries(0):
+            graph.get_first_question_in_next_section(self.section)
+            graph.get_topmost_section(self.empty)
+
+
+class TestTemplateGraphCache(BranchingData, test.TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        clear_template_graph_cache()
+
+    def test_snapshot_is_cached_until_changed(self):
+        graph = self.template.snapshot()
+        self.assertIs(self.template.snapshot(), graph)
+        self.q3.question = 'Changed'
+        self.q3.save()
+        new_graph = self.template.snapshot()
+        self.assertIsNot(new_graph, graph)
+        self.assertEqual(new_graph.get_question(self.q3.pk).question, 'Changed')
+
+    def test_compiled_fsas_are_reused(self):
+        self.template.snapshot()
+        self.q3.question = 'Changed'
+        self.q3.save()
+        with self.assertNumQueries(5):  # the FSA is already compiled
+            self.template.snapshot()
+
+
+class TestRenderedCache(BranchingData, test.TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        clear_template_graph_cache()
+        clear_rendered_cache()
+
+    def test_canned_text_is_memoized(self):
+        data = {
+            str(self.q1.pk): {'choice': True},
+            str(self.q2.pk): {'choice': 'b'},
+        }
+        texts = self.template.generate_canned_text(data)
+        self.assertEqual(get_rendered_cache_info()['misses'], 2)
+        summary = self.template.get_summary(data)
+        self.assertEqual(self.template.generate_canned_text(data), texts)
+        info = get_rendered_cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['entries']), (2, 4, 4))
+        self.assertEqual(summary[self.section.full_title()]['data'][self.q1.pk]['answer'], 'Yes')
+        # Bulk updates send no signals
+        CannedAnswer.objects.filter(question=self.q2, choice='b').update(canned_text='Changed')
+        Template.objects.filter(pk=self.template.pk).bump_generation()
+        texts = self.template.generate_canned_text(data)
+        self.assertEqual(texts[0]['text'][1]['text'], 'Changed')
+
+
+class TestLRUCache(test.SimpleTestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(cache), 2)
+
+    def test_evicts_by_weight(self):
+        cache = LRUCache(10, maxweight=5)
+        cache.set('a', 'aaa', 3)
+        cache.set('b', 'bb', 2)
+        self.assertEqual(cache.weight, 5)
+        cache.set('c', 'c', 1)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.weight, 3)
+        cache.set('b', 'b', 1)
+        self.assertEqual(cache.weight, 2)
+        cache.pop('c')
+        self.assertEqual(cache.weight, 1)
+
+
+class TestLabelCache(CannedData, test.TestCase):
+
+    def test_labels_are_cached_until_saved(self):
+        question = ChoiceQuestion.objects.create(label='1', position=1, **self.canned_question)
+        info = get_label_cache_info()
+        self.assertEqual(str(question), '1 s')
+        with self.assertNumQueries(0):
+            self.assertEqual(str(question), '1 s')
+        self.assertEqual(get_label_cache_info()['hits'], info['hits'] + 1)
+        self.assertEqual(get_label_cache_info()['entries'], info['entries'] + 1)
+        question.forget_label()
+        self.assertEqual(get_label_cache_info()['entries'], info['entries'])
+        same = ChoiceQuestion.objects.get(pk=question.pk)
+        same.label = '2'
+        same.save()
+        self.assertEqual(str(same), '2 s')
+        question.refresh_from_db()
+        self.assertEqual(str(question), '2 s')
+
+    def test_labels_follow_related_objects(self):
+        self.assertEqual(str(self.section), 'Template: Miscellaneous')
+        self.template.abbreviation = 'T'
+        self.template.save()
+        section = Section.objects.get(pk=self.section.pk)
+        self.assertEqual(str(section), 'T: Miscellaneous')
+
+    def test_labels_do_not_leak_between_instances(self):
+        first = Section.objects.get(pk=self.section.pk)
+        str(first)
+        Section.objects.filter(pk=self.section.pk).update(title='Changed')
+        self.assertEqual(str(Section.objects.get(pk=self.section.pk)),
+                         'Template: Changed')
+
+    def test_default_label(self):
+        # Models without their own get_label() get Django's label
+        self.assertEqual(CachedLabelMixin.get_label(EEStoreMount()), 'EEStoreMount object')
+
+
+class TestQuestionMapAnswersToNodes(CannedData, test.TestCase):
+
+    def test_map_answers_to_nodes_many(self):
+        q1 = BooleanQuestion.objects.create(label='q1', position=1, **self.canned_question)
+        q1.create_node()
+        q2 = DateRangeQuestion.objects.create(position=2, **self.canned_question)
+        answer_sets = [
+            {str(q1.pk): {'choice': 'Yes'}, str(q2.pk): {'choice': 'whenever'}},
+            {str(q1.pk): {'choice': 'No'}},
+            {},
+        ]
+        with self.assertNumQueries(1):
+            result = Question.map_answers_to_nodes_many(answer_sets)
+        self.assertEqual(result, [{'q1': 'Yes'}, {'q1': 'No'}, {}])
+        self.assertEqual(Question.map_answers_to_nodes(answer_sets[0]), result[0])
+
+
 class TestQuestionNextQuestionMethods(CannedData, test.TestCase):
 
     def test_no_next_question(self):
         q = DateRangeQuestion.objects.create(**self.canned_question)
         result = q.get_next_question(None)
         self.assertEqual(result, None)
-        q = DateRangeQuestion.objects.create(position=2, **self.canned_question)
+        q = DateRangeQuestion.objects.create(**self.canned_question)  # goes last
         result = q.get_next_question(None)
         self.assertEqual(result, None)
 
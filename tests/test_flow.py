@@ -2,12 +2,27 @@
 
 from __future__ import unicode_literals
 
+from pathlib import Path
+from unittest import mock
+import os
+import tempfile
+
 from django import test
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import transaction
+from django.test.utils import CaptureQueriesContext
 from datetime import date
+from io import StringIO
 
+from flow.analysis import get_analysis
+from flow.compiled import clear_compiled_fsa_cache, invalidate_compiled_fsa
 from flow.models import Node
 from flow.models import Edge
 from flow.models import FSA
+from flow.graphviz import RenderCache, get_render_cache, render_dotsource_to_file
+from flow.graphviz import render_dotsource_to_bytes
 
 
 def generate_nodes(start, **canned_data):
@@ -171,11 +186,109 @@ class TestFSA(CannedData, test.TestCase):
         self.assertEqual(set(paths), set((route1, route2)))
         self.assertNotEqual(route1, route2)
 
+    def test_evaluate_many(self):
+        self.generate_nodes()
+        data_sets = [{'s1': 'True'}, {'s1': 'False'}, {}, {'s1': 'Maybe'}]
+        walks = self.fsa.evaluate_many(data_sets)
+        self.assertEqual(walks[0].path, ('start', 's1', 's2', 's4', 's5'))
+        self.assertEqual(walks[0].terminal, 's5')
+        self.assertTrue(walks[0].complete)
+        self.assertEqual(walks[1].path, ('start', 's1', 's3', 's4', 's5'))
+        self.assertTrue(walks[1].complete)
+        self.assertEqual(walks[2].path, ('start', 's1'))
+        self.assertEqual(walks[2].terminal, 's1')
+        self.assertFalse(walks[2].complete)
+        self.assertEqual(walks[3].terminal, 's1')
+        self.assertFalse(walks[3].complete)
+
+    def test_evaluate_many_end_node_and_loop(self):
+        self.generate_nodes()
+        Node.objects.filter(slug='s4').update(end=True)
+        Edge.objects.create(condition='Maybe', prev_node=self.nodes['s1'], next_node=self.start)
+        self.fsa.compile()
+        walks = self.fsa.evaluate_many([{'s1': 'True'}, {'s1': 'Maybe'}])
+        self.assertEqual(walks[0].path, ('start', 's1', 's2', 's4'))
+        self.assertTrue(walks[0].complete)
+        self.assertEqual(walks[1].path, ('start', 's1'))
+        self.assertFalse(walks[1].complete)
+
+    def test_iter_paths(self):
+        self.generate_nodes()
+        route1 = (self.start.slug, 's1', 's2', 's4', 's5', None)
+        route2 = (self.start.slug, 's1', 's3', 's4', 's5', None)
+        paths = list(self.fsa.iter_paths())
+        limited = list(self.fsa.iter_paths(limit=1))
+        through = list(self.fsa.iter_paths(through='s3'))
+        from_s4 = list(self.fsa.iter_paths(from_='s4'))
+        self.assertEqual(set(paths), set((route1, route2)))
+        self.assertEqual(len(limited), 1)
+        self.assertEqual(through, [route2])
+        self.assertEqual(from_s4, [('s4', 's5', None)])
+
+    def test_iter_paths_stops_at_end_node(self):
+        self.generate_nodes()
+        self.nodes['s4'].end = True
+        self.nodes['s4'].save()
+        paths = set(self.fsa.iter_paths())
+        route1 = (self.start.slug, 's1', 's2', 's4')
+        route2 = (self.start.slug, 's1', 's3', 's4')
+        self.assertEqual(paths, set((route1, route2)))
+
+    def test_count_paths(self):
+        self.generate_nodes()
+        self.assertEqual(self.fsa.count_paths(), 2)
+        self.assertEqual(self.fsa.count_paths(from_='s4'), 1)
+        # Second diamond doubles the number of paths
+        s6 = Node.objects.create(slug='s6', **self.canned_data)
+        s7 = Node.objects.create(slug='s7', **self.canned_data)
+        Edge.objects.filter(prev_node=self.nodes['s5']).delete()
+        Edge.objects.create(condition='True', prev_node=self.nodes['s5'], next_node=s6)
+        Edge.objects.create(condition='False', prev_node=self.nodes['s5'], next_node=s7)
+        Edge.objects.create(prev_node=s6)
+        Edge.objects.create(prev_node=s7)
+        self.assertEqual(self.fsa.count_paths(), 4)
+        self.assertEqual(self.fsa.count_paths(), len(self.fsa.find_all_paths()))
+
+    def test_find_paths_to_and_from(self):
+        self.generate_nodes()
+        paths_to = self.fsa.find_paths_to('s4')
+        self.assertEqual(set(paths_to), set((
+            (self.start.slug, 's1', 's2', 's4'),
+            (self.start.slug, 's1', 's3', 's4'),
+        )))
+        paths_from = self.fsa.find_paths_from('s4')
+        self.assertEqual(paths_from, [('s4', 's5', None)] * 2)
+
+    def test_find_paths_to_skips_other_paths_and_duplicates(self):
+        self.generate_nodes()
+        # Only the path through s2 reaches s2, and it ends there
+        self.assertEqual(self.fsa.find_paths_to('s2'),
+                         [(self.start.slug, 's1', 's2')])
+        # A diamond after s4 doubles the full paths but not those to s4
+        s6 = Node.objects.create(slug='s6', **self.canned_data)
+        s7 = Node.objects.create(slug='s7', **self.canned_data)
+        Edge.objects.filter(prev_node=self.nodes['s5']).delete()
+        Edge.objects.create(condition='True', prev_node=self.nodes['s5'], next_node=s6)
+        Edge.objects.create(condition='False', prev_node=self.nodes['s5'], next_node=s7)
+        Edge.objects.create(prev_node=s6)
+        Edge.objects.create(prev_node=s7)
+        self.assertEqual(len(self.fsa.find_paths_to('s4')), 2)
+        self.assertEqual(self.fsa.find_paths_to('unknown'), [])
+
     def test_get_maximal_previous_nodes(self):
         self.generate_nodes()
         result = self.fsa.get_maximal_previous_nodes('s4')
         self.assertEqual(len(result), 4)
 
+    def test_get_maximal_previous_nodes_stops_at_start(self):
+        self.generate_nodes()
+        self.nodes['s1'].start = True
+        self.nodes['s1'].save()
+        result = self.fsa.get_maximal_previous_nodes('s4')
+        self.assertEqual(set(n.slug for n in result), set(('s1', 's2', 's3')))
+        with self.assertRaises(Node.DoesNotExist):
+            self.fsa.get_maximal_previous_nodes('unknown')
+
     def test_find_possible_paths_for_data(self):
         self.generate_nodes()
         expected_path = ('start', 's1', 's2', 's4', 's5')
@@ -194,8 +307,322 @@ class TestFSA(CannedData, test.TestCase):
         result = self.fsa.order_data(data)
         self.assertEqual(result, expected)
 
+    def test_order_data_unknown_path(self):
+        self.generate_nodes()
+        with self.assertRaises(KeyError):
+            self.fsa.order_data({'s2': None, 's3': None})
+
+    def test_reachability(self):
+        self.generate_nodes()
+        reachability = self.fsa.reachability()
+        self.assertTrue(reachability.is_consistent(['s1', 's3', 's5']))
+        self.assertTrue(reachability.is_consistent([]))
+        self.assertFalse(reachability.is_consistent(['s2', 's3']))
+        self.assertFalse(reachability.is_consistent(['s1', 'unknown']))
+        self.assertEqual(reachability.canonical_order(['s5', 's2', 'start']),
+                         ['start', 's2', 's5'])
+        self.assertEqual(reachability.reachable_before('s4'),
+                         frozenset(('start', 's1', 's2', 's3')))
+        self.assertEqual(reachability.reachable_after('s2'),
+                         frozenset(('s4', 's5')))
+
+    def test_reachability_matches_path_enumeration(self):
+        self.generate_nodes()
+        reachability = self.fsa.reachability()
+        paths = self.fsa.find_all_paths()
+        slugs = ['start', 's1', 's2', 's3', 's4', 's5']
+        for i, first in enumerate(slugs):
+            for second in slugs[i:]:
+                keys = set((first, second))
+                expected = any(keys.issubset(path) for path in paths)
+                self.assertEqual(reachability.is_consistent(keys), expected, keys)
+
     def test_generate_dotsource(self):
         self.generate_nodes()
         source = self.fsa.generate_dotsource()
         self.assertIn('start [shape=doublecircle]', source)
         self.assertIn('s5 [shape=doublecircle]', source)
+
+
+class TestCompiledFSA(CannedData, test.TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        clear_compiled_fsa_cache()
+
+    def generate_nodes(self):
+        self.nodes = generate_nodes(self.start, **self.canned_data)
+
+    def test_compile_in_three_queries(self):
+        self.generate_nodes()
+        with self.assertNumQueries(3):  # generation, nodes, edges
+            compiled = self.fsa.compile()
+        self.assertEqual(compiled.start, 'start')
+        self.assertEqual(compiled.graph['s1'], frozenset(('s2', 's3')))
+        self.assertEqual(compiled.graph['s5'], frozenset((None,)))
+        self.assertEqual(dict(compiled.transitions['s1']), {'True': 's2', 'False': 's3'})
+
+    def test_lookups_only_check_the_generation(self):
+        self.generate_nodes()
+        self.nodes['s1'].start = True
+        self.nodes['s1'].save()
+        self.fsa.compile()
+        with self.assertNumQueries(2):
+            next_node = self.fsa.nextnode('s1', {'s1': 'False'})
+            prev_node = self.fsa.prevnode('s4', {'s1': 'False', 's3': ''})
+        self.assertEqual(next_node, self.nodes['s3'])
+        self.assertEqual(prev_node, self.nodes['s3'])
+        with self.assertNumQueries(1):
+            self.fsa.evaluate_many([{'s1': 'True'}, {'s1': 'False'}, {}])
+        with self.assertNumQueries(1):
+            list(self.fsa.iter_paths(through='s3'))
+        with self.assertNumQueries(1):
+            self.fsa.get_maximal_previous_nodes('s4')
+
+    def test_cache_is_invalidated_on_edge_changes(self):
+        self.generate_nodes()
+        compiled = self.fsa.compile()
+        self.assertIs(self.fsa.compile(), compiled)
+        s6 = Node.objects.create(slug='s6', **self.canned_data)
+        self.assertIsNot(self.fsa.compile(), compiled)
+        compiled = self.fsa.compile()
+        Edge.objects.create(condition='True', prev_node=self.nodes['s5'], next_node=s6)
+        self.assertIsNot(self.fsa.compile(), compiled)
+        self.assertEqual(self.fsa.compile().graph['s5'], frozenset((None, 's6')))
+
+    def test_cache_is_invalidated_by_other_processes(self):
+        self.generate_nodes()
+        compiled = self.fsa.compile()
+        # Another process changing the FSA only leaves the generation behind
+        Node.objects.filter(slug='s4').update(end=True)
+        invalidate_compiled_fsa(self.fsa.pk)
+        self.assertIsNot(self.fsa.compile(), compiled)
+        self.assertIn('s4', self.fsa.compile().ends)
+
+    def test_nothing_is_cached_inside_a_transaction(self):
+        self.generate_nodes()
+        with transaction.atomic():
+            compiled = self.fsa.compile()
+            self.assertIsNot(self.fsa.compile(), compiled)
+        compiled = self.fsa.compile()
+        self.assertIs(self.fsa.compile(), compiled)
+
+
+class TestFSAClone(CannedData, test.TestCase):
+
+    def generate_nodes(self):
+        self.nodes = generate_nodes(self.start, **self.canned_data)
+
+    def test_clone(self):
+        self.generate_nodes()
+        self.nodes['s2'].depends = self.nodes['s1']
+        self.nodes['s2'].save()
+        new = self.fsa.clone('clone')
+        self.assertEqual(new.cloned_from, self.fsa)
+        self.assertEqual(new.generate_graph().keys(), self.fsa.generate_graph().keys())
+        for slug, goes_to in self.fsa.generate_graph().items():
+            self.assertEqual(set(new.generate_graph()[slug]), set(goes_to))
+        self.assertEqual(new.start.slug, 'start')
+        s2 = new.nodes.get(slug='s2')
+        self.assertEqual(s2.depends, new.nodes.get(slug='s1'))
+        self.assertEqual(s2.cloned_from, self.nodes['s2'])
+        self.assertFalse(Edge.objects.filter(prev_node__fsa=new, cloned_from__isnull=True).exists())
+        self.assertEqual(new.find_all_paths(), self.fsa.find_all_paths())
+
+    def test_clone_query_count_is_constant(self):
+        self.generate_nodes()
+        small = FSA.objects.create(slug='small')
+        start = Node.objects.create(slug='start', fsa=small, start=True)
+        s1 = Node.objects.create(slug='s1', fsa=small, depends=start)
+        Edge.objects.create(prev_node=start, next_node=s1)
+        Edge.objects.create(prev_node=s1)
+        with CaptureQueriesContext(connection) as small_queries:
+            small.clone('small-clone')
+        with CaptureQueriesContext(connection) as big_queries:
+            self.fsa.clone('big-clone')
+        # The big one has no depends to update
+        self.assertEqual(len(big_queries), len(small_queries) - 1)
+
+
+class TestRenderCache(test.SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_file(self, name, size):
+        path = self.directory / name
+        path.write_bytes(b'x' * size)
+        return path
+
+    def test_get_and_put(self):
+        cache = RenderCache(self.directory / 'cache')
+        self.assertIsNone(cache.get('png', 'digraph {}'))
+        rendered = self.make_file('rendered.png', 10)
+        cached = cache.put('png', 'digraph {}', rendered)
+        self.assertEqual(cache.get('png', 'digraph {}'), cached)
+        self.assertIsNone(cache.get('svg', 'digraph {}'))
+        self.assertIsNone(cache.get('png', 'digraph { a }'))
+
+    def test_evict_least_recently_used(self):
+        cache = RenderCache(self.directory / 'cache', max_size=25)
+        rendered = self.make_file('rendered.png', 10)
+        first = cache.put('png', 'first', rendered)
+        os.utime(str(first), (0, 0))
+        second = cache.put('png', 'second', rendered)
+        os.utime(str(second), (1, 1))
+        cache.get('png', 'first')  # first is now the most recently used
+        cache.put('png', 'third', rendered)
+        self.assertIsNotNone(cache.get('png', 'first'))
+        self.assertIsNone(cache.get('png', 'second'))
+        self.assertIsNotNone(cache.get('png', 'third'))
+
+    def test_render_cache_hit_does_not_run_graphviz(self):
+        dotsource = 'digraph { a -> b }'
+        cache = get_render_cache(self.directory)
+        cache.put('svg', dotsource, self.make_file('rendered.svg', 10))
+        with mock.patch('graphviz.Source.render') as render:
+            path = render_dotsource_to_file('svg', 'graph', dotsource, self.directory)
+        render.assert_not_called()
+        self.assertEqual(path.read_bytes(), b'x' * 10)
+
+    def test_render_cache_evicted_after_touch_is_a_miss(self):
+        cache = RenderCache(self.directory / 'cache')
+        missing = self.directory / 'cache' / 'missing.png'
+        with mock.patch.object(cache, 'get', return_value=missing):
+            self.assertIsNone(cache.get_bytes('png', 'digraph {}'))
+
+    def test_render_to_file_renders_when_evicted_after_touch(self):
+        dotsource = 'digraph { a -> b }'
+        cache = get_render_cache(self.directory)
+        cached = cache.put('svg', dotsource, self.make_file('rendered.svg', 10))
+        cached.unlink()
+
+        def render(cleanup):
+            (self.directory / 'graph.svg').write_bytes(b'y')
+
+        with mock.patch.object(cache, 'get', return_value=cached):
+            with mock.patch('graphviz.Source.render', side_effect=render) as mocked:
+                render_dotsource_to_file('svg', 'graph', dotsource, self.directory)
+        mocked.assert_called_once_with(cleanup=True)
+        self.assertEqual(cache.get_bytes('svg', dotsource), b'y')
+
+
+class TestRenderToBytes(test.SimpleTestCase):
+
+    def test_render_dotsource_to_bytes(self):
+        with mock.patch('graphviz.Source.pipe', return_value=b'<svg/>') as pipe:
+            result = render_dotsource_to_bytes('svg', 'digraph { a -> b }')
+        pipe.assert_called_once_with()
+        self.assertEqual(result, b'<svg/>')
+
+    def test_renders_are_cached(self):
+        dotsource = 'digraph { a -> b }'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch('graphviz.Source.pipe', return_value=b'<svg/>') as pipe:
+                first = render_dotsource_to_bytes('svg', dotsource, tmpdir)
+                second = render_dotsource_to_bytes('svg', dotsource, tmpdir)
+                render_dotsource_to_bytes('png', dotsource, tmpdir)
+            self.assertEqual(pipe.call_count, 2)
+            self.assertEqual(first, second)
+            cache = get_render_cache(tmpdir)
+            self.assertEqual(cache.get_bytes('svg', dotsource), b'<svg/>')
+
+
+class TestFSAAdminGraph(test.TestCase):
+
+    def setUp(self):
+        from easydmp.auth.models import User
+        self.tmpdir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(FSA, 'GRAPHVIZ_TMPDIR', self.tmpdir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+        self.fsa = FSA.objects.create(slug='graph')
+        Node.objects.create(fsa=self.fsa, slug='start', start=True, end=True)
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(self.user)
+
+    def test_graph_view(self):
+        url = '/admin/flow/fsa/{}/graph.svg/'.format(self.fsa.pk)
+        with mock.patch('graphviz.Source.pipe', return_value=b'<svg/>'):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertEqual(response.content, b'<svg/>')
+        with mock.patch('graphviz.Source.pipe') as pipe:
+            response = self.client.get(url)
+        pipe.assert_not_called()
+        self.assertEqual(response.content, b'<svg/>')
+
+    def test_change_view_links_to_graph(self):
+        response = self.client.get('/admin/flow/fsa/{}/change/'.format(self.fsa.pk))
+        self.assertContains(response, '/admin/flow/fsa/{}/graph.svg/'.format(self.fsa.pk))
+
+    def test_graph_view_unknown_format(self):
+        url = '/admin/flow/fsa/{}/graph.exe/'.format(self.fsa.pk)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+
+class TestFSAAnalysis(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        s1 = Node.objects.create(slug='s1', **self.canned_data)
+        s2 = Node.objects.create(slug='s2', **self.canned_data)
+        s3 = Node.objects.create(slug='s3', **self.canned_data)
+        Node.objects.create(slug='s4', end=True, **self.canned_data)
+        Edge.objects.create(prev_node=self.start, next_node=s1)
+        Edge.objects.create(condition='a', prev_node=s1, next_node=s2)
+        Edge.objects.create(condition='a', prev_node=s1, next_node=s3)
+        Edge.objects.create(prev_node=s2, next_node=s1)
+
+    def test_analyze(self):
+        report = self.fsa.analyze()
+        self.assertFalse(report.is_ok)
+        self.assertEqual(report.start, 'start')
+        self.assertEqual(report.unreachable, ('s4',))
+        self.assertEqual(report.dead_ends, ('s3',))
+        self.assertEqual(report.duplicate_conditions, {'s1': ('a',)})
+        self.assertEqual(report.cycles, (('s1', 's2'),))
+        self.assertEqual(len(report.problems()), 4)
+
+    def test_analyze_self_loop(self):
+        s3 = Node.objects.get(slug='s3')
+        Edge.objects.create(prev_node=s3, next_node=s3)
+        report = self.fsa.analyze()
+        self.assertEqual(report.dead_ends, ())
+        self.assertEqual(report.cycles, (('s1', 's2'), ('s3',)))
+
+    def test_analyze_is_cached_until_changed(self):
+        compiled = self.fsa.compile()
+        report = get_analysis(compiled)
+        self.assertIs(get_analysis(compiled), report)
+        Node.objects.filter(slug='s4').delete()
+        self.assertEqual(self.fsa.analyze().unreachable, ())
+
+    def test_analyze_clean_fsa(self):
+        fsa = FSA.objects.create(slug='clean')
+        start = Node.objects.create(slug='start', fsa=fsa, start=True)
+        end = Node.objects.create(slug='end', fsa=fsa, end=True)
+        Edge.objects.create(prev_node=start, next_node=end)
+        report = fsa.analyze()
+        self.assertTrue(report.is_ok)
+        self.assertEqual(report.problems(), [])
+
+    def test_no_start_node(self):
+        self.start.start = False
+        self.start.save()
+        report = self.fsa.analyze()
+        self.assertIsNone(report.start)
+        self.assertIn('There is no start node', report.problems())
+
+    def test_management_command(self):
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('analyze_fsas', stdout=out)
+        self.assertIn('cannot be reached', out.getvalue())
@@ -6,7 +6,8 @@ from easydmp.dmpt.models import Template, Section, BooleanQuestion, CannedAnswer
 from easydmp.auth.models import User
 
 from easydmp.plan import views
-from easydmp.plan.models import Plan
+from easydmp.plan.models import Answer, Plan, QuestionValidity, SectionValidity
+from easydmp.plan.summary import clear_plan_summary_cache
 from easydmp.plan.views import AbstractGeneratedPlanView
 
 
@@ -113,3 +114,158 @@ class GeneratedViewTestCase(test.TestCase):
         kwargs = {'plan': plan.pk}
         response = c.get(reverse(self.urlname, kwargs=kwargs))
         self.assertEqual(response.status_code, 404, '{} should be hidden'.format(self.urlname))
+
+
+class ValidationData(object):
+
+    def setUp(self):
+        self.template = Template.objects.create(title='test template')
+        self.questions = []
+        for i in range(3):
+            section = Section.objects.create(template=self.template, title=str(i), position=i)
+            for j in range(4):
+                question = BooleanQuestion.objects.create(section=section, position=j)
+                CannedAnswer.objects.create(question=question, choice='Yes')
+                CannedAnswer.objects.create(question=question, choice='No')
+                self.questions.append(question)
+        self.user = User.objects.create(username='test user')
+        self.plan = Plan.objects.create(
+            template=self.template, title='test plan',
+            added_by=self.user,
+            modified_by=self.user,
+        )
+
+    def answer(self, questions):
+        self.plan.data = {str(q.pk): {'choice': True} for q in questions}
+
+
+class ValidatePlanTestCase(ValidationData, test.TestCase):
+
+    def test_validate_plan(self):
+        self.answer(self.questions[:-1])
+        report = self.template.validate_plan(self.plan)
+        self.assertFalse(report)
+        last_section = self.questions[-1].section_id
+        self.assertEqual(report.invalid_sections, {last_section})
+        self.assertEqual(report.invalid_questions, {self.questions[-1].pk})
+        self.assertEqual(report.first_invalid[last_section], self.questions[-1].pk)
+        valids = set(QuestionValidity.objects.filter(plan=self.plan, valid=True)
+                     .values_list('question_id', flat=True))
+        self.assertEqual(valids, report.valid_questions)
+        self.assertEqual(SectionValidity.objects.filter(plan=self.plan, valid=True).count(), 2)
+        self.assertFalse(self.template.validate_plan(self.plan, recalculate=False))
+
+        self.answer(self.questions)
+        self.assertTrue(self.template.validate_plan(self.plan))
+        self.assertTrue(self.template.validate_plan(self.plan, recalculate=False))
+
+    def test_missing_validities_are_created(self):
+        QuestionValidity.objects.filter(plan=self.plan).delete()
+        self.answer(self.questions)
+        self.assertTrue(self.template.validate_plan(self.plan))
+        self.assertEqual(QuestionValidity.objects.filter(plan=self.plan, valid=True).count(), 12)
+
+    def test_fixed_number_of_queries(self):
+        self.answer(self.questions[:-1])
+        graph = self.template.snapshot()
+        # Look up existing rows, then one update each for questions and sections
+        with self.assertNumQueries(4):
+            graph.validate_plan(self.plan)
+
+    def test_nonsense_data(self):
+        self.plan.data = {'0': {'choice': True}}
+        report = self.template.validate_plan(self.plan)
+        self.assertFalse(report)
+        self.assertEqual(len(report.errors), 1)
+
+
+class RevalidatePlanTestCase(ValidationData, test.TestCase):
+
+    def test_answer_revalidates_question_and_section(self):
+        self.answer(self.questions[:-1])
+        self.template.validate_plan(self.plan)
+        question = self.questions[-1]
+        answer = Answer(question, self.plan)
+        graph = self.template.snapshot()
+        with self.assertNumQueries(5):
+            report = graph.revalidate_question(self.plan, question)
+        self.assertEqual(report.invalid_sections, {question.section_id})
+        self.plan.data[str(question.pk)] = {'choice': True}
+        self.plan.save(question=question)
+        self.assertTrue(self.plan.valid)
+        self.assertTrue(QuestionValidity.objects.get(plan=self.plan, question=question).valid)
+        self.assertEqual(SectionValidity.objects.filter(plan=self.plan, valid=True).count(), 3)
+        answer.save_choice({'choice': False}, self.user)
+        self.assertTrue(self.plan.valid)
+
+    def test_other_sections_are_left_alone(self):
+        self.answer(self.questions)
+        self.template.validate_plan(self.plan)
+        first = self.questions[0]
+        SectionValidity.objects.filter(plan=self.plan, section_id=first.section_id).update(valid=False)
+        question = self.questions[-1]
+        report = self.plan.revalidate(question)
+        self.assertFalse(report)
+        self.assertEqual(report.invalid_sections, {first.section_id})
+        self.assertEqual(report.valid_questions, {question.pk})
+
+
+class PlanSummaryCacheTestCase(ValidationData, test.TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        clear_plan_summary_cache()
+
+    def test_summary_is_cached_until_changed(self):
+        self.answer(self.questions)
+        self.plan.save()
+        summary = self.plan.get_summary()
+        with self.assertNumQueries(2):  # the stamp and the valid sections
+            self.assertIs(self.plan.get_summary(), summary)
+        self.plan.validate(recalculate=True)
+        new_summary = self.plan.get_summary()
+        self.assertIsNot(new_summary, summary)
+        self.assertIs(self.plan.get_summary(), new_summary)
+        section = self.questions[0].section
+        self.assertTrue(new_summary[section.full_title()]['section']['valid'])
+
+
+class NavigationMapTestCase(ValidationData, test.TestCase):
+
+    def test_navigation_map(self):
+        self.answer(self.questions[:2])
+        navigation_map = self.plan.navigation_map()
+        self.assertEqual(list(navigation_map.questions), self.questions)
+        self.assertTrue(navigation_map.complete)
+        self.assertEqual(len(navigation_map.sections), 3)
+
+    def test_prev_question(self):
+        self.answer(self.questions[:6])
+        navigation_map = self.plan.navigation_map()
+        prev = views.get_prevquestion(self.questions[5], self.plan.data, navigation_map)
+        self.assertEqual(prev, self.questions[4])
+        # From the start of a section, back to the end of the previous one
+        prev = views.get_prevquestion(self.questions[4], self.plan.data, navigation_map)
+        self.assertEqual(prev, self.questions[3])
+        self.assertFalse(views.has_prevquestion(self.questions[0], self.plan.data, navigation_map))
+
+
+class DeletePlanTestCase(ValidationData, test.TestCase):
+
+    def test_delete_with_validities(self):
+        self.answer(self.questions)
+        self.plan.validate()
+        self.plan.visited_sections.add(self.questions[0].section)
+        other = Plan.objects.create(
+            template=self.template, title='other plan',
+            added_by=self.user, modified_by=self.user,
+        )
+        counts = self.plan.count_deletions()
+        self.assertEqual(counts['question validitys'], 12)
+        self.assertEqual(counts['section validitys'], 3)
+        self.assertEqual(Plan.objects.filter(pk=self.plan.pk).count(), 1)
+        self.plan.delete()
+        self.assertFalse(Plan.objects.filter(pk=self.plan.pk).exists())
+        self.assertFalse(QuestionValidity.objects.filter(plan_id=self.plan.pk).exists())
+        self.assertEqual(QuestionValidity.objects.filter(plan=other).count(), 12)
+        self.assertEqual(Section.objects.filter(template=self.template).count(), 3)